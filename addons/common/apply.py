@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Apply the documents of several manifests with as few kubectl round trips as
+possible.
+
+    apply.py [--timeout SECONDS] [--server-side-crds] <manifest> ...
+
+Manifests are files, https URLs or - for stdin, and their documents are applied
+in three batches:
+
+  1. CustomResourceDefinitions, then wait for them to be Established.
+  2. Everything else except the custom resources of the CRDs of step 1.
+  3. Those custom resources, once the webhooks of step 2 are serving. Webhooks
+     can still reject requests for a few seconds after that, so the batch is
+     retried on admission errors until the timeout.
+
+With --server-side-crds the CRDs are applied server-side, with conflicts forced.
+Large CRDs, eg those of the Gateway API and Traefik, do not fit in the
+last-applied-configuration annotation of a client-side apply, and their
+upstreams install them server-side. CRDs that an earlier enable applied
+client-side are taken over by the kubectl field manager, and forcing conflicts
+lets the addon keep owning them.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import yaml
+
+KUBECTL = os.path.expandvars("$SNAP/microk8s-kubectl.wrapper")
+WEBHOOK_KINDS = ["ValidatingWebhookConfiguration", "MutatingWebhookConfiguration"]
+# kubectl errors of an apply rejected because a webhook is not serving yet
+ADMISSION_ERRORS = ["failed calling webhook", "no endpoints available for service"]
+
+
+class ApplyError(Exception):
+    def __init__(self, message, output=""):
+        super().__init__(message)
+        self.output = output
+
+
+def load(source):
+    """
+    Returns: the documents of a manifest, with any List flattened.
+
+    """
+    if source == "-":
+        content = sys.stdin.read()
+    elif source.startswith("https://"):
+        with urllib.request.urlopen(source, timeout=60) as resp:
+            content = resp.read().decode("utf8")
+    else:
+        with open(source) as f:
+            content = f.read()
+    docs = []
+    for doc in yaml.safe_load_all(content):
+        if not doc:
+            continue
+        if doc.get("kind", "").endswith("List") and "items" in doc:
+            docs.extend(doc["items"])
+        else:
+            docs.append(doc)
+    return docs
+
+
+def split(docs):
+    """
+    Returns: (CRDs, other documents, custom resources of those CRDs)
+
+    """
+    crds = [d for d in docs if d.get("kind") == "CustomResourceDefinition"]
+    defined = {(c["spec"]["group"], c["spec"]["names"]["kind"]) for c in crds}
+    resources, custom = [], []
+    for doc in docs:
+        if doc.get("kind") == "CustomResourceDefinition":
+            continue
+        group = doc.get("apiVersion", "").rpartition("/")[0]
+        if (group, doc.get("kind")) in defined:
+            custom.append(doc)
+        else:
+            resources.append(doc)
+    return crds, resources, custom
+
+
+def kubectl(*args, input=None):
+    result = subprocess.run(
+        [KUBECTL] + list(args),
+        input=input,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    sys.stdout.write(result.stdout)
+    if result.returncode != 0:
+        raise ApplyError("kubectl {} failed".format(" ".join(args[:2])), result.stdout)
+    return result.stdout
+
+
+def apply(docs, server_side=False):
+    args = ["apply", "-f", "-"]
+    if server_side:
+        args += ["--server-side", "--force-conflicts"]
+    kubectl(*args, input=yaml.safe_dump_all(docs))
+
+
+def apply_custom(docs, timeout, interval=1):
+    """
+    Apply custom resources, retrying while their webhooks reject them until
+    timeout seconds have passed.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return apply(docs)
+        except ApplyError as err:
+            if not any(e in err.output for e in ADMISSION_ERRORS):
+                raise
+            if time.monotonic() + interval > deadline:
+                raise ApplyError("Timed out waiting for the webhooks to accept them")
+        print("The webhooks are not ready yet, will retry")
+        time.sleep(interval)
+
+
+def watch(resource, done, timeout, namespace=None, selector=None):
+    """
+    Watch the objects of a resource until done({name: object}) is true.
+    """
+    cmd = [KUBECTL, "get", resource, "-o", "json", "--watch"]
+    if namespace:
+        cmd += ["-n", namespace]
+    if selector:
+        cmd += ["-l", selector]
+    # Not a pipe, which kubectl could fill up while we only read its output
+    errors = tempfile.TemporaryFile(mode="w+")
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=errors, universal_newlines=True
+    )
+    timed_out = threading.Event()
+
+    def expire():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, expire)
+    timer.start()
+    decoder = json.JSONDecoder()
+    objects = {}
+    buf = ""
+    try:
+        for line in proc.stdout:
+            buf += line
+            try:
+                obj, end = decoder.raw_decode(buf.lstrip())
+            except ValueError:
+                continue
+            buf = buf.lstrip()[end:]
+            objects[obj["metadata"]["name"]] = obj
+            if done(objects):
+                return
+    finally:
+        timer.cancel()
+        proc.kill()
+        proc.wait()
+        errors.seek(0)
+        error = errors.read().strip()
+        errors.close()
+    if not timed_out.is_set():
+        # kubectl gave up on its own, eg on an unknown resource or no permission
+        raise ApplyError(
+            "kubectl get {} exited with {}: {}".format(
+                resource, proc.returncode, error or "no error output"
+            )
+        )
+    raise ApplyError("Timed out waiting for {}".format(resource))
+
+
+def wait_for_crds(crds, timeout):
+    names = ["crd/{}".format(c["metadata"]["name"]) for c in crds]
+    kubectl(
+        "wait", "--for=condition=Established", "--timeout={}s".format(timeout), *names
+    )
+
+
+def endpoints_ready(slices):
+    return any(
+        e.get("conditions", {}).get("ready")
+        for s in slices.values()
+        for e in s.get("endpoints") or []
+    )
+
+
+def wait_for_webhooks(resources, timeout):
+    """
+    Wait for the services behind the webhooks of resources to have a ready
+    endpoint, and for the CA bundles their manifests leave out to be injected.
+    """
+    for config in [r for r in resources if r.get("kind") in WEBHOOK_KINDS]:
+        name = config["metadata"]["name"]
+        services = set()
+        for webhook in config.get("webhooks", []):
+            service = webhook["clientConfig"].get("service")
+            if service:
+                services.add((service["namespace"], service["name"]))
+        for namespace, service in sorted(services):
+            print("Waiting for webhook service {}/{}".format(namespace, service))
+            watch(
+                "endpointslices",
+                endpoints_ready,
+                timeout,
+                namespace,
+                "kubernetes.io/service-name={}".format(service),
+            )
+        if not all(w["clientConfig"].get("caBundle") for w in config["webhooks"]):
+            print("Waiting for the CA bundle of {}".format(name))
+            watch(
+                "{}/{}".format(config["kind"].lower(), name),
+                lambda configs: all(
+                    w["clientConfig"].get("caBundle")
+                    for c in configs.values()
+                    for w in c.get("webhooks", [])
+                ),
+                timeout,
+            )
+
+
+def apply_all(sources, timeout=300, server_side_crds=False):
+    docs = [doc for source in sources for doc in load(source)]
+    crds, resources, custom = split(docs)
+    if crds:
+        apply(crds, server_side=server_side_crds)
+        wait_for_crds(crds, timeout)
+    if resources:
+        apply(resources)
+    if custom:
+        wait_for_webhooks(resources, timeout)
+        apply_custom(custom, timeout)
+
+
+def main(argv):
+    timeout = 300
+    server_side_crds = False
+    sources = []
+    args = iter(argv)
+    for arg in args:
+        if arg == "--timeout":
+            timeout = int(next(args))
+        elif arg == "--server-side-crds":
+            server_side_crds = True
+        else:
+            sources.append(arg)
+    if not sources:
+        print(__doc__.strip(), file=sys.stderr)
+        return 2
+    try:
+        apply_all(sources, timeout, server_side_crds)
+    except (OSError, ValueError, yaml.YAMLError, ApplyError) as err:
+        print("Cannot apply {}: {}".format(" ".join(sources), err), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
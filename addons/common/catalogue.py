@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+The addons of addons.yaml, compiled to a JSON index so that loading them does
+not need a YAML parse.
+
+    catalogue.py [--arch ARCH]
+
+prints the names of the addons supported on ARCH, the current one by default.
+
+The index holds the entries, a name -> entry map and the names supported on
+each architecture. It is keyed on the mtime, size and sha256 of addons.yaml:
+if the mtime and size match, the index is used as is. Otherwise addons.yaml is
+hashed, and it is only parsed again if its content changed. Indexes are kept in
+a private per-user directory, and only trusted if owned by the current user and
+not writable by others.
+"""
+
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+from pathlib import Path
+from stat import S_IWGRP, S_IWOTH
+
+import yaml
+
+ADDONS_YAML = Path(__file__).absolute().parents[2] / "addons.yaml"
+ARCH_TRANSLATE = {"aarch64": "arm64", "x86_64": "amd64"}
+VERSION = 1
+
+
+def current_arch():
+    machine = platform.machine()
+    return ARCH_TRANSLATE.get(machine, machine)
+
+
+def cache_path(addons_yaml):
+    """
+    Returns: where the index of addons_yaml is kept, under $SNAP_USER_COMMON
+    or the per-user cache directory.
+
+    """
+    key = hashlib.sha256(str(Path(addons_yaml).absolute()).encode("utf8"))
+    cache_dir = os.environ.get("SNAP_USER_COMMON") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "microk8s-addons",
+    )
+    return Path(cache_dir) / "addons-catalogue-{}.json".format(key.hexdigest()[:16])
+
+
+def compile_index(content, stat):
+    """
+    Returns: the index of the addons.yaml content.
+
+    """
+    addons = yaml.safe_load(content)["microk8s-addons"]["addons"]
+    by_arch = {}
+    for addon in addons:
+        for arch in addon.get("supported_architectures", []):
+            by_arch.setdefault(arch, []).append(addon["name"])
+    return {
+        "version": VERSION,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha256": hashlib.sha256(content).hexdigest(),
+        "addons": addons,
+        "by_arch": by_arch,
+    }
+
+
+def _trusted(f):
+    """
+    Returns: whether the open index file f is owned by the current user and
+    not writable by others, so that no other user can have planted it.
+
+    """
+    st = os.fstat(f.fileno())
+    return st.st_uid == os.geteuid() and not st.st_mode & (S_IWGRP | S_IWOTH)
+
+
+def _write(path, index):
+    try:
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, str(path))
+    except OSError:
+        # The index is only a cache, addons.yaml is parsed again next time
+        pass
+
+
+class Catalogue(object):
+    """
+    The addons of an addons.yaml, loaded from its index.
+    """
+
+    def __init__(self, index):
+        self.addons = index["addons"]
+        self.by_name = {addon["name"]: addon for addon in self.addons}
+        self._by_arch = index["by_arch"]
+
+    def for_arch(self, arch=None):
+        """
+        Returns: the entries of the addons supported on arch, in file order.
+
+        """
+        names = self._by_arch.get(arch or current_arch(), [])
+        return [self.by_name[name] for name in names]
+
+
+def load(addons_yaml=ADDONS_YAML, path=None):
+    """
+    Returns: the Catalogue of addons_yaml, from its index if it is current.
+
+    """
+    path = Path(path) if path else cache_path(addons_yaml)
+    stat = os.stat(str(addons_yaml))
+    try:
+        with open(str(path)) as f:
+            index = json.load(f) if _trusted(f) else None
+    except (OSError, ValueError):
+        index = None
+    if index and index.get("version") == VERSION:
+        if (index["mtime_ns"], index["size"]) == (stat.st_mtime_ns, stat.st_size):
+            return Catalogue(index)
+
+    with open(str(addons_yaml), "rb") as f:
+        content = f.read()
+    if (
+        index
+        and index.get("version") == VERSION
+        and index["sha256"] == hashlib.sha256(content).hexdigest()
+    ):
+        # Touched but not changed
+        index.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+    else:
+        index = compile_index(content, stat)
+    _write(path, index)
+    return Catalogue(index)
+
+
+def main(argv):
+    arch = argv[argv.index("--arch") + 1] if "--arch" in argv else None
+    for addon in load().for_arch(arch):
+        print(addon["name"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
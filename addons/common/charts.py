@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+A content-addressed cache of Helm chart archives, so that enabling an addon
+with a pinned chart version does not need the network.
+
+    charts.py fetch <repository URL> <chart> <version>
+    charts.py helm-args <repository URL> <chart> [<version>]
+    charts.py import <bundle directory or tarball>
+    charts.py vendor <chart directory>
+
+fetch prints the path of the chart archive, downloading it from the repository
+into the cache if needed. helm-args prints the helm arguments for the chart, one
+per line: the path fetch gives, or the chart with --repo and --version if it
+cannot be cached, eg with no version pinned or no network. import adds the
+charts of an offline bundle to the cache: a directory or tarball holding the
+chart archives and a charts.yaml that lists them, eg
+
+    charts:
+      - repository: https://charts.jetstack.io
+        chart: cert-manager
+        version: v1.19.1
+        file: cert-manager-v1.19.1.tgz
+        digest: <sha256 of the archive>
+
+vendor puts the archives of the dependencies of a chart in its charts/
+directory, from the cache, and locks them in charts.lock along with the sha256
+of Chart.yaml. They are reused as they are until Chart.yaml changes, so helm
+does not need to resolve them again.
+
+Archives are stored by their sha256, and checked against it when used. The
+least recently used charts are evicted once the cache grows over
+$MICROK8S_CHART_CACHE_MB, 512 by default.
+"""
+
+import fcntl
+import hashlib
+import http.client
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from pathlib import Path
+
+import yaml
+
+MB = 1024 * 1024
+LOCK = "charts.lock"
+# The C loader, where libyaml is available, parses the multi-MB index.yaml of
+# repositories like prometheus-community many times faster
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+class ChartError(Exception):
+    pass
+
+
+# Errors from fetching a chart, eg no network or a malformed repository reply
+FETCH_ERRORS = (
+    OSError,
+    ValueError,
+    KeyError,
+    IndexError,
+    http.client.HTTPException,
+    yaml.YAMLError,
+    ChartError,
+)
+
+
+def cache_dir():
+    return Path(os.environ.get("SNAP_COMMON", "/var/snap/microk8s/common")) / "charts"
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def download(url, timeout=60):
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        return resp.read()
+
+
+def extract(tar, path):
+    """
+    Extract a bundle tarball into path, refusing members that would land
+    outside of it, links and special files.
+    """
+    if hasattr(tarfile, "data_filter"):
+        try:
+            tar.extractall(path, filter="data")
+        except tarfile.FilterError as err:
+            raise ChartError("Unsafe bundle: {}".format(err))
+        return
+    for member in tar.getmembers():
+        parts = Path(member.name).parts
+        if (
+            member.name.startswith("/")
+            or ".." in parts
+            or not (member.isfile() or member.isdir())
+        ):
+            raise ChartError("Unsafe bundle member {}".format(member.name))
+    tar.extractall(path)
+
+
+class ChartCache(object):
+    """
+    Chart archives under root/blobs, named by their sha256, and an index in
+    root/index.json mapping repository, chart and version to an archive along
+    with its size and when it was last used.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = Path(root or cache_dir())
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("MICROK8S_CHART_CACHE_MB", "512")) * MB
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(repository, chart, version):
+        return " ".join([repository.rstrip("/"), chart, version.lstrip("v")])
+
+    def blob(self, digest):
+        return self.root / "blobs" / "{}.tgz".format(digest)
+
+    @contextmanager
+    def _index(self):
+        """
+        Yield the index for update, holding a lock against concurrent enables.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(str(self.root / "index.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(str(self.root / "index.json")) as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+            yield index
+            fd, tmp = tempfile.mkstemp(dir=str(self.root), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp, str(self.root / "index.json"))
+
+    def get(self, repository, chart, version):
+        """
+        Returns: the path of the cached archive, or None if it is not cached or
+        fails its digest check, in which case it is dropped.
+
+        """
+        key = self.key(repository, chart, version)
+        with self._index() as index:
+            entry = index.get(key)
+            if not entry:
+                return None
+            path = self.blob(entry["digest"])
+            try:
+                with open(str(path), "rb") as f:
+                    valid = sha256(f.read()) == entry["digest"]
+            except OSError:
+                valid = False
+            if not valid:
+                del index[key]
+                if path.exists():
+                    path.unlink()
+                return None
+            entry["used"] = time.time()
+            return path
+
+    def put(self, repository, chart, version, data, digest=None):
+        """
+        Store an archive, checking it against its expected digest if given.
+
+        Returns: its path
+
+        """
+        actual = sha256(data)
+        if digest and digest != actual:
+            raise ChartError(
+                "Digest mismatch for {} {}: expected {}, got {}".format(
+                    chart, version, digest, actual
+                )
+            )
+        path = self.blob(actual)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if not path.exists():
+            fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, str(path))
+        key = self.key(repository, chart, version)
+        with self._index() as index:
+            index[key] = {"digest": actual, "size": len(data), "used": time.time()}
+            self._evict(index, keep=key)
+        return path
+
+    def _evict(self, index, keep):
+        """
+        Drop the least recently used charts until the cache fits, and delete
+        the archives no chart refers to any more.
+        """
+        by_use = sorted(index, key=lambda k: index[k]["used"])
+        total = sum(
+            entry["size"] for entry in {e["digest"]: e for e in index.values()}.values()
+        )
+        for key in by_use:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            entry = index.pop(key)
+            if all(e["digest"] != entry["digest"] for e in index.values()):
+                total -= entry["size"]
+        referenced = {entry["digest"] for entry in index.values()}
+        for path in (self.root / "blobs").glob("*.tgz"):
+            if path.stem not in referenced:
+                path.unlink()
+
+    def fetch(self, repository, chart, version):
+        """
+        Returns: the path of the archive of chart version from the cache, or
+        downloaded from the repository into the cache.
+
+        """
+        path = self.get(repository, chart, version)
+        if path:
+            return path
+        base = repository.rstrip("/") + "/"
+        repo_index = yaml.load(
+            download(urllib.parse.urljoin(base, "index.yaml")), Loader=SafeLoader
+        )
+        for entry in (repo_index.get("entries") or {}).get(chart, []):
+            if entry.get("version", "").lstrip("v") == version.lstrip("v"):
+                url = urllib.parse.urljoin(base, entry["urls"][0])
+                return self.put(
+                    repository, chart, version, download(url), entry.get("digest")
+                )
+        raise ChartError("No chart {} {} in {}".format(chart, version, repository))
+
+    def import_bundle(self, bundle):
+        """
+        Add the charts of an offline bundle to the cache.
+
+        Returns: the number of charts added
+
+        """
+        bundle = Path(bundle)
+        with tempfile.TemporaryDirectory() as tmp:
+            if bundle.is_file():
+                with tarfile.open(str(bundle)) as tar:
+                    extract(tar, tmp)
+                bundle = Path(tmp)
+            with open(str(bundle / "charts.yaml")) as f:
+                charts = yaml.safe_load(f)["charts"]
+            for chart in charts:
+                with open(str(bundle / chart["file"]), "rb") as f:
+                    data = f.read()
+                self.put(
+                    chart["repository"],
+                    chart["chart"],
+                    str(chart["version"]),
+                    data,
+                    chart.get("digest"),
+                )
+        return len(charts)
+
+
+def file_digest(path):
+    """
+    Returns: the sha256 of the file at path, or None if it cannot be read.
+
+    """
+    try:
+        with open(str(path), "rb") as f:
+            return sha256(f.read())
+    except OSError:
+        return None
+
+
+def vendor(chart_dir, cache):
+    """
+    Put the dependencies of the chart in chart_dir in its charts/ directory
+    and lock them, unless the lock is current and the archives match it.
+
+    Returns: True if the vendored archives were reused, False if they were
+    put in place again
+
+    """
+    chart_dir = Path(chart_dir)
+    charts_dir = chart_dir / "charts"
+    with open(str(chart_dir / "Chart.yaml"), "rb") as f:
+        content = f.read()
+    try:
+        with open(str(chart_dir / LOCK)) as f:
+            lock = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError):
+        lock = None
+    if (
+        lock
+        and lock.get("chart") == sha256(content)
+        and all(
+            file_digest(charts_dir / dep["file"]) == dep["digest"]
+            for dep in lock["dependencies"]
+        )
+    ):
+        return True
+
+    dependencies = []
+    for dep in yaml.safe_load(content).get("dependencies") or []:
+        version = str(dep["version"])
+        path = cache.fetch(dep["repository"], dep["name"], version)
+        dependencies.append(
+            {
+                "name": dep["name"],
+                "version": version,
+                "repository": dep["repository"],
+                "file": "{}-{}.tgz".format(dep["name"], version),
+                "digest": path.stem,
+            }
+        )
+        charts_dir.mkdir(exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(charts_dir), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f, open(str(path), "rb") as src:
+            f.write(src.read())
+        os.replace(tmp, str(charts_dir / dependencies[-1]["file"]))
+    files = {dep["file"] for dep in dependencies}
+    for path in charts_dir.glob("*.tgz"):
+        if path.name not in files:
+            path.unlink()
+
+    fd, tmp = tempfile.mkstemp(dir=str(chart_dir), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        yaml.safe_dump({"chart": sha256(content), "dependencies": dependencies}, f)
+    os.replace(tmp, str(chart_dir / LOCK))
+    return False
+
+
+def helm_args(cache, repository, chart, version=""):
+    """
+    Returns: the helm arguments for chart version, preferring the cache.
+
+    """
+    if version:
+        try:
+            return [str(cache.fetch(repository, chart, version))]
+        except FETCH_ERRORS as err:
+            print("Not using the chart cache: {}".format(err), file=sys.stderr)
+    args = [chart, "--repo={}".format(repository)]
+    if version:
+        args.append("--version={}".format(version))
+    return args
+
+
+def main(argv):
+    cache = ChartCache()
+    if argv[:1] == ["helm-args"] and len(argv) in [3, 4]:
+        print("\n".join(helm_args(cache, *argv[1:])))
+        return 0
+    try:
+        if argv[:1] == ["fetch"] and len(argv) == 4:
+            print(cache.fetch(*argv[1:]))
+            return 0
+        if argv[:1] == ["vendor"] and len(argv) == 2:
+            if vendor(argv[1], cache):
+                print("Using the locked chart dependencies of {}".format(argv[1]))
+            else:
+                print("Locked the chart dependencies of {}".format(argv[1]))
+            return 0
+        if argv[:1] == ["import"] and len(argv) == 2:
+            print("Imported {} charts".format(cache.import_bundle(argv[1])))
+            return 0
+    except FETCH_ERRORS as err:
+        print(
+            "Cannot {} {}: {}".format(argv[0], " ".join(argv[1:]), err), file=sys.stderr
+        )
+        return 1
+    print(__doc__.strip(), file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Enable addons along with the addons they require, as declared in addons.yaml.
+
+    plan.py [--requirements-of ADDON] [--dry-run] [ADDON ...]
+
+Addons already enabled are found with a single status lookup and skipped. The
+rest are enabled in layers: every addon of a layer only requires addons of the
+layers before it, and the addons of a layer are enabled concurrently.
+With --requirements-of, the addons an addon requires are enabled, but not the
+addon itself, eg from its own enable script.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+import catalogue
+
+ADDONS_YAML = catalogue.ADDONS_YAML
+MICROK8S_ENABLE = os.path.expandvars("$SNAP/microk8s-enable.wrapper")
+MICROK8S_STATUS = os.path.expandvars("$SNAP/microk8s-status.wrapper")
+REPOSITORY = "core"
+
+
+class PlanError(Exception):
+    pass
+
+
+def load_catalogue(addons_yaml=ADDONS_YAML):
+    """
+    Returns: {name: addons.yaml entry} of the addons of this repository.
+
+    """
+    return catalogue.load(addons_yaml).by_name
+
+
+def qualify(addon):
+    """
+    Returns: addon as repository/name, eg dns -> core/dns
+
+    """
+    return addon if "/" in addon else "{}/{}".format(REPOSITORY, addon)
+
+
+def requirements(addon, catalogue):
+    """
+    Returns: the addons addon requires, qualified. Addons of other repositories
+    are not in the catalogue and have no known requirements.
+
+    """
+    repository, _, name = qualify(addon).partition("/")
+    if repository != REPOSITORY or name not in catalogue:
+        return []
+    return [qualify(r) for r in catalogue[name].get("requires", [])]
+
+
+def conflicts(addon, catalogue):
+    repository, _, name = qualify(addon).partition("/")
+    if repository != REPOSITORY or name not in catalogue:
+        return []
+    return [qualify(c) for c in catalogue[name].get("conflicts", [])]
+
+
+def plan(targets, catalogue, enabled=()):
+    """
+    Resolve the addons to enable for targets.
+
+    Returns: a list of layers, each a sorted list of qualified addons that only
+    require addons of the layers before it or addons already enabled
+
+    """
+    enabled = {qualify(addon) for addon in enabled}
+    depth = {}
+
+    def visit(addon, path):
+        if addon in path:
+            raise PlanError(
+                "Circular requirement: {}".format(" -> ".join(path + [addon]))
+            )
+        if addon in enabled:
+            return -1
+        if addon not in depth:
+            depth[addon] = 1 + max(
+                [visit(r, path + [addon]) for r in requirements(addon, catalogue)],
+                default=-1,
+            )
+        return depth[addon]
+
+    for target in targets:
+        visit(qualify(target), [])
+
+    for addon in depth:
+        for other in conflicts(addon, catalogue):
+            if other in enabled or other in depth:
+                raise PlanError("{} conflicts with {}".format(addon, other))
+    for addon in enabled:
+        for other in conflicts(addon, catalogue):
+            if other in depth:
+                raise PlanError("{} conflicts with {}".format(other, addon))
+
+    layers = [[] for _ in range(max(depth.values(), default=-1) + 1)]
+    for addon, level in depth.items():
+        layers[level].append(addon)
+    return [sorted(layer) for layer in layers]
+
+
+def enabled_addons():
+    """
+    Returns: the qualified names of the enabled addons, out of one status lookup.
+
+    """
+    output = subprocess.check_output([MICROK8S_STATUS, "--format", "yaml"])
+    status = yaml.safe_load(output) or {}
+    return {
+        "{}/{}".format(addon.get("repository", REPOSITORY), addon["name"])
+        for addon in status.get("addons") or []
+        if addon.get("status") == "enabled"
+    }
+
+
+def enable(addon):
+    print("Enabling {}".format(addon))
+    result = subprocess.run(
+        [MICROK8S_ENABLE, addon],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    return addon, result.returncode, result.stdout
+
+
+def enable_layers(layers):
+    """
+    Enable the addons of each layer concurrently, a layer at a time, printing
+    the output of each addon once it is done.
+    """
+    for layer in layers:
+        failed = []
+        with ThreadPoolExecutor(max_workers=len(layer)) as executor:
+            for addon, returncode, output in executor.map(enable, layer):
+                print(output, end="")
+                if returncode != 0:
+                    failed.append(addon)
+        if failed:
+            raise PlanError("Failed to enable {}".format(", ".join(failed)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("addons", nargs="*")
+    parser.add_argument("--requirements-of")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    catalogue = load_catalogue()
+    targets = list(args.addons)
+    if args.requirements_of:
+        targets += requirements(args.requirements_of, catalogue)
+    try:
+        layers = plan(targets, catalogue, enabled_addons())
+        if args.dry_run:
+            for i, layer in enumerate(layers):
+                print("{}: {}".format(i, " ".join(layer)))
+            return 0
+        enable_layers(layers)
+    except (subprocess.CalledProcessError, PlanError) as err:
+        print("Cannot enable {}: {}".format(" ".join(targets), err), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Render an addon manifest to stdout, replacing its $PLACEHOLDERS in one pass.
+
+    render.py [--allow-unset] [--digest] <manifest> '$KEY=value' ...
+
+Placeholders are $ followed by upper case letters, digits and underscores, eg
+$ARCH or $SNAP_COMMON. Rendering fails if the manifest has a placeholder with
+no value, unless --allow-unset is given, eg to delete the objects of a manifest
+where only their names matter. With --digest only the sha256 of the rendered
+manifest is printed, to tell whether a manifest changed since it was applied.
+"""
+
+import argparse
+import hashlib
+import re
+import sys
+
+PLACEHOLDER = re.compile(r"(\$[A-Z][A-Z0-9_]*)")
+
+
+class RenderError(Exception):
+    pass
+
+
+def parse(content):
+    """
+    Split a template into its literal text and placeholders.
+
+    Returns: a list alternating literal text and placeholder names, starting
+    and ending with literal text
+
+    """
+    return PLACEHOLDER.split(content)
+
+
+def render(content, values, allow_unset=False):
+    """
+    Returns: content with every placeholder replaced by its value in values.
+    Placeholders with no value are kept as they are if allow_unset is set,
+    otherwise they raise a RenderError.
+
+    """
+    parts = parse(content)
+    missing = sorted({p for p in parts[1::2] if p not in values})
+    if missing and not allow_unset:
+        raise RenderError("No value for {}".format(", ".join(missing)))
+    return "".join(
+        values.get(part, part) if i % 2 else part for i, part in enumerate(parts)
+    )
+
+
+def parse_values(args):
+    """
+    Returns: {"$KEY": value} out of a list of '$KEY=value' arguments.
+
+    """
+    values = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or not PLACEHOLDER.fullmatch(key):
+            raise RenderError(
+                "Invalid substitution {!r}, expected $KEY=value".format(arg)
+            )
+        values[key] = value
+    return values
+
+
+def digest(rendered):
+    return hashlib.sha256(rendered.encode("utf8")).hexdigest()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("manifest")
+    parser.add_argument("values", nargs="*", metavar="'$KEY=value'")
+    parser.add_argument("--allow-unset", action="store_true")
+    parser.add_argument("--digest", action="store_true")
+    # Flags may come after the manifest, eg render.py <manifest> --digest
+    args = parser.parse_intermixed_args(argv)
+    try:
+        values = parse_values(args.values)
+        with open(args.manifest) as f:
+            rendered = render(f.read(), values, args.allow_unset)
+        if args.digest:
+            print(digest(rendered))
+        else:
+            sys.stdout.write(rendered)
+    except (OSError, RenderError) as err:
+        print("Cannot render {}: {}".format(args.manifest, err), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,19 @@
 use_addon_manifest() {
     # Perform an action (apply or delete) on a manifest.
-    # Optionally replace strings in the manifest
+    # Optionally replace $PLACEHOLDERS in the manifest, all in one pass by render.py
     #
     # Parameters:
     # $1 the name of the manifest. Should be in the addons directory and should not
     #    include the trailing .yaml eg ingress, dns
     # $2 the action to be performed on the manifest, eg apply, delete
-    # $3 (optional) an associative array with keys the string to be replaced and value what to
-    #    replace with. The string $ARCH is always injected to this array.
+    # $3 (optional) an associative array with keys the placeholder to be replaced, eg $DNSIP,
+    #    and value what to replace with. $ARCH is always injected to this array. Applying a
+    #    manifest with a placeholder that has no value fails.
+    #
+    # The digest of an applied manifest is kept under $SNAP_DATA/var/lock/manifests. Applying
+    # it again with the same values is skipped if kubectl diff finds its live objects still
+    # match it, and use_manifest_unchanged is set to true so that callers can skip restarting
+    # services. Any drift, or a diff that fails, applies it again.
     #
     local manifest="$1.yaml"; shift
     local action="$1"; shift
@@ -17,17 +23,69 @@ use_addon_manifest() {
     else
         declare -A items
     fi
-    local tmp_manifest="${SNAP_USER_DATA}/tmp/temp-$$.yaml"
     items[\$ARCH]=$(arch)
 
-    mkdir -p ${SNAP_USER_DATA}/tmp
-    SCRIPT_DIR=$(cd $(dirname "${BASH_SOURCE[0]}") && pwd)
-    cp "${SCRIPT_DIR}/../${manifest}" "${tmp_manifest}"
+    # Objects are deleted by name, so placeholders may be left unset
+    local render_opts=()
+    if [ "$action" = "delete" ]
+    then
+        render_opts+=(--allow-unset)
+    fi
+    local values=()
     for i in "${!items[@]}"
     do
-        "$SNAP/bin/sed" -i 's@'$i'@'"${items[$i]}"'@g' "${tmp_manifest}"
+        values+=("$i=${items[$i]}")
     done
-    "$SNAP/kubectl" "--kubeconfig=$SNAP_DATA/credentials/client.config" "$action" -f "${tmp_manifest}"
-    use_manifest_result="$?"
-    rm "${tmp_manifest}"
+
+    SCRIPT_DIR=$(cd $(dirname "${BASH_SOURCE[0]}") && pwd)
+    local render=("$SNAP/usr/bin/python3" "${SCRIPT_DIR}/render.py" "${render_opts[@]}" "${SCRIPT_DIR}/../${manifest}")
+    local kubectl=("$SNAP/kubectl" "--kubeconfig=$SNAP_DATA/credentials/client.config")
+    local digest_name="${manifest%.yaml}"
+    local digest_file="${SNAP_DATA}/var/lock/manifests/${digest_name//\//-}.sha256"
+    local digest=""
+    use_manifest_unchanged=false
+
+    if [ "$action" = "apply" ]
+    then
+        digest="$("${render[@]}" --digest "${values[@]}" 2> /dev/null)" || true
+        if [ -n "$digest" ] && [ -f "$digest_file" ] && [ "$(cat "$digest_file")" = "$digest" ] &&
+            "${render[@]}" "${values[@]}" | "${kubectl[@]}" diff -f - &> /dev/null
+        then
+            echo "Manifest ${manifest} is already applied"
+            use_manifest_unchanged=true
+            use_manifest_result=0
+            return 0
+        fi
+    fi
+
+    "${render[@]}" "${values[@]}" | "${kubectl[@]}" "$action" -f -
+    local status=("${PIPESTATUS[@]}")
+    use_manifest_result="${status[1]}"
+    if [ "${status[0]}" != "0" ]
+    then
+        use_manifest_result="${status[0]}"
+    fi
+
+    if [ "$action" = "apply" ] && [ "$use_manifest_result" = "0" ] && [ -n "$digest" ]
+    then
+        mkdir -p "$(dirname "$digest_file")"
+        echo "$digest" > "$digest_file"
+    elif [ "$action" = "delete" ]
+    then
+        rm -f "$digest_file"
+    fi
+}
+
+helm_chart_args() {
+    # Print the helm arguments of a chart, one per line: the path of its archive in the
+    # local chart cache, fetched into it by charts.py if needed, or the chart with --repo
+    # and --version when it cannot be cached. Use unquoted, eg
+    #   $HELM upgrade --install name $(helm_chart_args "$REPO" chart "$VERSION") ...
+    #
+    # Parameters:
+    # $1 the chart repository URL
+    # $2 the chart name
+    # $3 (optional) the chart version
+    local script_dir=$(cd $(dirname "${BASH_SOURCE[0]}") && pwd)
+    "$SNAP/usr/bin/python3" "${script_dir}/charts.py" helm-args "$@"
 }
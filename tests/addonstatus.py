@@ -0,0 +1,130 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from common import ADDONS_YAML, SNAP_PATHS, catalogue
+from kubeclient import ApiError, get_client
+from utils import kubectl_get
+
+# Searched for a check_status that names no resource type, as in the rows of
+# `kubectl get all`
+WORKLOAD_RESOURCES = ["pod", "deployment.apps", "daemonset.apps", "statefulset.apps"]
+
+
+def expand_path(path, snap_paths=SNAP_PATHS):
+    for var, value in snap_paths.items():
+        path = path.replace("${%s}" % var, value)
+    return path
+
+
+def parse_check(check_status):
+    """
+    Returns: ("file", None, path) for checks on files, ("object", resource,
+    name prefix) for checks on a resource type, eg pod/coredns, and ("name",
+    None, substring) for checks on any workload name.
+
+    """
+    if check_status.startswith("$") or check_status.startswith("/"):
+        return "file", None, check_status
+    if "/" in check_status:
+        resource, _, prefix = check_status.partition("/")
+        return "object", resource, prefix
+    return "name", None, check_status
+
+
+def rbac_enabled(snap_paths=SNAP_PATHS):
+    """
+    The cluster-admin role of the rbac check_status exists with or without the
+    addon, so the authorization mode of the apiserver is checked instead.
+    """
+    try:
+        with open(expand_path("${SNAP_DATA}/args/kube-apiserver", snap_paths)) as f:
+            args = f.read()
+    except OSError:
+        return False
+    for line in args.splitlines():
+        if line.startswith("--authorization-mode"):
+            return "RBAC" in line.partition("=")[2].split(",")
+    return False
+
+
+class StatusEvaluator(object):
+    """
+    Evaluates the check_status of all the addons at once, by default those of
+    addons.yaml supported on the current arch. The checks are grouped by
+    resource type and each type is listed once, all types concurrently.
+    Resource types the apiserver does not serve are not looked up again.
+    """
+
+    def __init__(self, addons=None, client=None, snap_paths=SNAP_PATHS):
+        if addons is None:
+            addons = catalogue.load(ADDONS_YAML).for_arch()
+        self.addons = addons
+        self.client = client
+        self.snap_paths = snap_paths
+        self._missing = set()
+
+    def _list(self, client, resource):
+        """
+        Returns: the names of all the objects of resource.
+
+        """
+        if resource in self._missing:
+            return []
+        try:
+            data = client.get(client.path(resource))
+        except ApiError as err:
+            if err.status == 404:
+                # The resource type is not served, eg its CRD is not installed
+                self._missing.add(resource)
+                return []
+            raise
+        return [item["metadata"]["name"] for item in data["items"]]
+
+    def _list_kubectl(self, resources):
+        """
+        Returns: {resource: names} of all resources out of one kubectl get.
+
+        """
+        data = kubectl_get("{} -A".format(",".join(resources)))
+        names = {resource: [] for resource in resources}
+        for item in data["items"]:
+            for resource in resources:
+                if resource.partition(".")[0] == item["kind"].lower():
+                    names[resource].append(item["metadata"]["name"])
+        return names
+
+    def evaluate(self):
+        """
+        Returns: {addon: "enabled" or "disabled"} for all addons
+
+        """
+        checks = {a["name"]: parse_check(a["check_status"]) for a in self.addons}
+        resources = {resource for kind, resource, _ in checks.values() if resource}
+        if any(kind == "name" for kind, _, _ in checks.values()):
+            resources.update(WORKLOAD_RESOURCES)
+        resources = sorted(resources)
+
+        client = self.client or get_client()
+        if not resources:
+            names = {}
+        elif client:
+            with ThreadPoolExecutor(max_workers=min(len(resources), 10)) as executor:
+                lists = executor.map(lambda r: self._list(client, r), resources)
+                names = dict(zip(resources, lists))
+        else:
+            names = self._list_kubectl(resources)
+
+        status = {}
+        for addon, (kind, resource, target) in checks.items():
+            if addon == "rbac":
+                enabled = rbac_enabled(self.snap_paths)
+            elif kind == "file":
+                enabled = os.path.exists(expand_path(target, self.snap_paths))
+            elif kind == "object":
+                enabled = any(name.startswith(target) for name in names[resource])
+            else:
+                enabled = any(
+                    target in name for r in WORKLOAD_RESOURCES for name in names[r]
+                )
+            status[addon] = "enabled" if enabled else "disabled"
+        return status
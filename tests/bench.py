@@ -0,0 +1,282 @@
+import json
+import os
+import re
+import statistics
+import time
+
+from common import ADDONS_YAML, SNAP_PATHS, catalogue, percentile
+from kubeclient import get_client
+from utils import (
+    get_arch,
+    kubectl_get,
+    microk8s_disable,
+    microk8s_enable,
+    wait_for_namespace_termination,
+    wait_for_pods,
+)
+
+# Addons that are on by default, aliases, deprecated, or that need hardware or
+# a dedicated node, and are left out of the time-to-ready benchmark.
+SKIP_ADDONS = {
+    "dns",
+    "helm",
+    "helm3",
+    "ha-cluster",
+    "storage",
+    "gpu",
+    "nvidia",
+    "prometheus",
+    "minio",
+    "community",
+    "cis-hardening",
+    "kube-ovn",
+    "mayastor",
+    # Its check_status, the cluster-admin role, exists with or without it
+    "rbac",
+}
+
+# Arguments for addons that cannot be enabled without any
+ENABLE_ARGS = {"metallb": "metallb 10.64.140.43-10.64.140.49"}
+
+# Arguments for addons whose disable would otherwise prompt
+DISABLE_ARGS = {"hostpath-storage": "hostpath-storage:destroy-storage"}
+
+
+def summarise_runs(samples):
+    """
+    Returns: {metric: {"median", "p95", "runs"}} for a {metric: [seconds]} dict.
+
+    """
+    return {
+        metric: {
+            "median": round(statistics.median(values), 3),
+            "p95": round(percentile(values, 95), 3),
+            "runs": len(values),
+        }
+        for metric, values in samples.items()
+        if values
+    }
+
+
+def supported_addons(arch=None, addons_yaml=ADDONS_YAML):
+    """
+    Returns: the addons.yaml entries supported on arch, the current one by default.
+
+    """
+    return catalogue.load(addons_yaml).for_arch(arch or get_arch())
+
+
+def check_status_target(check_status):
+    """
+    Returns: the namespace of the object satisfying an addons.yaml check_status,
+    "" for files and cluster scoped objects, or None if it does not exist yet.
+    Kubernetes checks match on the object name prefix, as `microk8s status` does.
+
+    """
+    if check_status.startswith("$"):
+        path = check_status
+        for var, value in SNAP_PATHS.items():
+            path = path.replace("${%s}" % var, value)
+        return "" if os.path.exists(path) else None
+
+    resource, _, prefix = check_status.partition("/")
+    client = get_client()
+    if client:
+        data = client.get_resource(resource)
+    else:
+        data = kubectl_get("{} -A".format(resource))
+    for item in data["items"]:
+        if item["metadata"]["name"].startswith(prefix):
+            return item["metadata"].get("namespace", "")
+    return None
+
+
+def namespaces():
+    return {ns["metadata"]["name"] for ns in kubectl_get("ns")["items"]}
+
+
+def wait_until(predicate, timeout_insec, interval=0.5):
+    """
+    Poll predicate until it returns something other than None.
+    """
+    deadline = time.monotonic() + timeout_insec
+    while True:
+        result = predicate()
+        if result is not None:
+            return result
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not met after {}s".format(timeout_insec))
+        time.sleep(interval)
+
+
+def time_addon(addon, timeout_insec=900):
+    """
+    Enable and disable an addon once, timing each phase.
+
+    Returns: {metric: seconds} with the enable command, the time until the
+    check_status object exists, until its pods are ready, the disable command
+    and the teardown of the objects and namespaces it created.
+
+    """
+    name = addon["name"]
+    check = addon["check_status"]
+    before = namespaces()
+    timings = {}
+
+    start = time.monotonic()
+    microk8s_enable(ENABLE_ARGS.get(name, name), timeout_insec=timeout_insec)
+    timings["enable"] = time.monotonic() - start
+    namespace = wait_until(lambda: check_status_target(check), timeout_insec)
+    timings["exists"] = time.monotonic() - start
+    created = sorted(namespaces() - before)
+    wait_on = sorted(set(created) | ({namespace} if namespace else set()))
+    if wait_on:
+        wait_for_pods([""], wait_on, condition="ready", timeout_insec=timeout_insec)
+    timings["ready"] = time.monotonic() - start
+
+    start = time.monotonic()
+    microk8s_disable(DISABLE_ARGS.get(name, name))
+    timings["disable"] = time.monotonic() - start
+    wait_until(
+        lambda: True if check_status_target(check) is None else None, timeout_insec
+    )
+    for ns in created:
+        wait_for_namespace_termination(ns, timeout_insec=timeout_insec)
+    timings["teardown"] = time.monotonic() - start
+    return timings
+
+
+def run_benchmark(addons, runs=3):
+    """
+    Time every addon runs times.
+
+    Returns: {addon: {metric: {"median", "p95", "runs"}}}
+
+    """
+    results = {}
+    for addon in addons:
+        samples = {}
+        for run in range(runs):
+            print("Benchmarking {} (run {}/{})".format(addon["name"], run + 1, runs))
+            for metric, seconds in time_addon(addon).items():
+                samples.setdefault(metric, []).append(seconds)
+        results[addon["name"]] = summarise_runs(samples)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Compare results against a baseline of the same shape.
+
+    Returns: a list of (addon, metric, baseline median, median) for every
+    median that is more than tolerance slower than the baseline.
+
+    """
+    regressions = []
+    for addon, metrics in sorted(results.items()):
+        for metric, stats in sorted(metrics.items()):
+            base = baseline.get(addon, {}).get(metric)
+            if base and stats["median"] > base["median"] * (1 + tolerance):
+                regressions.append((addon, metric, base["median"], stats["median"]))
+    return regressions
+
+
+def load_results(path):
+    """
+    Returns: the results stored in path for the current arch, or {} if there are none.
+
+    """
+    try:
+        with open(path) as f:
+            return json.load(f).get(get_arch(), {})
+    except FileNotFoundError:
+        return {}
+
+
+def save_results(path, results):
+    """
+    Store results for the current arch in path, keeping other arches' results.
+    """
+    try:
+        with open(path) as f:
+            stored = json.load(f)
+    except FileNotFoundError:
+        stored = {}
+    stored[get_arch()] = results
+    with open(path, "w") as f:
+        json.dump(stored, f, indent=2, sort_keys=True)
+
+
+def format_results(results, baseline=None):
+    lines = [
+        "{:<20} {:<9} {:>9} {:>9} {:>9}".format(
+            "addon", "phase", "median", "p95", "baseline"
+        )
+    ]
+    for addon, metrics in sorted(results.items()):
+        for metric, stats in metrics.items():
+            base = (baseline or {}).get(addon, {}).get(metric)
+            lines.append(
+                "{:<20} {:<9} {:>8.1f}s {:>8.1f}s {:>9}".format(
+                    addon,
+                    metric,
+                    stats["median"],
+                    stats["p95"],
+                    "{:.1f}s".format(base["median"]) if base else "-",
+                )
+            )
+    return "\n".join(lines)
+
+
+def script_variable(script, name):
+    """
+    Returns: the default value a shell script assigns to name, eg CHART_VERSION
+    in addons/ingress/enable, or None if it does not set one.
+
+    """
+    with open(script) as f:
+        match = re.search(r'^{}="?([^"\s]*)"?'.format(name), f.read(), re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def version_key(version):
+    return tuple(int(n) for n in re.findall(r"\d+", version))
+
+
+def record_versioned_result(path, version, result):
+    """
+    Store result under version in path, for the current arch.
+
+    Returns: the result stored for the closest earlier version, or None if
+    there is none.
+
+    """
+    stored = load_results(path)
+    earlier = [v for v in stored if version_key(v) < version_key(version)]
+    stored[version] = result
+    save_results(path, stored)
+    return stored[max(earlier, key=version_key)] if earlier else None
+
+
+def compare_load(result, previous, tolerance=0.2):
+    """
+    Compare the as_dict() of two load results.
+
+    Returns: a list of (metric, previous, current) for a throughput more than
+    tolerance lower, tail latencies more than tolerance higher, or a higher
+    error rate.
+
+    """
+    regressions = []
+    if previous.get("rps") and (result["rps"] or 0) < previous["rps"] * (1 - tolerance):
+        regressions.append(("rps", previous["rps"], result["rps"]))
+    for metric in ["p99", "p999"]:
+        if previous.get(metric) and (result[metric] or 0) > previous[metric] * (
+            1 + tolerance
+        ):
+            regressions.append((metric, previous[metric], result[metric]))
+    if result["error_rate"] > previous.get("error_rate", 0):
+        regressions.append(
+            ("error_rate", previous.get("error_rate", 0), result["error_rate"])
+        )
+    return regressions
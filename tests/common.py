@@ -0,0 +1,48 @@
+import importlib.util
+import math
+import sys
+from pathlib import Path
+
+ADDONS_YAML = Path(__file__).absolute().parent.parent / "addons.yaml"
+ADDONS_DIR = ADDONS_YAML.parent / "addons"
+
+SNAP_PATHS = {
+    "SNAP": "/snap/microk8s/current",
+    "SNAP_DATA": "/var/snap/microk8s/current",
+    "SNAP_COMMON": "/var/snap/microk8s/common",
+}
+
+
+def load_addon_module(relative_path):
+    """
+    Returns: the Python module at relative_path under the addons directory,
+    eg common/charts.py
+
+    """
+    path = ADDONS_DIR / relative_path
+    spec = importlib.util.spec_from_file_location(path.stem, str(path))
+    module = importlib.util.module_from_spec(spec)
+    # For its imports of the modules next to it, as when run as a script
+    sys.path.insert(0, str(path.parent))
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(path.parent))
+    return module
+
+
+# The addons of addons.yaml out of their cached index, and their arch names, eg
+# amd64 for x86_64
+catalogue = load_addon_module("common/catalogue.py")
+ARCH_TRANSLATE = catalogue.ARCH_TRANSLATE
+current_arch = catalogue.current_arch
+
+
+def percentile(values, pct):
+    """
+    Returns: the nearest-rank percentile of values.
+
+    """
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(pct / 100.0 * len(ordered))))
+    return ordered[rank - 1]
@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+import results
+import retry
+import timing
+
+_tests = {}
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    timing.start_test(item.nodeid)
+    budget = os.environ.get("TEST_RETRY_BUDGET")
+    retry.set_test_budget(float(budget) if budget else None)
+
+
+def pytest_runtest_teardown(item):
+    retry.set_test_budget(None)
+
+
+def pytest_runtest_logreport(report):
+    if report.when == "call" or report.outcome == "failed":
+        test = _tests.setdefault(report.nodeid, {"duration": 0.0, "passed": 1})
+        test["duration"] += report.duration
+        if report.failed:
+            test["passed"] = 0
+
+
+def pytest_sessionfinish(session):
+    """
+    Append the timings of this session to the results database.
+    """
+    path = results.db_path()
+    if not path or not (_tests or results.pending):
+        return
+    summary = {"test": timing.summarise("test"), "addon": timing.summarise("addon")}
+    try:
+        results.record_session(path, _tests, summary, results.pending)
+    except Exception as err:
+        print("Cannot record the results in {}: {}".format(path, err))
+
+
+def pytest_terminal_summary(terminalreporter):
+    """
+    Summarise where the time went, per test and per addon.
+    """
+    if not timing.spans:
+        return
+    terminalreporter.section("harness timings per test")
+    terminalreporter.write_line(timing.format_summary("test"))
+    terminalreporter.section("harness timings per addon")
+    terminalreporter.write_line(timing.format_summary("addon"))
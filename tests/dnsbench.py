@@ -0,0 +1,165 @@
+import json
+from pathlib import Path
+
+import requests
+
+from kubeclient import ApiError, get_client
+from manifests import apply_manifest
+from utils import (
+    kubectl,
+    kubectl_get,
+    wait_for_namespace_termination,
+    wait_for_pod_state,
+)
+
+DNSLOAD = Path(__file__).absolute().parent / "dnsload.py"
+NAMESPACE = "dns-bench"
+CACHE_METRICS = ["coredns_cache_hits_total", "coredns_cache_misses_total"]
+
+
+def default_names(zone="bench.test", cluster_domain="cluster.local", hosts=10):
+    """
+    Returns: the (kind, name) mix resolved by the benchmark: cluster names,
+    names found through the search path, and names served by the upstream,
+    both fully qualified and through the search path.
+
+    """
+    names = [
+        ("cluster", "kubernetes.default.svc.{}.".format(cluster_domain)),
+        ("search", "kubernetes.default"),
+        ("search", "kube-dns.kube-system"),
+    ]
+    names += [("upstream", "host-{}.{}.".format(i, zone)) for i in range(hosts)]
+    names += [("upstream-search", "host-{}.{}".format(i, zone)) for i in range(hosts)]
+    return names
+
+
+def parse_metrics(text, metrics=CACHE_METRICS):
+    """
+    Returns: {metric: value summed over all label sets} out of a Prometheus
+    text exposition.
+
+    """
+    totals = {metric: 0.0 for metric in metrics}
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        name = line.split("{", 1)[0].split(" ", 1)[0]
+        if name in totals:
+            totals[name] += float(line.rsplit(" ", 1)[1])
+    return totals
+
+
+def coredns_metrics():
+    """
+    Returns: the cache counters of all the CoreDNS pods, read through the
+    apiserver proxy.
+
+    """
+    client = get_client()
+    pods = kubectl_get("po -n kube-system -l k8s-app=kube-dns")["items"]
+    totals = {metric: 0.0 for metric in CACHE_METRICS}
+    for pod in pods:
+        path = "/api/v1/namespaces/kube-system/pods/{}:9153/proxy/metrics".format(
+            pod["metadata"]["name"]
+        )
+        try:
+            if client:
+                text = client.request("GET", path).text
+            else:
+                text = kubectl("get --raw {}".format(path))
+        except (ApiError, requests.RequestException) as err:
+            print("Cannot read the metrics of {}: {}".format(path, err))
+            continue
+        for metric, value in parse_metrics(text).items():
+            totals[metric] += value
+    return totals
+
+
+def cache_hit_ratio(before, after):
+    hits = after["coredns_cache_hits_total"] - before["coredns_cache_hits_total"]
+    misses = after["coredns_cache_misses_total"] - before["coredns_cache_misses_total"]
+    return round(hits / (hits + misses), 3) if hits + misses else None
+
+
+def upstream_address():
+    """
+    Returns: the internal IP of the first node, where pods reach a stand-in
+    upstream nameserver listening on the host.
+
+    """
+    node = kubectl_get("no")["items"][0]
+    for address in node["status"]["addresses"]:
+        if address["type"] == "InternalIP":
+            return address["address"]
+    raise ValueError("Node {} has no InternalIP".format(node["metadata"]["name"]))
+
+
+def run_dns_benchmark(duration=30, concurrency=8, names=None, timeout_insec=600):
+    """
+    Run the resolver load from a pod against the kube-dns service.
+
+    Returns: the dnsload results, with the CoreDNS cache hit ratio over the run
+
+    """
+    names = names or default_names()
+    server = kubectl_get("svc kube-dns -n kube-system")["spec"]["clusterIP"]
+    try:
+        # Applied rather than created, so that a namespace left over by an
+        # aborted run is reused
+        kubectl(
+            "apply -f -",
+            input=kubectl(
+                "create namespace {} --dry-run=client -o yaml".format(NAMESPACE)
+            ),
+        )
+        kubectl(
+            "apply -f -",
+            input=kubectl(
+                "create configmap dnsload -n {} --from-file={} "
+                "--dry-run=client -o yaml".format(NAMESPACE, DNSLOAD)
+            ),
+        )
+        before = coredns_metrics()
+        apply_manifest(
+            "dns-bench.yaml",
+            SERVER=server,
+            DURATION=duration,
+            CONCURRENCY=concurrency,
+            NAMES=",".join("{}:{}".format(kind, name) for kind, name in names),
+        )
+        wait_for_pod_state(
+            "dns-bench", NAMESPACE, "terminated", timeout_insec=timeout_insec
+        )
+        after = coredns_metrics()
+        result = json.loads(kubectl("logs dns-bench -n {}".format(NAMESPACE)))
+    finally:
+        kubectl("delete namespace {} --ignore-not-found".format(NAMESPACE))
+        wait_for_namespace_termination(NAMESPACE)
+    result["cache_hit_ratio"] = cache_hit_ratio(before, after)
+    return result
+
+
+def format_comparison(results):
+    """
+    Format {variant: run_dns_benchmark result} as a table.
+    """
+    kinds = sorted({kind for r in results.values() for kind in r["kinds"]})
+    header = "{:<24} {:>8} {:>8} {:>6}".format("variant", "qps", "res/s", "hit%")
+    header += "".join(" {:>22}".format(kind + " p50/p99") for kind in kinds)
+    lines = [header]
+    for variant, result in results.items():
+        ratio = result["cache_hit_ratio"]
+        line = "{:<24} {:>8} {:>8} {:>6}".format(
+            variant,
+            result["qps"],
+            result["resolutions_per_s"],
+            "-" if ratio is None else round(ratio * 100, 1),
+        )
+        for kind in kinds:
+            stats = result["kinds"].get(kind, {})
+            line += " {:>22}".format(
+                "{}/{}ms".format(stats.get("p50_ms", "-"), stats.get("p99_ms", "-"))
+            )
+        lines.append(line)
+    return "\n".join(lines)
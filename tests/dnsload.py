@@ -0,0 +1,235 @@
+"""
+Resolver load generator for the dns addon benchmark. It only needs the Python
+standard library, as it is shipped to the benchmark pod in a ConfigMap.
+
+Names are given as kind:name, eg upstream:host-1.bench.test. Names that are not
+fully qualified are expanded with the search path of /etc/resolv.conf, the way
+the libc resolver does, and the time of the whole expansion is measured.
+"""
+
+import argparse
+import json
+import math
+import random
+import socket
+import struct
+import threading
+import time
+
+NOERROR = 0
+NXDOMAIN = 3
+
+
+def build_query(qid, name, qtype=1):
+    """
+    Returns: a DNS query packet for name, of type A by default.
+
+    """
+    header = struct.pack(">HHHHHH", qid, 0x0100, 1, 0, 0, 0)
+    labels = b"".join(
+        bytes([len(label)]) + label.encode("ascii")
+        for label in name.rstrip(".").split(".")
+        if label
+    )
+    return header + labels + b"\x00" + struct.pack(">HH", qtype, 1)
+
+
+def parse_header(packet):
+    """
+    Returns: (id, rcode, answer count) of a DNS packet.
+
+    """
+    qid, flags, _, ancount, _, _ = struct.unpack(">HHHHHH", packet[:12])
+    return qid, flags & 0xF, ancount
+
+
+def read_search(resolv_conf="/etc/resolv.conf"):
+    """
+    Returns: (search domains, ndots) out of a resolv.conf.
+
+    """
+    search, ndots = [], 1
+    try:
+        with open(resolv_conf) as f:
+            for line in f:
+                parts = line.split()
+                if parts and parts[0] == "search":
+                    search = parts[1:]
+                elif parts and parts[0] == "options":
+                    for option in parts[1:]:
+                        if option.startswith("ndots:"):
+                            ndots = int(option.split(":")[1])
+    except OSError:
+        pass
+    return search, ndots
+
+
+def candidates(name, search, ndots):
+    """
+    Returns: the names a resolver queries for name, in order.
+
+    """
+    if name.endswith("."):
+        return [name]
+    expanded = ["{}.{}".format(name, domain) for domain in search]
+    if name.count(".") >= ndots:
+        return [name] + expanded
+    return expanded + [name]
+
+
+class Resolver(object):
+    """
+    A stub resolver on its own UDP socket, for use by a single thread.
+    """
+
+    def __init__(self, server, port=53, timeout=2.0, search=(), ndots=1):
+        self.server = (server, port)
+        self.search = list(search)
+        self.ndots = ndots
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(timeout)
+
+    def query(self, name):
+        """
+        Returns: the rcode of the answer to an A query for name.
+
+        """
+        qid = random.getrandbits(16)
+        self.sock.sendto(build_query(qid, name), self.server)
+        while True:
+            packet, _ = self.sock.recvfrom(4096)
+            answer_id, rcode, _ = parse_header(packet)
+            if answer_id == qid:
+                return rcode
+
+    def resolve(self, name):
+        """
+        Resolve name through the search path.
+
+        Returns: (rcode, number of queries sent)
+
+        """
+        queries = 0
+        for candidate in candidates(name, self.search, self.ndots):
+            queries += 1
+            rcode = self.query(candidate)
+            if rcode != NXDOMAIN:
+                return rcode, queries
+        return NXDOMAIN, queries
+
+    def close(self):
+        self.sock.close()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(pct / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def run_load(
+    server, names, duration=10, concurrency=8, port=53, timeout=2.0, search=None
+):
+    """
+    Resolve names round robin from concurrency threads for duration seconds.
+
+    Args:
+        names: list of (kind, name)
+        search: (search domains, ndots), read from /etc/resolv.conf by default
+
+    Returns: {"qps", "resolutions_per_s", "queries", "kinds": {kind: stats}}
+    where stats holds the resolutions, errors, timeouts and the latency
+    percentiles in milliseconds
+
+    """
+    search, ndots = search or read_search()
+    lock = threading.Lock()
+    results = {kind: {"latencies": [], "errors": 0, "timeouts": 0} for kind, _ in names}
+    totals = {"queries": 0}
+    deadline = time.perf_counter() + duration
+
+    def worker(offset):
+        resolver = Resolver(server, port, timeout, search, ndots)
+        local = {
+            kind: {"latencies": [], "errors": 0, "timeouts": 0} for kind, _ in names
+        }
+        queries = 0
+        i = offset
+        try:
+            while time.perf_counter() < deadline:
+                kind, name = names[i % len(names)]
+                i += 1
+                start = time.perf_counter()
+                try:
+                    rcode, sent = resolver.resolve(name)
+                except socket.timeout:
+                    local[kind]["timeouts"] += 1
+                    continue
+                queries += sent
+                if rcode == NOERROR:
+                    local[kind]["latencies"].append(time.perf_counter() - start)
+                else:
+                    local[kind]["errors"] += 1
+        finally:
+            resolver.close()
+        with lock:
+            totals["queries"] += queries
+            for kind, stats in local.items():
+                results[kind]["latencies"].extend(stats["latencies"])
+                results[kind]["errors"] += stats["errors"]
+                results[kind]["timeouts"] += stats["timeouts"]
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    kinds = {}
+    for kind, stats in results.items():
+        latencies = stats["latencies"]
+        kinds[kind] = {
+            "resolutions": len(latencies),
+            "errors": stats["errors"],
+            "timeouts": stats["timeouts"],
+        }
+        if latencies:
+            for pct in [50, 90, 99]:
+                kinds[kind]["p{}_ms".format(pct)] = round(
+                    percentile(latencies, pct) * 1000, 2
+                )
+    resolved = sum(stats["resolutions"] for stats in kinds.values())
+    return {
+        "qps": round(totals["queries"] / elapsed, 1),
+        "resolutions_per_s": round(resolved / elapsed, 1),
+        "queries": totals["queries"],
+        "kinds": kinds,
+    }
+
+
+def parse_names(spec):
+    """
+    Returns: [(kind, name)] out of a comma separated list of kind:name.
+
+    """
+    return [tuple(item.split(":", 1)) for item in spec.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--server", required=True)
+    parser.add_argument("--port", type=int, default=53)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--names", required=True, help="kind:name,...")
+    args = parser.parse_args()
+    result = run_load(
+        args.server, parse_names(args.names), args.duration, args.concurrency, args.port
+    )
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
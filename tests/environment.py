@@ -0,0 +1,207 @@
+import json
+import os
+import platform
+import tempfile
+import threading
+from subprocess import CalledProcessError, check_output, run, PIPE, DEVNULL
+
+import requests
+import yaml
+
+from common import ARCH_TRANSLATE
+from kubeclient import get_client
+
+
+BOOT_ID = "/proc/sys/kernel/random/boot_id"
+SNAP_YAML = "/snap/microk8s/current/meta/snap.yaml"
+CACHE_DIR = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+CACHE_FILE = os.path.join(CACHE_DIR, "microk8s-tests", "environment.json")
+
+
+class Environment(object):
+    """
+    What the tests need to know about the machine and cluster they run on,
+    probed once per session.
+
+    Attributes:
+        machine: platform.machine(), eg x86_64
+        arch: the matching microk8s arch, eg amd64
+        container: the type of container we run in, eg lxc or docker, or None
+        nodes: names of the cluster nodes
+        gpu: True if an NVIDIA device is present
+        confinement: confinement of the microk8s snap, eg strict or classic
+        boot_id: the kernel boot id at the time of the probe
+    """
+
+    FIELDS = ["machine", "arch", "container", "nodes", "gpu", "confinement", "boot_id"]
+
+    def __init__(self, **fields):
+        for field in self.FIELDS:
+            setattr(self, field, fields.get(field))
+
+    @property
+    def is_container(self):
+        return self.container is not None
+
+    @property
+    def is_lxc_container(self):
+        return self.container == "lxc"
+
+    @property
+    def is_multinode(self):
+        return len(self.nodes or []) > 1
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+def boot_id():
+    try:
+        with open(BOOT_ID) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def probe_nodes():
+    """
+    Returns: the names of the cluster nodes, or [] if the cluster cannot be queried.
+
+    """
+    client = get_client()
+    try:
+        if client:
+            return [n["metadata"]["name"] for n in client.get_resource("no")["items"]]
+        cmd = ["/snap/bin/microk8s.kubectl", "get", "no", "-o", "name"]
+        names = check_output(cmd).decode("utf-8").split()
+        return [name.split("/", 1)[-1] for name in names]
+    except (CalledProcessError, OSError, requests.RequestException):
+        print("Failed to query the cluster nodes.")
+        return []
+
+
+def _output(cmd):
+    """
+    Returns: the return code and output of cmd, (None, "") if it cannot be run.
+
+    """
+    try:
+        p = run(cmd.split(), stdout=PIPE, stderr=DEVNULL)
+    except OSError:
+        return None, ""
+    return p.returncode, p.stdout.decode("utf-8", "replace")
+
+
+def probe_container():
+    """
+    Returns: the type of container we are running in, or None.
+
+    """
+    if os.path.isdir("/run/systemd/system"):
+        code, container = _output("sudo systemd-detect-virt --container")
+        if code == 0 and container.strip() != "none":
+            print("Tests are running in {}".format(container.strip()))
+            return container.strip()
+        print("systemd-detect-virt did not detect a container")
+
+    if os.path.exists("/run/container_type"):
+        with open("/run/container_type") as f:
+            return f.read().strip() or "unknown"
+
+    _, found = _output("sudo grep -ohE (lxc|hypervisor) /proc/1/environ /proc/cpuinfo")
+    found = found.split()
+    if found:
+        print("Tests are running in an undetectable container")
+        return "lxc" if "lxc" in found else found[0]
+    print("no indication of a container in /proc")
+    return None
+
+
+def probe_gpu():
+    _, devices = _output("lspci")
+    return "NVIDIA" in devices.upper()
+
+
+def probe_confinement():
+    try:
+        with open(SNAP_YAML) as f:
+            return yaml.safe_load(f).get("confinement")
+    except (OSError, yaml.YAMLError):
+        return None
+
+
+def probe():
+    """
+    Returns: a freshly probed Environment.
+
+    """
+    machine = platform.machine()
+    return Environment(
+        machine=machine,
+        arch=ARCH_TRANSLATE.get(machine, machine),
+        container=probe_container(),
+        nodes=probe_nodes(),
+        gpu=probe_gpu(),
+        confinement=probe_confinement(),
+        boot_id=boot_id(),
+    )
+
+
+def load_cached(path, nodes):
+    """
+    Returns: the Environment cached in path if it was probed since the last
+    boot with the same number of nodes, else None.
+
+    """
+    try:
+        with open(path) as f:
+            fields = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if fields.get("boot_id") != boot_id() or len(fields.get("nodes") or []) != len(
+        nodes
+    ):
+        return None
+    fields["nodes"] = nodes
+    return Environment(**fields)
+
+
+def save_cached(path, environment):
+    """
+    Cache environment in path. It is written to a new file renamed over path,
+    so that a symlink planted at path is replaced rather than followed.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(environment.as_dict(), f)
+        os.replace(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
+_environment = None
+_environment_lock = threading.Lock()
+
+
+def get_environment():
+    """
+    Return the session wide Environment. It is read from the cache file in
+    $TEST_ENVIRONMENT_CACHE, or the per-user cache directory by default, when
+    still valid, and probed and cached otherwise.
+    """
+    global _environment
+    with _environment_lock:
+        if _environment is None:
+            path = os.environ.get("TEST_ENVIRONMENT_CACHE", CACHE_FILE)
+            _environment = load_cached(path, probe_nodes())
+            if _environment is None:
+                _environment = probe()
+                try:
+                    save_cached(path, _environment)
+                except OSError as err:
+                    print("Cannot cache the environment in {}: {}".format(path, err))
+        return _environment
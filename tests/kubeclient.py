@@ -0,0 +1,357 @@
+import atexit
+import base64
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+from subprocess import CalledProcessError
+
+import requests
+import yaml
+from requests.adapters import HTTPAdapter
+
+
+KUBECONFIG = "/var/snap/microk8s/current/credentials/client.config"
+
+
+class ApiError(CalledProcessError):
+    """
+    The apiserver answered with an error status.
+
+    This is a CalledProcessError so that callers written against the forking
+    kubectl helpers keep catching failures the way they always did.
+    """
+
+    def __init__(self, status, reason, message, url):
+        super().__init__(1, url, output=message.encode("utf8"))
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+    def __str__(self):
+        return "{} {}: {}".format(self.status, self.reason, self.message)
+
+
+class KubeClient(object):
+    """
+    A minimal Kubernetes API client that talks to the apiserver over a single
+    keep-alive connection pool. The kubeconfig is read only once.
+    """
+
+    def __init__(self, kubeconfig=KUBECONFIG, pool_maxsize=10):
+        with open(kubeconfig) as f:
+            config = yaml.safe_load(f)
+
+        context_name = config.get("current-context")
+        contexts = {c["name"]: c["context"] for c in config.get("contexts", [])}
+        if context_name in contexts:
+            context = contexts[context_name]
+        else:
+            context = config["contexts"][0]["context"]
+        clusters = {c["name"]: c["cluster"] for c in config["clusters"]}
+        users = {u["name"]: u.get("user") or {} for u in config.get("users", [])}
+        cluster = clusters[context["cluster"]]
+        user = users.get(context.get("user"), {})
+
+        self.server = cluster["server"].rstrip("/")
+        self.namespace = context.get("namespace", "default")
+        self._certs_dir = None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept"] = "application/json"
+
+        if cluster.get("insecure-skip-tls-verify"):
+            self.session.verify = False
+        else:
+            ca = self._material(cluster, "certificate-authority", "ca.crt")
+            if ca:
+                self.session.verify = ca
+
+        cert = self._material(user, "client-certificate", "client.crt")
+        key = self._material(user, "client-key", "client.key")
+        if cert and key:
+            self.session.cert = (cert, key)
+        if user.get("token"):
+            self.session.headers["Authorization"] = "Bearer {}".format(user["token"])
+        elif user.get("username"):
+            self.session.auth = (user["username"], user.get("password", ""))
+
+        self._resources = {}
+        self._discovered = set()
+        self._lock = threading.Lock()
+
+    def _material(self, section, key, filename):
+        """
+        Return a path to the certificate material under key, writing out the
+        inline base64 data to a private directory if needed.
+        """
+        if section.get(key):
+            return section[key]
+        data = section.get("{}-data".format(key))
+        if not data:
+            return None
+        if not self._certs_dir:
+            self._certs_dir = tempfile.mkdtemp(prefix="kubeclient-")
+            atexit.register(shutil.rmtree, self._certs_dir, True)
+        path = os.path.join(self._certs_dir, filename)
+        with open(path, "wb") as f:
+            f.write(base64.b64decode(data))
+        return path
+
+    def request(self, method, path, params=None, body=None, timeout=60, stream=False):
+        """
+        Perform a request against the apiserver.
+        Args:
+            method: the HTTP method
+            path: the absolute API path, eg /api/v1/nodes
+            params: query parameters
+            body: an object to send as JSON
+            timeout: seconds to wait for the apiserver
+            stream: do not read the response body
+
+        Returns: the requests response, an ApiError is raised on error statuses
+
+        """
+        url = self.server + path
+        data = None
+        headers = {}
+        if body is not None:
+            data = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        resp = self.session.request(
+            method,
+            url,
+            params=params,
+            data=data,
+            headers=headers,
+            timeout=timeout,
+            stream=stream,
+        )
+        if resp.status_code >= 400:
+            try:
+                status = resp.json()
+                reason = status.get("reason", resp.reason)
+                message = status.get("message", resp.text)
+            except ValueError:
+                reason, message = resp.reason, resp.text
+            resp.close()
+            raise ApiError(resp.status_code, reason, message, url)
+        return resp
+
+    def get(self, path, params=None, timeout=60):
+        """
+        Do a GET on path and return the decoded JSON body.
+        """
+        return self.request("GET", path, params=params, timeout=timeout).json()
+
+    def _discover(self, group_version):
+        if group_version in self._discovered:
+            return
+        if "/" in group_version:
+            path = "/apis/{}".format(group_version)
+        else:
+            path = "/api/{}".format(group_version)
+        data = self.get(path)
+        group = group_version.split("/")[0] if "/" in group_version else ""
+        for res in data.get("resources", []):
+            if "/" in res["name"]:
+                # Subresources such as pods/log are not addressable on their own
+                continue
+            entry = (path, res["name"], res.get("namespaced", False))
+            names = [res["name"], res.get("singularName"), res["kind"].lower()]
+            names.extend(res.get("shortNames", []))
+            for name in names:
+                if not name:
+                    continue
+                self._resources.setdefault((name, ""), entry)
+                self._resources.setdefault((name, group), entry)
+        self._discovered.add(group_version)
+
+    def resource(self, name):
+        """
+        Resolve a resource name as kubectl would accept it (eg po, pods,
+        deployment.apps) to a tuple of (API base path, plural, namespaced).
+        """
+        name = name.lower()
+        plural, _, group = name.partition(".")
+        with self._lock:
+            if (plural, group) in self._resources:
+                return self._resources[(plural, group)]
+            self._discover("v1")
+            if (plural, group) not in self._resources:
+                for api_group in self.get("/apis").get("groups", []):
+                    if group and api_group["name"] != group:
+                        continue
+                    self._discover(api_group["preferredVersion"]["groupVersion"])
+                    if (plural, group) in self._resources:
+                        break
+            if (plural, group) not in self._resources:
+                raise ApiError(
+                    404,
+                    "NotFound",
+                    'the server doesn\'t have a resource type "{}"'.format(name),
+                    self.server,
+                )
+            return self._resources[(plural, group)]
+
+    def path(self, resource, name=None, namespace=None):
+        """
+        Return the API path for a resource, a named object or a collection.
+        """
+        base, plural, namespaced = self.resource(resource)
+        if namespaced and namespace:
+            path = "{}/namespaces/{}/{}".format(base, namespace, plural)
+        else:
+            path = "{}/{}".format(base, plural)
+        if name:
+            path += "/{}".format(name)
+        return path
+
+    def get_resource(self, resource, name=None, namespace=None, label=None, field=None):
+        """
+        Get a named object, or list objects optionally filtered by a label or
+        field selector. A namespace of None means all namespaces.
+        """
+        params = {}
+        if label:
+            params["labelSelector"] = label
+        if field:
+            params["fieldSelector"] = field
+        return self.get(self.path(resource, name, namespace), params=params)
+
+    def watch(
+        self,
+        resource,
+        namespace=None,
+        label=None,
+        field=None,
+        resource_version=None,
+        deadline=None,
+    ):
+        """
+        Watch a collection and yield (event type, object) tuples.
+
+        The stream is reopened from the last resourceVersion seen whenever the
+        apiserver or the connection drops it, until deadline (a time.monotonic()
+        value) passes. If resource_version has expired an ApiError with status
+        410 is raised and the caller should list again.
+        """
+        path = self.path(resource, None, namespace)
+        while True:
+            params = {"watch": "true", "allowWatchBookmarks": "true"}
+            if label:
+                params["labelSelector"] = label
+            if field:
+                params["fieldSelector"] = field
+            if resource_version:
+                params["resourceVersion"] = resource_version
+            read_timeout = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                params["timeoutSeconds"] = int(math.ceil(remaining))
+                read_timeout = remaining + 10
+            try:
+                resp = self.request(
+                    "GET", path, params=params, timeout=(10, read_timeout), stream=True
+                )
+                with resp:
+                    for line in resp.iter_lines():
+                        if not line:
+                            continue
+                        event = json.loads(line)
+                        obj = event["object"]
+                        if event["type"] == "ERROR":
+                            raise ApiError(
+                                obj.get("code", 500),
+                                obj.get("reason", "Error"),
+                                obj.get("message", ""),
+                                path,
+                            )
+                        metadata = obj.get("metadata", {})
+                        resource_version = metadata.get(
+                            "resourceVersion", resource_version
+                        )
+                        if event["type"] != "BOOKMARK":
+                            yield event["type"], obj
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ) as err:
+                print("Watch on {} interrupted, resuming: {}".format(path, err))
+                time.sleep(1)
+
+
+def parse_get_target(target, default_namespace="default"):
+    """
+    Break a `kubectl get` target such as "po -n kube-system -l app=foo" into
+    (resource, name, namespace, label). Returns None when the target uses
+    anything the API client does not understand.
+    """
+    args = target.split()
+    resource, name, namespace, label = None, None, default_namespace, None
+    positional = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ("-n", "--namespace", "-l", "--selector") and i + 1 < len(args):
+            value = args[i + 1]
+            i += 2
+        elif arg.startswith(("--namespace=", "--selector=")):
+            arg, value = arg.split("=", 1)
+            i += 1
+        elif arg in ("-A", "--all-namespaces"):
+            namespace = None
+            i += 1
+            continue
+        elif arg.startswith("-"):
+            return None
+        else:
+            positional.append(arg)
+            i += 1
+            continue
+        if arg in ("-n", "--namespace"):
+            namespace = value
+        else:
+            label = value
+
+    if len(positional) == 1 and "/" in positional[0]:
+        positional = positional[0].split("/", 1)
+    if not positional or len(positional) > 2 or "," in positional[0]:
+        return None
+    resource = positional[0]
+    if len(positional) == 2:
+        name = positional[1]
+    return resource, name, namespace, label
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the session wide client, or None if the kubeconfig cannot be read.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            kubeconfig = os.environ.get("MICROK8S_KUBECONFIG", KUBECONFIG)
+            try:
+                _client = KubeClient(kubeconfig)
+            except (OSError, KeyError, IndexError, TypeError, yaml.YAMLError) as err:
+                print(
+                    "Cannot load {}, falling back to kubectl: {}".format(
+                        kubeconfig, err
+                    )
+                )
+                _client = False
+        return _client or None
@@ -0,0 +1,65 @@
+import re
+import threading
+from pathlib import Path
+
+from utils import get_arch, kubectl
+
+TEMPLATES = Path(__file__).absolute().parent / "templates"
+PLACEHOLDER = re.compile(r"\$([A-Za-z_][A-Za-z0-9_]*)")
+
+_lock = threading.Lock()
+_templates = {}
+_rendered = {}
+
+
+def load_template(name, templates=TEMPLATES):
+    """
+    Returns: the text of a template, read from disk on first use only.
+
+    """
+    path = Path(templates) / name
+    with _lock:
+        if path not in _templates:
+            _templates[path] = path.read_text()
+        return _templates[path]
+
+
+def render_manifest(name, templates=TEMPLATES, **variables):
+    """
+    Substitute $VARIABLE placeholders in a template. $ARCH defaults to the
+    architecture we are running on. Renders are cached, the template file
+    itself is never modified.
+
+    Returns: the rendered manifest as a string
+
+    """
+    if "ARCH" not in variables:
+        variables["ARCH"] = get_arch()
+    key = (Path(templates) / name, tuple(sorted(variables.items())))
+    with _lock:
+        if key in _rendered:
+            return _rendered[key]
+    text = load_template(name, templates)
+    # Whole placeholder names only, so that $ARCH does not clobber eg $ARCHIVE
+    text = PLACEHOLDER.sub(lambda m: str(variables.get(m.group(1), m.group(0))), text)
+    with _lock:
+        _rendered[key] = text
+    return text
+
+
+def apply_manifest(name, timeout_insec=300, **variables):
+    """
+    Render a template and apply it, streaming it to kubectl on stdin.
+    """
+    return kubectl(
+        "apply -f -", timeout_insec, input=render_manifest(name, **variables)
+    )
+
+
+def delete_manifest(name, timeout_insec=300, **variables):
+    """
+    Render a template and delete the objects it describes.
+    """
+    return kubectl(
+        "delete -f -", timeout_insec, input=render_manifest(name, **variables)
+    )
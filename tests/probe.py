@@ -0,0 +1,221 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import percentile
+
+
+class ProbeResult(object):
+    """
+    The outcome of sampling a URL: latencies of the successful requests and
+    counts of the failed ones by reason.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.latencies = []
+        self.errors = {}
+        self.elapsed = None
+
+    @property
+    def total(self):
+        return len(self.latencies) + sum(self.errors.values())
+
+    @property
+    def error_count(self):
+        return sum(self.errors.values())
+
+    def ok(self, max_error_rate=None):
+        """
+        Returns: True if at least one request succeeded and, if max_error_rate
+        is given, no more than that share of them failed. Functional checks
+        only need a success, as a data path that is still converging may fail
+        some requests.
+
+        """
+        if not self.latencies:
+            return False
+        if max_error_rate is None:
+            return True
+        return self.error_count <= max_error_rate * self.total
+
+    @property
+    def rps(self):
+        """
+        Successful requests per second, for results of a timed load.
+        """
+        return len(self.latencies) / self.elapsed if self.elapsed else None
+
+    def percentile(self, pct):
+        return percentile(self.latencies, pct) if self.latencies else None
+
+    def as_dict(self):
+        return {
+            "requests": self.total,
+            "errors": self.error_count,
+            "error_rate": round(self.error_count / self.total, 4) if self.total else 0,
+            "rps": round(self.rps, 1) if self.rps else None,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+        }
+
+    def format(self):
+        if not self.latencies:
+            return "{}: all {} requests failed {}".format(
+                self.url, self.total, self.errors
+            )
+        return "{}: {} requests, p50 {:.1f}ms p90 {:.1f}ms p99 {:.1f}ms, {} errors ({:.1%}) {}".format(
+            self.url,
+            self.total,
+            self.percentile(50) * 1000,
+            self.percentile(90) * 1000,
+            self.percentile(99) * 1000,
+            self.error_count,
+            self.error_count / self.total,
+            self.errors or "",
+        )
+
+
+class ProbeClient(object):
+    """
+    HTTP client for checking the data path of a cluster, eg through an ingress,
+    a service or a port-forward. Connections are pooled and reused across
+    requests and threads.
+    """
+
+    def __init__(self, pool_maxsize=10, timeout=5):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, url, check=None):
+        """
+        Do a single GET of url.
+
+        Args:
+            url: the URL to get
+            check: optional callable taking the response, returning True if it is valid
+
+        Returns: (latency in seconds, None) on success, (latency, reason) on failure
+
+        """
+        start = time.perf_counter()
+        try:
+            resp = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as err:
+            return time.perf_counter() - start, type(err).__name__
+        latency = time.perf_counter() - start
+        if resp.status_code != 200:
+            return latency, str(resp.status_code)
+        if check and not check(resp):
+            return latency, "unexpected content"
+        return latency, None
+
+    def wait_until_up(self, url, check=None, timeout_insec=250, interval=2):
+        """
+        GET url until it succeeds.
+
+        Returns: the seconds it took
+
+        """
+        start = time.monotonic()
+        while True:
+            _, error = self.get(url, check)
+            if error is None:
+                return time.monotonic() - start
+            if time.monotonic() - start > timeout_insec:
+                raise TimeoutError(
+                    "{} not up after {}s, last error {}".format(
+                        url, timeout_insec, error
+                    )
+                )
+            time.sleep(interval)
+
+    def sample(self, url, count=20, concurrency=4, check=None):
+        """
+        GET url count times, with up to concurrency requests in flight.
+
+        Returns: a ProbeResult
+
+        """
+        result = ProbeResult(url)
+        lock = threading.Lock()
+
+        def one(_):
+            latency, error = self.get(url, check)
+            with lock:
+                if error is None:
+                    result.latencies.append(latency)
+                else:
+                    result.errors[error] = result.errors.get(error, 0) + 1
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(one, range(count)))
+        return result
+
+    def load(self, url, duration=30, concurrency=16, check=None):
+        """
+        Drive url with concurrency clients, each sending its next request as soon
+        as it has a response, for duration seconds. Every client keeps its
+        connection alive, as long as the pool holds concurrency connections.
+
+        Returns: a ProbeResult with the elapsed time set
+
+        """
+        result = ProbeResult(url)
+        lock = threading.Lock()
+        deadline = time.perf_counter() + duration
+
+        def client(_):
+            latencies, errors = [], {}
+            while time.perf_counter() < deadline:
+                latency, error = self.get(url, check)
+                if error is None:
+                    latencies.append(latency)
+                else:
+                    errors[error] = errors.get(error, 0) + 1
+            with lock:
+                result.latencies.extend(latencies)
+                for error, count in errors.items():
+                    result.errors[error] = result.errors.get(error, 0) + count
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(client, range(concurrency)))
+        result.elapsed = time.perf_counter() - start
+        return result
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_probe_client():
+    """
+    Return the session wide probe client.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ProbeClient()
+        return _client
+
+
+def probe(url, check=None, timeout_insec=250, count=20, concurrency=4):
+    """
+    Wait for url to come up, then sample it and print the latencies.
+
+    Returns: the ProbeResult
+
+    """
+    client = get_probe_client()
+    client.wait_until_up(url, check, timeout_insec)
+    result = client.sample(url, count, concurrency, check)
+    print(result.format())
+    return result
@@ -0,0 +1,282 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import percentile
+from kubeclient import ApiError, get_client
+
+REGISTRY = "http://localhost:32000"
+MANIFEST_TYPE = "application/vnd.oci.image.manifest.v1+json"
+CONFIG_TYPE = "application/vnd.oci.image.config.v1+json"
+LAYER_TYPE = "application/vnd.oci.image.layer.v1.tar"
+MB = 1024 * 1024
+
+
+def digest(data):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def make_layer(size):
+    """
+    Returns: an uncompressed layer tarball holding one file of size random bytes.
+
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        info = tarfile.TarInfo("data")
+        info.size = size
+        tar.addfile(info, io.BytesIO(os.urandom(size)))
+    return buf.getvalue()
+
+
+class SyntheticImage(object):
+    """
+    An image of random layers, built in memory so that no base image has to be
+    pulled from the internet.
+    """
+
+    def __init__(self, name, layers=3, layer_size=10 * MB):
+        self.name = name
+        self.layers = [make_layer(layer_size) for _ in range(layers)]
+        config = {
+            "architecture": "amd64",
+            "os": "linux",
+            "rootfs": {
+                "type": "layers",
+                "diff_ids": [digest(layer) for layer in self.layers],
+            },
+        }
+        self.config = json.dumps(config).encode("utf8")
+        self.manifest = json.dumps(
+            {
+                "schemaVersion": 2,
+                "mediaType": MANIFEST_TYPE,
+                "config": self._descriptor(CONFIG_TYPE, self.config),
+                "layers": [self._descriptor(LAYER_TYPE, l) for l in self.layers],
+            }
+        ).encode("utf8")
+
+    @staticmethod
+    def _descriptor(media_type, data):
+        return {"mediaType": media_type, "digest": digest(data), "size": len(data)}
+
+    @property
+    def size(self):
+        return sum(len(layer) for layer in self.layers) + len(self.config)
+
+
+class RegistryClient(object):
+    """
+    Talks the registry HTTP API v2 over pooled connections, timing every blob.
+    """
+
+    def __init__(self, registry=REGISTRY, pool_maxsize=10, timeout=300):
+        self.registry = registry.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _url(self, path):
+        return self.registry + path
+
+    def push_blob(self, repository, data):
+        """
+        Upload a blob in one request.
+
+        Returns: the seconds it took
+
+        """
+        start = time.perf_counter()
+        resp = self.session.post(
+            self._url("/v2/{}/blobs/uploads/".format(repository)), timeout=self.timeout
+        )
+        resp.raise_for_status()
+        location = resp.headers["Location"]
+        if location.startswith("/"):
+            location = self._url(location)
+        separator = "&" if "?" in location else "?"
+        resp = self.session.put(
+            "{}{}digest={}".format(location, separator, digest(data)),
+            data=data,
+            headers={"Content-Type": "application/octet-stream"},
+            timeout=self.timeout,
+        )
+        resp.raise_for_status()
+        return time.perf_counter() - start
+
+    def pull_blob(self, repository, blob_digest):
+        """
+        Download a blob and check its digest.
+
+        Returns: the seconds it took
+
+        """
+        start = time.perf_counter()
+        resp = self.session.get(
+            self._url("/v2/{}/blobs/{}".format(repository, blob_digest)),
+            timeout=self.timeout,
+        )
+        resp.raise_for_status()
+        if digest(resp.content) != blob_digest:
+            raise ValueError("Blob {} is corrupt".format(blob_digest))
+        return time.perf_counter() - start
+
+    def push(self, image, tag="latest"):
+        """
+        Push an image, layers first.
+
+        Returns: the seconds each layer took
+
+        """
+        latencies = [self.push_blob(image.name, layer) for layer in image.layers]
+        self.push_blob(image.name, image.config)
+        resp = self.session.put(
+            self._url("/v2/{}/manifests/{}".format(image.name, tag)),
+            data=image.manifest,
+            headers={"Content-Type": MANIFEST_TYPE},
+            timeout=self.timeout,
+        )
+        resp.raise_for_status()
+        return latencies
+
+    def pull(self, repository, tag="latest"):
+        """
+        Pull an image by tag: its manifest, config and layers.
+
+        Returns: the seconds each layer took
+
+        """
+        resp = self.session.get(
+            self._url("/v2/{}/manifests/{}".format(repository, tag)),
+            headers={"Accept": MANIFEST_TYPE},
+            timeout=self.timeout,
+        )
+        resp.raise_for_status()
+        manifest = resp.json()
+        self.pull_blob(repository, manifest["config"]["digest"])
+        return [self.pull_blob(repository, l["digest"]) for l in manifest["layers"]]
+
+
+def parse_quantity(quantity):
+    """
+    Returns: a CPU quantity in cores or a memory quantity in bytes, eg
+    "250m" -> 0.25, "12345n" -> 0.000012345, "64Mi" -> 67108864
+
+    """
+    suffixes = {
+        "n": 1e-9,
+        "u": 1e-6,
+        "m": 1e-3,
+        "k": 1e3,
+        "M": 1e6,
+        "G": 1e9,
+        "Ki": 1024,
+        "Mi": 1024**2,
+        "Gi": 1024**3,
+    }
+    for suffix in sorted(suffixes, key=len, reverse=True):
+        if quantity.endswith(suffix):
+            return float(quantity[: -len(suffix)]) * suffixes[suffix]
+    return float(quantity)
+
+
+class ResourceSampler(object):
+    """
+    Samples the CPU and memory use of the pods in a namespace from the metrics
+    API, in a background thread, keeping the peaks. Needs metrics-server; with
+    no metrics the peaks stay None.
+    """
+
+    def __init__(self, namespace="container-registry", interval=1.0):
+        self.path = "/apis/metrics.k8s.io/v1beta1/namespaces/{}/pods".format(namespace)
+        self.interval = interval
+        self.cpu = None
+        self.memory = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        client = get_client()
+        if not client:
+            return
+        try:
+            pods = client.get(self.path)["items"]
+        except (ApiError, requests.RequestException):
+            return
+        containers = [c for pod in pods for c in pod.get("containers", [])]
+        cpu = sum(parse_quantity(c["usage"]["cpu"]) for c in containers)
+        memory = sum(parse_quantity(c["usage"]["memory"]) for c in containers)
+        self.cpu = max(cpu, self.cpu or 0)
+        self.memory = max(memory, self.memory or 0)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def _layer_stats(latencies):
+    return {
+        "layer_p50": round(percentile(latencies, 50), 3),
+        "layer_p95": round(percentile(latencies, 95), 3),
+    }
+
+
+def run_registry_benchmark(
+    images=4, layers=3, layer_mb=10, concurrency=4, registry=REGISTRY
+):
+    """
+    Push a batch of synthetic images of layers layers of layer_mb MB each to the
+    registry, concurrency at a time, then pull them all back the same way.
+
+    Returns: {"push": stats, "pull": stats, "cpu_cores", "memory_mb"} where stats
+    holds the MB/s and the per-layer latency percentiles
+
+    """
+    client = RegistryClient(registry, pool_maxsize=concurrency)
+    batch = [
+        SyntheticImage("bench/image-{}".format(i), layers, layer_mb * MB)
+        for i in range(images)
+    ]
+    total_mb = sum(image.size for image in batch) / MB
+    results = {}
+    with ResourceSampler() as sampler:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            start = time.perf_counter()
+            pushed = list(executor.map(client.push, batch))
+            elapsed = time.perf_counter() - start
+            results["push"] = dict(
+                mb_per_s=round(total_mb / elapsed, 1),
+                **_layer_stats([t for image in pushed for t in image])
+            )
+
+            start = time.perf_counter()
+            pulled = list(executor.map(client.pull, [i.name for i in batch]))
+            elapsed = time.perf_counter() - start
+            results["pull"] = dict(
+                mb_per_s=round(total_mb / elapsed, 1),
+                **_layer_stats([t for image in pulled for t in image])
+            )
+        sampler.sample()
+    results["cpu_cores"] = round(sampler.cpu, 3) if sampler.cpu is not None else None
+    results["memory_mb"] = (
+        round(sampler.memory / MB, 1) if sampler.memory is not None else None
+    )
+    return results
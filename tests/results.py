@@ -0,0 +1,361 @@
+"""
+Historical store of harness timings and benchmark results, and a CLI to find
+regressions and flaky tests in it.
+
+    python tests/results.py regressions
+    python tests/results.py flaky
+    python tests/results.py trend --metric enable.median --addon dns
+
+Test sessions are only recorded when $RESULTS_DB names the database.
+"""
+
+import argparse
+import csv
+import os
+import sqlite3
+import statistics
+import sys
+import time
+
+from common import ADDONS_YAML, catalogue, current_arch
+
+SNAP_CURRENT = "/snap/microk8s/current"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    snap_revision TEXT NOT NULL,
+    arch TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    addon TEXT,
+    addon_version TEXT,
+    metric TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS measurements_series
+    ON measurements (kind, name, metric, addon);
+"""
+
+# Benchmark results recorded by the tests of this session, stored at the end
+pending = []
+
+
+def db_path():
+    """
+    Returns: the database path from $RESULTS_DB, or None if it is not set,
+    as recording is opt-in.
+
+    """
+    return os.environ.get("RESULTS_DB") or None
+
+
+def snap_revision():
+    try:
+        return os.path.basename(os.readlink(SNAP_CURRENT))
+    except OSError:
+        return "unknown"
+
+
+def addon_versions(addons_yaml=ADDONS_YAML):
+    """
+    Returns: {addon: version} out of addons.yaml.
+
+    """
+    addons = catalogue.load(addons_yaml).addons
+    return {a["name"]: a.get("version") or None for a in addons}
+
+
+def flatten(results, prefix=""):
+    """
+    Returns: the numbers in a nested dict keyed by dotted paths, eg
+    {"push": {"mb_per_s": 10}} -> {"push.mb_per_s": 10}
+
+    """
+    flat = {}
+    for key, value in results.items():
+        path = "{}.{}".format(prefix, key) if prefix else str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def record_benchmark(name, results, addon=None):
+    """
+    Queue the numbers in a benchmark result to be stored at the end of the
+    session, eg record_benchmark("registry", {"push": {"mb_per_s": 10}}).
+    """
+    pending.append((name, addon, flatten(results)))
+
+
+class ResultsStore(object):
+    """
+    Measurements of harness runs in a SQLite database. Each run is keyed by the
+    snap revision and arch, each measurement by the addon version in addons.yaml.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(str(path))
+        self.db.executescript(SCHEMA)
+
+    def start_run(self, snap_revision, arch, started=None):
+        cursor = self.db.execute(
+            "INSERT INTO runs (started, snap_revision, arch) VALUES (?, ?, ?)",
+            (started or time.time(), snap_revision, arch),
+        )
+        return cursor.lastrowid
+
+    def add(self, run_id, kind, name, metrics, addon=None, addon_version=None):
+        """
+        Store {metric: value} measurements of kind (test, span or benchmark).
+        """
+        self.db.executemany(
+            "INSERT INTO measurements VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (run_id, kind, name, addon, addon_version, metric, value)
+                for metric, value in metrics.items()
+            ],
+        )
+
+    def commit(self):
+        self.db.commit()
+
+    def series(self, kind=None, name=None, metric=None, addon=None, arch=None):
+        """
+        Returns: measurement rows, oldest run first, as dicts with the run
+        details, filtered by any of the arguments given.
+
+        """
+        query = (
+            "SELECT r.id, r.started, r.snap_revision, r.arch, m.kind, m.name,"
+            " m.addon, m.addon_version, m.metric, m.value"
+            " FROM measurements m JOIN runs r ON r.id = m.run_id"
+        )
+        filters = {
+            "m.kind": kind,
+            "m.name": name,
+            "m.metric": metric,
+            "m.addon": addon,
+            "r.arch": arch,
+        }
+        where = [(column, value) for column, value in filters.items() if value]
+        if where:
+            query += " WHERE " + " AND ".join("{} = ?".format(c) for c, _ in where)
+        query += " ORDER BY r.started, r.id"
+        columns = [
+            "run",
+            "started",
+            "snap_revision",
+            "arch",
+            "kind",
+            "name",
+            "addon",
+            "addon_version",
+            "metric",
+            "value",
+        ]
+        rows = self.db.execute(query, [value for _, value in where])
+        return [dict(zip(columns, row)) for row in rows]
+
+    def close(self):
+        self.db.close()
+
+
+def record_session(path, tests, span_summary, benchmarks):
+    """
+    Store the measurements of a test session as a new run.
+
+    Args:
+        path: the database
+        tests: {test: {"duration", "passed"}}
+        span_summary: timing.summarise("test") and ("addon") as {"test": ..., "addon": ...}
+        benchmarks: [(name, addon, {metric: value})]
+
+    """
+    versions = addon_versions()
+    store = ResultsStore(path)
+    try:
+        run = store.start_run(snap_revision(), current_arch())
+        for test, metrics in tests.items():
+            kinds = span_summary["test"].get(test, {})
+            metrics = dict(metrics)
+            # Waits poll by design, only commands failing and retrying count
+            metrics["retries"] = sum(
+                a - c for kind, (c, a, _, _) in kinds.items() if kind != "wait"
+            )
+            metrics["sleep"] = sum(s for _, _, s, _ in kinds.values())
+            store.add(run, "test", test, metrics)
+        for addon, kinds in span_summary["addon"].items():
+            if addon == "-":
+                continue
+            for kind, (count, attempts, sleep, wall) in kinds.items():
+                store.add(
+                    run,
+                    "span",
+                    kind,
+                    {"wall": wall, "retries": attempts - count, "sleep": sleep},
+                    addon,
+                    versions.get(addon),
+                )
+        for name, addon, metrics in benchmarks:
+            store.add(run, "benchmark", name, metrics, addon, versions.get(addon))
+        store.commit()
+    finally:
+        store.close()
+
+
+def _series_key(row):
+    return row["kind"], row["name"], row["addon"], row["arch"], row["metric"]
+
+
+def find_regressions(
+    store, window=10, threshold=3.0, min_change=0.2, min_history=5, higher_is_better=()
+):
+    """
+    Compare the latest value of every series against the window values before
+    it. A value is a regression when it is worse than the median by more than
+    threshold robust standard deviations (1.4826 * MAD) and by more than
+    min_change of the median. Lower values are better unless the metric name
+    ends with one of higher_is_better.
+
+    Returns: a list of dicts describing the regressions
+
+    """
+    groups = {}
+    for row in store.series():
+        groups.setdefault(_series_key(row), []).append(row)
+
+    regressions = []
+    for key, rows in groups.items():
+        history, latest = rows[-window - 1 : -1], rows[-1]
+        if len(history) < min_history:
+            continue
+        values = [r["value"] for r in history]
+        median = statistics.median(values)
+        spread = 1.4826 * statistics.median(abs(v - median) for v in values)
+        sign = -1 if key[-1].endswith(tuple(higher_is_better)) else 1
+        change = sign * (latest["value"] - median)
+        if change > threshold * spread and change > min_change * abs(median):
+            previous = {r["addon_version"] for r in history} - {None}
+            regressions.append(
+                {
+                    "kind": key[0],
+                    "name": key[1],
+                    "addon": key[2],
+                    "arch": key[3],
+                    "metric": key[4],
+                    "median": median,
+                    "latest": latest["value"],
+                    "snap_revision": latest["snap_revision"],
+                    "version_change": (
+                        "{} -> {}".format(
+                            ",".join(sorted(previous)), latest["addon_version"]
+                        )
+                        if latest["addon_version"] not in previous and previous
+                        else None
+                    ),
+                }
+            )
+    return regressions
+
+
+def find_flaky(store, window=20, min_rate=0.1):
+    """
+    Returns: (test, runs, retry rate, failure rate) for the tests that needed
+    retries or failed in at least min_rate of their last window runs, but did
+    not fail every time.
+
+    """
+    runs = {}
+    for row in store.series(kind="test"):
+        runs.setdefault((row["name"], row["run"]), {})[row["metric"]] = row["value"]
+    per_test = {}
+    for (test, _), metrics in runs.items():
+        per_test.setdefault(test, []).append(metrics)
+
+    flaky = []
+    for test, history in sorted(per_test.items()):
+        history = history[-window:]
+        retried = sum(1 for m in history if m.get("retries", 0) > 0)
+        failed = sum(1 for m in history if not m.get("passed", 1))
+        retry_rate, failure_rate = retried / len(history), failed / len(history)
+        if failed == len(history):
+            continue
+        if retry_rate >= min_rate or failure_rate > 0:
+            flaky.append((test, len(history), retry_rate, failure_rate))
+    return flaky
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db", default=db_path() or "harness-results.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    regressions = commands.add_parser("regressions", help="flag slowdowns")
+    regressions.add_argument("--window", type=int, default=10)
+    regressions.add_argument("--threshold", type=float, default=3.0)
+    regressions.add_argument("--min-change", type=float, default=0.2)
+    regressions.add_argument(
+        "--higher-is-better",
+        default="mb_per_s,rps,qps,resolutions_per_s,volumes_per_s,iops,hit_ratio,calls_per_s",
+        help="comma separated metric suffixes where higher values are better",
+    )
+
+    flaky = commands.add_parser("flaky", help="list tests that needed retries")
+    flaky.add_argument("--window", type=int, default=20)
+    flaky.add_argument("--min-rate", type=float, default=0.1)
+
+    trend = commands.add_parser("trend", help="export a series as CSV")
+    for option in ["kind", "name", "metric", "addon", "arch"]:
+        trend.add_argument("--" + option)
+
+    args = parser.parse_args(argv)
+    store = ResultsStore(args.db)
+    try:
+        if args.command == "regressions":
+            found = find_regressions(
+                store,
+                args.window,
+                args.threshold,
+                args.min_change,
+                higher_is_better=args.higher_is_better.split(","),
+            )
+            for r in found:
+                print(
+                    "{arch} {kind} {name} {addon} {metric}: median {median:.3f} -> "
+                    "{latest:.3f} at snap revision {snap_revision}".format(**r)
+                    + (
+                        ", addon version {}".format(r["version_change"])
+                        if r["version_change"]
+                        else ""
+                    )
+                )
+            return 1 if found else 0
+        if args.command == "flaky":
+            for test, count, retry_rate, failure_rate in find_flaky(
+                store, args.window, args.min_rate
+            ):
+                print(
+                    "{}: retried in {:.0%}, failed in {:.0%} of {} runs".format(
+                        test, retry_rate, failure_rate, count
+                    )
+                )
+            return 0
+        rows = store.series(args.kind, args.name, args.metric, args.addon, args.arch)
+        if rows:
+            writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        return 0
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
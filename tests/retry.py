@@ -0,0 +1,178 @@
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+NOT_FOUND = "not-found"
+UNAVAILABLE = "unavailable"
+FORBIDDEN = "forbidden"
+OTHER = "other"
+
+# Checked in order, the first match wins
+ERROR_PATTERNS = [
+    (
+        UNAVAILABLE,
+        re.compile(
+            r"connection refused|was refused|unable to connect|connection reset"
+            r"|serviceunavailable|service unavailable|tls handshake timeout"
+            r"|i/o timeout|etcdserver|too many requests|\b50[234]\b",
+            re.IGNORECASE,
+        ),
+    ),
+    (FORBIDDEN, re.compile(r"forbidden|unauthorized|\b40[13]\b", re.IGNORECASE)),
+    (
+        NOT_FOUND,
+        re.compile(
+            r"notfound|not found|doesn't have a resource type|no matches for kind"
+            r"|\b404\b",
+            re.IGNORECASE,
+        ),
+    ),
+]
+
+
+def classify(error):
+    """
+    Returns: the class of an error, given its message or output.
+
+    """
+    text = str(error)
+    for error_class, pattern in ERROR_PATTERNS:
+        if pattern.search(text):
+            return error_class
+    return OTHER
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter.
+
+    Args:
+        initial: delay after the first failed attempt
+        factor: growth of the delay per attempt
+        cap: maximum delay
+        jitter: fraction of the delay to randomise by, in both directions
+        max_attempts: give up after this many attempts, regardless of time left
+    """
+
+    def __init__(self, initial, factor=2.0, cap=10.0, jitter=0.2, max_attempts=None):
+        self.initial = initial
+        self.factor = factor
+        self.cap = cap
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+
+    def delay(self, attempt):
+        """
+        Returns: the seconds to wait after failed attempt number attempt (from 1).
+
+        """
+        delay = min(self.cap, self.initial * self.factor ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class RetryPolicy(object):
+    """
+    Decides whether and how long to wait before retrying a failed operation,
+    based on the class of the error and the number of attempts so far.
+    """
+
+    def __init__(self, backoffs=None, default=None):
+        # Objects about to appear are retried fast. An apiserver that is
+        # restarting is given room. Permission errors rarely resolve
+        # themselves, only RBAC propagation delays are waited out.
+        self.backoffs = {
+            NOT_FOUND: Backoff(0.25, cap=3.0),
+            UNAVAILABLE: Backoff(2.0, factor=1.5, cap=15.0),
+            FORBIDDEN: Backoff(1.0, cap=5.0, max_attempts=5),
+        }
+        self.backoffs.update(backoffs or {})
+        self.default = default or Backoff(0.5, cap=10.0)
+
+    def backoff(self, error_class):
+        return self.backoffs.get(error_class, self.default)
+
+    def next_delay(self, error, attempt, deadline):
+        """
+        Returns: the seconds to sleep before the next attempt, or None to give up.
+        The delay is cut short so as not to overrun the deadline.
+
+        """
+        backoff = self.backoff(classify(error))
+        if backoff.max_attempts and attempt >= backoff.max_attempts:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        return min(backoff.delay(attempt), remaining)
+
+
+class FixedPolicy(RetryPolicy):
+    """
+    Retry every interval seconds whatever the error, the behaviour the harness
+    had before retry policies.
+    """
+
+    def __init__(self, interval=3.0):
+        super().__init__(default=Backoff(interval, factor=1.0, cap=interval, jitter=0))
+        self.backoffs = {}
+
+
+_default = {"policy": RetryPolicy(), "budget": None}
+_local = threading.local()
+
+
+def get_policy():
+    return getattr(_local, "policy", None) or _default["policy"]
+
+
+def set_default_policy(policy):
+    _default["policy"] = policy
+
+
+@contextmanager
+def policy(retry_policy):
+    """
+    Use retry_policy for the retries done by this thread.
+    """
+    previous = getattr(_local, "policy", None)
+    _local.policy = retry_policy
+    try:
+        yield
+    finally:
+        _local.policy = previous
+
+
+def set_test_budget(seconds):
+    """
+    Give the running test a total retry budget of seconds, shared by all the
+    calls it makes from any thread. None removes the budget.
+    """
+    _default["budget"] = None if seconds is None else time.monotonic() + seconds
+
+
+@contextmanager
+def budget(seconds):
+    """
+    Bound the retries done by this thread, including nested calls, to seconds.
+    A budget can only shrink the time left by an enclosing one.
+    """
+    previous = getattr(_local, "budget", None)
+    _local.budget = deadline(seconds)
+    try:
+        yield
+    finally:
+        _local.budget = previous
+
+
+def deadline(timeout_insec):
+    """
+    Returns: the time.monotonic() deadline for an operation with timeout_insec,
+    shortened by the test and thread budgets in effect.
+
+    """
+    deadlines = [time.monotonic() + timeout_insec, _default["budget"]]
+    deadlines.append(getattr(_local, "budget", None))
+    return min(d for d in deadlines if d is not None)
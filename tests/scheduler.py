@@ -0,0 +1,198 @@
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import timing
+
+
+class Job(object):
+    """
+    A unit of work for the scheduler, typically enable -> validate -> disable of
+    an addon.
+
+    Args:
+        name: unique name of the job, usually the addon name
+        run: callable doing the work
+        requires: names of jobs that have to succeed before this one starts
+        conflicts: names of jobs or shared resources (eg "kubelet", "port:80")
+            this job cannot run alongside. Two jobs conflict when either one
+            names the other, or when they name the same resource.
+        exclusive: the job cannot run alongside any other job
+    """
+
+    def __init__(self, name, run, requires=(), conflicts=(), exclusive=False):
+        self.name = name
+        self.run = run
+        self.requires = list(requires)
+        self.conflicts = set(conflicts)
+        self.exclusive = exclusive
+        self.ready = None
+        self.start = None
+        self.end = None
+        self.error = None
+        self.skipped = False
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    def conflicts_with(self, other):
+        if self.exclusive or other.exclusive:
+            return True
+        mine = self.conflicts | {self.name}
+        theirs = other.conflicts | {other.name}
+        return bool(self.conflicts & theirs or other.conflicts & mine)
+
+
+class Report(object):
+    """
+    The outcome of a scheduler run.
+    """
+
+    def __init__(self, jobs, start, end):
+        self.jobs = jobs
+        self.start = start
+        self.end = end
+
+    @property
+    def wall_time(self):
+        return self.end - self.start
+
+    @property
+    def serial_time(self):
+        return sum(job.duration for job in self.jobs.values())
+
+    @property
+    def failed(self):
+        return [job for job in self.jobs.values() if job.error or job.skipped]
+
+    def critical_path(self):
+        """
+        Returns: the chain of jobs, following requirements, with the longest
+        total run time and that time in seconds.
+
+        """
+        finish = {}
+        previous = {}
+
+        def longest(name):
+            if name not in finish:
+                job = self.jobs[name]
+                best, best_time = None, 0.0
+                for req in job.requires:
+                    if longest(req) > best_time:
+                        best, best_time = req, longest(req)
+                finish[name] = best_time + job.duration
+                previous[name] = best
+            return finish[name]
+
+        if not self.jobs:
+            return [], 0.0
+        last = max(self.jobs, key=longest)
+        path = []
+        while last:
+            path.insert(0, last)
+            last = previous[last]
+        return path, finish[path[-1]]
+
+    def format(self):
+        lines = [
+            "{:<24} {:>8} {:>8} {:>8}  {}".format(
+                "job", "waited", "start", "took", "result"
+            )
+        ]
+        for job in sorted(self.jobs.values(), key=lambda j: j.start or self.end):
+            if job.skipped:
+                lines.append(
+                    "{:<24} {:>8} {:>8} {:>8}  skipped".format(job.name, "-", "-", "-")
+                )
+                continue
+            lines.append(
+                "{:<24} {:>7.1f}s {:>7.1f}s {:>7.1f}s  {}".format(
+                    job.name,
+                    job.start - job.ready,
+                    job.start - self.start,
+                    job.duration,
+                    "failed: {}".format(job.error) if job.error else "ok",
+                )
+            )
+        path, seconds = self.critical_path()
+        lines.append(
+            "Wall time {:.1f}s, serial time {:.1f}s".format(
+                self.wall_time, self.serial_time
+            )
+        )
+        lines.append("Critical path {:.1f}s: {}".format(seconds, " -> ".join(path)))
+        return "\n".join(lines)
+
+
+def run_jobs(jobs, max_workers=4):
+    """
+    Run jobs concurrently, respecting their requirements and conflicts. Jobs
+    are started in the order given as soon as they are unblocked. Jobs whose
+    requirements failed are skipped.
+
+    Returns: a Report
+
+    """
+    jobs = {job.name: job for job in jobs}
+    for job in jobs.values():
+        for req in job.requires:
+            if req not in jobs:
+                raise ValueError("Job {} requires unknown job {}".format(job.name, req))
+
+    pending = list(jobs.values())
+    running = {}
+    start = time.monotonic()
+
+    def execute(job):
+        job.start = time.monotonic()
+        try:
+            with timing.addon_context(job.name):
+                job.run()
+        except BaseException as err:
+            traceback.print_exc()
+            job.error = err
+        finally:
+            job.end = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            skipping = True
+            while skipping:
+                skipping = False
+                for job in list(pending):
+                    if any(jobs[r].error or jobs[r].skipped for r in job.requires):
+                        print("Skipping {}, a requirement failed".format(job.name))
+                        job.skipped = True
+                        pending.remove(job)
+                        skipping = True
+
+            for job in list(pending):
+                reqs = [jobs[r] for r in job.requires]
+                if not all(r.end for r in reqs):
+                    continue
+                if job.ready is None:
+                    job.ready = time.monotonic()
+                if len(running) >= max_workers:
+                    continue
+                if any(job.conflicts_with(other) for other in running.values()):
+                    continue
+                pending.remove(job)
+                print("Starting {}".format(job.name))
+                running[executor.submit(execute, job)] = job
+
+            if not running:
+                if pending:
+                    # Only happens with a requirement cycle
+                    raise ValueError(
+                        "Cannot schedule {}".format([job.name for job in pending])
+                    )
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                print("Finished {}".format(running.pop(future).name))
+
+    return Report(jobs, start, time.monotonic())
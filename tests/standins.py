@@ -0,0 +1,574 @@
+import copy
+import hashlib
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import yaml
+
+
+CORE_RESOURCES = [
+    ("pods", "pod", "Pod", ["po"], True),
+    ("nodes", "node", "Node", ["no"], False),
+    ("namespaces", "namespace", "Namespace", ["ns"], False),
+    ("services", "service", "Service", ["svc"], True),
+    (
+        "persistentvolumeclaims",
+        "persistentvolumeclaim",
+        "PersistentVolumeClaim",
+        ["pvc"],
+        True,
+    ),
+]
+
+APPS_RESOURCES = [
+    ("deployments", "deployment", "Deployment", ["deploy"], True),
+    ("daemonsets", "daemonset", "DaemonSet", ["ds"], True),
+    ("statefulsets", "statefulset", "StatefulSet", ["sts"], True),
+]
+
+
+def _resource_list(group_version, resources):
+    return {
+        "kind": "APIResourceList",
+        "groupVersion": group_version,
+        "resources": [
+            {
+                "name": name,
+                "singularName": singular,
+                "kind": kind,
+                "shortNames": short,
+                "namespaced": namespaced,
+                "verbs": ["get", "list", "watch"],
+            }
+            for name, singular, kind, short, namespaced in resources
+        ],
+    }
+
+
+def _matches(obj, selector, field=""):
+    metadata = obj.get("metadata", {})
+    labels = metadata.get("labels", {})
+    for term in [t for t in selector.split(",") if t]:
+        key, _, value = term.partition("=")
+        if labels.get(key) != value:
+            return False
+    for term in [t for t in field.split(",") if t]:
+        key, _, value = term.partition("=")
+        if key == "metadata.name" and metadata.get("name") != value:
+            return False
+        if key == "metadata.namespace" and metadata.get("namespace") != value:
+            return False
+    return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self, message):
+        self._send(
+            404,
+            {
+                "kind": "Status",
+                "status": "Failure",
+                "reason": "NotFound",
+                "message": message,
+            },
+        )
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = [p for p in url.path.split("/") if p]
+        server = self.server
+        server.requests += 1
+
+        if parts == ["readyz"]:
+            if server.ready:
+                return self._send(200, "ok")
+            return self._send(500, {"kind": "Status", "message": "readyz check failed"})
+        if parts == ["api"]:
+            return self._send(200, {"kind": "APIVersions", "versions": ["v1"]})
+        if parts == ["api", "v1"]:
+            return self._send(200, _resource_list("v1", CORE_RESOURCES))
+        if parts == ["apis"]:
+            group = {"name": "apps", "preferredVersion": {"groupVersion": "apps/v1"}}
+            return self._send(200, {"kind": "APIGroupList", "groups": [group]})
+        if parts == ["apis", "apps", "v1"]:
+            return self._send(200, _resource_list("apps/v1", APPS_RESOURCES))
+
+        # Strip the group version prefix, leaving [namespaces, ns,] plural [, name]
+        if parts[:2] == ["api", "v1"]:
+            parts = parts[2:]
+        elif parts[:3] == ["apis", "apps", "v1"] and len(parts) > 3:
+            parts = parts[3:]
+        else:
+            return self._not_found("the server could not find the requested resource")
+
+        namespace = None
+        if len(parts) >= 3 and parts[0] == "namespaces":
+            namespace = parts[1]
+            parts = parts[2:]
+        plural = parts[0]
+        name = parts[1] if len(parts) > 1 else None
+
+        selector = query.get("labelSelector", [""])[0]
+        field = query.get("fieldSelector", [""])[0]
+        if query.get("watch", [""])[0] == "true":
+            return self._watch(plural, namespace, selector, field, query)
+
+        with server.lock:
+            objects = [
+                obj
+                for (res, ns, _), obj in sorted(server.objects.items())
+                if res == plural and (namespace is None or ns == namespace)
+            ]
+            resource_version = str(server.resource_version)
+        if name:
+            for obj in objects:
+                if obj["metadata"]["name"] == name:
+                    return self._send(200, obj)
+            return self._not_found('{} "{}" not found'.format(plural, name))
+
+        items = [obj for obj in objects if _matches(obj, selector, field)]
+        metadata = {"resourceVersion": resource_version}
+        self._send(200, {"kind": "List", "metadata": metadata, "items": items})
+
+    def _watch(self, plural, namespace, selector, field, query):
+        server = self.server
+        since = int(query.get("resourceVersion", ["0"])[0] or 0)
+        deadline = time.monotonic() + int(query.get("timeoutSeconds", ["300"])[0])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        with server.lock:
+            generation = server.generation
+        while True:
+            with server.changed:
+                server.changed.wait_for(
+                    lambda: server.resource_version > since
+                    or server.generation != generation,
+                    timeout=max(0, deadline - time.monotonic()),
+                )
+                if server.generation != generation:
+                    # Drop the connection without terminating the stream
+                    self.close_connection = True
+                    return
+                events = [e for e in server.events if e[0] > since]
+            for rv, event, key, obj in events:
+                since = rv
+                res, ns, _ = key
+                if res != plural or (namespace is not None and ns != namespace):
+                    continue
+                if not _matches(obj, selector, field):
+                    continue
+                data = json.dumps({"type": event, "object": obj}).encode("utf8")
+                if not self._write_chunk(data + b"\n"):
+                    return
+            if time.monotonic() >= deadline:
+                self._write_chunk(b"")
+                return
+
+    def _write_chunk(self, data):
+        try:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away, eg after seeing the event it waited for
+            self.close_connection = True
+            return False
+
+
+class StandInApiServer(ThreadingHTTPServer):
+    """
+    An in-process HTTP server answering the small subset of the Kubernetes API
+    used by the test harness. Objects are held in memory and can be changed
+    while the server runs. Use it as a context manager.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, objects=()):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.objects = {}
+        self.events = []
+        self.resource_version = 0
+        self.generation = 0
+        self.requests = 0
+        self.ready = True
+        for obj in objects:
+            self.put(obj)
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def put(self, obj):
+        """
+        Create or replace an object. The plural resource name is taken from
+        the kind, eg Pod -> pods.
+        """
+        obj = copy.deepcopy(obj)
+        meta = obj["metadata"]
+        key = (obj["kind"].lower() + "s", meta.get("namespace"), meta["name"])
+        with self.changed:
+            event = "MODIFIED" if key in self.objects else "ADDED"
+            self._record(event, key, obj)
+            self.objects[key] = obj
+
+    def delete(self, kind, name, namespace=None):
+        """
+        Delete an object if it exists.
+        """
+        key = (kind.lower() + "s", namespace, name)
+        with self.changed:
+            if key in self.objects:
+                self._record("DELETED", key, self.objects.pop(key))
+
+    def drop_watches(self):
+        """
+        Abruptly close all open watch streams, as an apiserver restart would.
+        """
+        with self.changed:
+            self.generation += 1
+            self.changed.notify_all()
+
+    def _record(self, event, key, obj):
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        self.events.append((self.resource_version, event, key, obj))
+        self.changed.notify_all()
+
+    def write_kubeconfig(self, path):
+        """
+        Write a kubeconfig pointing to this server at path.
+        """
+        config = {
+            "apiVersion": "v1",
+            "kind": "Config",
+            "clusters": [{"name": "standin", "cluster": {"server": self.url}}],
+            "users": [{"name": "admin", "user": {"token": "standin"}}],
+            "contexts": [
+                {"name": "standin", "context": {"cluster": "standin", "user": "admin"}}
+            ],
+            "current-context": "standin",
+        }
+        with open(path, "w") as f:
+            yaml.safe_dump(config, f)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.drop_watches()
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+class _RegistryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body=b"", headers=None):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        self._body()
+        if not self.path.endswith("/blobs/uploads/"):
+            return self._send(404)
+        location = "{}{}".format(self.path, uuid.uuid4().hex)
+        self._send(202, headers={"Location": location})
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        data = self._body()
+        store = self.server
+        if "/blobs/uploads/" in url.path:
+            expected = parse_qs(url.query)["digest"][0]
+            if "sha256:" + hashlib.sha256(data).hexdigest() != expected:
+                return self._send(400)
+            with store.lock:
+                store.blobs[expected] = data
+            return self._send(201)
+        if "/manifests/" in url.path:
+            with store.lock:
+                store.manifests[url.path] = (self.headers["Content-Type"], data)
+            return self._send(201)
+        self._send(404)
+
+    def do_GET(self):
+        store = self.server
+        with store.lock:
+            if "/blobs/" in self.path:
+                data = store.blobs.get(self.path.rsplit("/", 1)[1])
+                if data is not None:
+                    return self._send(200, data)
+            elif self.path in store.manifests:
+                content_type, data = store.manifests[self.path]
+                return self._send(200, data, {"Content-Type": content_type})
+        self._send(404)
+
+
+class StandInRegistry(ThreadingHTTPServer):
+    """
+    An in-process image registry speaking enough of the registry HTTP API v2 to
+    push and pull images with monolithic blob uploads. Use it as a context
+    manager.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _RegistryHandler)
+        self.lock = threading.Lock()
+        self.blobs = {}
+        self.manifests = {}
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+class _ChartRepoHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        repo = self.server
+        with repo.lock:
+            repo.requests += 1
+            if self.path == "/index.yaml":
+                body = repo.index().encode("utf8")
+            else:
+                body = repo.archives.get(self.path.lstrip("/"))
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInChartRepo(ThreadingHTTPServer):
+    """
+    An in-process Helm chart repository serving an index.yaml and the chart
+    archives added to it. Use it as a context manager.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _ChartRepoHandler)
+        self.lock = threading.Lock()
+        self.archives = {}
+        self.entries = {}
+        self.requests = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def add(self, chart, version, data, digest=None):
+        """
+        Serve data as the archive of chart version, listed with digest, the
+        sha256 of data by default.
+        """
+        name = "{}-{}.tgz".format(chart, version)
+        with self.lock:
+            self.archives[name] = data
+            self.entries.setdefault(chart, []).append(
+                {
+                    "version": version,
+                    "urls": [name],
+                    "digest": digest or hashlib.sha256(data).hexdigest(),
+                }
+            )
+
+    def index(self):
+        return yaml.safe_dump({"apiVersion": "v1", "entries": self.entries})
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+class _DnsHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        packet, sock = self.request
+        server = self.server
+        qid, flags = struct.unpack(">HH", packet[:4])
+        labels, offset = [], 12
+        while packet[offset]:
+            length = packet[offset]
+            labels.append(packet[offset + 1 : offset + 1 + length].decode("ascii"))
+            offset += 1 + length
+        question = packet[12 : offset + 5]
+        qtype = struct.unpack(">H", packet[offset + 1 : offset + 3])[0]
+        name = ".".join(labels).lower()
+        with server.lock:
+            server.queries.append(name)
+        found = name == server.zone or name.endswith("." + server.zone)
+        answer = b""
+        if found and qtype == 1:
+            answer = b"\xc0\x0c" + struct.pack(">HHIH", 1, 1, server.ttl, 4)
+            answer += socket.inet_aton(server.address)
+        # QR, RD and RA set, NXDOMAIN for names outside the zone
+        flags = 0x8180 | (0 if found else 3)
+        header = struct.pack(">HHHHHH", qid, flags, 1, 1 if answer else 0, 0, 0)
+        sock.sendto(header + question + answer, self.client_address)
+
+
+class StandInDnsServer(socketserver.ThreadingUDPServer):
+    """
+    An in-process DNS server answering A queries for every name in zone with
+    address, and NXDOMAIN for every other name. It stands in for the upstream
+    nameservers of CoreDNS. Use it as a context manager.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self, zone="bench.test", address="10.0.0.1", ttl=30, host="127.0.0.1", port=0
+    ):
+        super().__init__((host, port), _DnsHandler)
+        self.zone = zone
+        self.address = address
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.queries = []
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def make_pod(
+    name, namespace="default", labels=None, state="running", reason=None, containers=1
+):
+    """
+    Returns: a minimal Pod object with its containers in the given state.
+
+    """
+    details = {"reason": reason} if reason else {}
+    names = ["{}-{}".format(name, i) if i else name for i in range(containers)]
+    return {
+        "kind": "Pod",
+        "apiVersion": "v1",
+        "metadata": {"name": name, "namespace": namespace, "labels": labels or {}},
+        "spec": {"containers": [{"name": n} for n in names]},
+        "status": {
+            "containerStatuses": [
+                {"name": n, "state": {state: details}, "ready": state == "running"}
+                for n in names
+            ]
+        },
+    }
+
+
+def make_node(name, ready=True):
+    """
+    Returns: a minimal Node object.
+
+    """
+    return {
+        "kind": "Node",
+        "apiVersion": "v1",
+        "metadata": {"name": name},
+        "status": {
+            "conditions": [{"type": "Ready", "status": "True" if ready else "False"}]
+        },
+    }
+
+
+def make_workload(kind, name, namespace="kube-system", desired=1, available=None):
+    """
+    Returns: a minimal Deployment or DaemonSet object with available of its
+    desired pods updated and available, all of them by default.
+
+    """
+    available = desired if available is None else available
+    if kind == "DaemonSet":
+        spec = {}
+        status = {
+            "desiredNumberScheduled": desired,
+            "updatedNumberScheduled": available,
+            "numberAvailable": available,
+        }
+    else:
+        spec = {"replicas": desired}
+        status = {"updatedReplicas": available, "availableReplicas": available}
+    status["observedGeneration"] = 1
+    return {
+        "kind": kind,
+        "apiVersion": "apps/v1",
+        "metadata": {"name": name, "namespace": namespace, "generation": 1},
+        "spec": spec,
+        "status": status,
+    }
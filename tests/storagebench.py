@@ -0,0 +1,157 @@
+import time
+
+from common import percentile
+from manifests import render_manifest
+from utils import kubectl, wait_for_namespace_termination, wait_for_objects
+
+NAMESPACE = "storage-bench"
+
+
+def parse_io_log(log, io_mb, random_ops):
+    """
+    Returns: {"seq_write_mb_s", "seq_read_mb_s", "rand_write_iops", "start", "end"}
+    out of the log of a benchmark pod. start and end are node uptimes.
+
+    """
+    spans = {}
+    for line in log.splitlines():
+        parts = line.split()
+        if len(parts) == 3:
+            spans[parts[0]] = (float(parts[1]), float(parts[2]))
+
+    def rate(amount, name):
+        start, end = spans[name]
+        return round(amount / max(end - start, 0.01), 1)
+
+    return {
+        "seq_write_mb_s": rate(io_mb, "seq_write"),
+        "seq_read_mb_s": rate(io_mb, "seq_read"),
+        "rand_write_iops": rate(random_ops, "rand_write"),
+        "start": min(start for start, _ in spans.values()),
+        "end": max(end for _, end in spans.values()),
+    }
+
+
+def node_throughput(pods, io_mb):
+    """
+    Returns: {node: stats} for a {pod: (node, parse_io_log result)} dict, with
+    the mean per pod rates and the aggregate write rate of all the pods of
+    each node.
+
+    """
+    nodes = {}
+    for node, stats in pods.values():
+        nodes.setdefault(node, []).append(stats)
+    result = {}
+    for node, runs in nodes.items():
+        window = max(r["end"] for r in runs) - min(r["start"] for r in runs)
+        result[node] = {
+            "pods": len(runs),
+            "aggregate_mb_s": round(len(runs) * io_mb / max(window, 0.01), 1),
+        }
+        for metric in ["seq_write_mb_s", "seq_read_mb_s", "rand_write_iops"]:
+            result[node][metric] = round(sum(r[metric] for r in runs) / len(runs), 1)
+    return result
+
+
+def _time_stats(times):
+    return {
+        "p50": round(percentile(times, 50), 2),
+        "p95": round(percentile(times, 95), 2),
+        "max": round(max(times), 2),
+    }
+
+
+def run_storage_benchmark(
+    count=20, io_mb=64, random_ops=256, reclaim_policy="Delete", timeout_insec=900
+):
+    """
+    Create count PVCs, each with a pod running an I/O job on it, all at once,
+    then delete them all at once.
+
+    Returns: {"provision": {...}, "reclaim": {...}, "io": {node: {...}}} with
+    the provisioning rate and time-to-Bound percentiles, the rate at which the
+    volumes are deleted (reclaim policy Delete) or released (Retain), and the
+    I/O throughput per node
+
+    """
+    names = ["bench-{}".format(i) for i in range(count)]
+    objects = [
+        render_manifest(
+            "storage-bench.yaml", NAME=name, IO_MB=io_mb, RANDOM_OPS=random_ops
+        )
+        for name in names
+    ]
+    kubectl(
+        "apply -f -",
+        input=kubectl("create namespace {} --dry-run=client -o yaml".format(NAMESPACE)),
+    )
+    volumes = {}
+    try:
+        start = time.monotonic()
+        kubectl("apply -f -", input="\n---\n".join(objects))
+        bound = {}
+
+        def all_bound(pvcs):
+            for name, pvc in pvcs.items():
+                if pvc.get("status", {}).get("phase") == "Bound" and name not in bound:
+                    bound[name] = time.monotonic() - start
+                    volumes[name] = pvc["spec"]["volumeName"]
+            return len(bound) == count
+
+        wait_for_objects("pvc", NAMESPACE, all_bound, timeout_insec)
+        provision_time = max(bound.values())
+
+        def all_finished(pods):
+            phases = [p.get("status", {}).get("phase") for p in pods.values()]
+            return len(phases) == count and all(
+                phase in ["Succeeded", "Failed"] for phase in phases
+            )
+
+        wait_for_objects("po", NAMESPACE, all_finished, timeout_insec)
+        pods = {}
+        for name in names:
+            node = kubectl(
+                "get po {} -n {} -o jsonpath={{.spec.nodeName}}".format(name, NAMESPACE)
+            )
+            log = kubectl("logs {} -n {}".format(name, NAMESPACE))
+            pods[name] = (node, parse_io_log(log, io_mb, random_ops))
+
+        start = time.monotonic()
+        kubectl("delete namespace {} --wait=false".format(NAMESPACE))
+        pvs = set(volumes.values())
+
+        def all_reclaimed(current):
+            if reclaim_policy == "Retain":
+                return all(
+                    current[pv].get("status", {}).get("phase") == "Released"
+                    for pv in pvs
+                    if pv in current
+                )
+            return not pvs & set(current)
+
+        wait_for_objects("pv", None, all_reclaimed, timeout_insec)
+        reclaim_time = time.monotonic() - start
+    finally:
+        # Also on failure, so that the next run starts from a clean slate
+        kubectl("delete namespace {} --ignore-not-found --wait=false".format(NAMESPACE))
+        if reclaim_policy == "Retain" and volumes:
+            kubectl(
+                "delete pv --ignore-not-found {}".format(
+                    " ".join(sorted(set(volumes.values())))
+                )
+            )
+        wait_for_namespace_termination(NAMESPACE, timeout_insec)
+
+    return {
+        "provision": dict(
+            volumes_per_s=round(count / provision_time, 2),
+            **_time_stats(list(bound.values()))
+        ),
+        "reclaim": {
+            "policy": reclaim_policy,
+            "volumes_per_s": round(count / reclaim_time, 2),
+            "seconds": round(reclaim_time, 2),
+        },
+        "io": node_throughput(pods, io_mb),
+    }
@@ -34,9 +34,67 @@ from utils import (
     is_multinode,
     run_until_success,
 )
+from addonstatus import StatusEvaluator
+from environment import get_environment
+from manifests import apply_manifest, delete_manifest
+from scheduler import Job, run_jobs
 from subprocess import CalledProcessError, check_call, check_output
 
 TEMPLATES = Path(__file__).absolute().parent / "templates"
+PARALLEL_ADDONS = os.environ.get("PARALLEL_ADDONS") == "True"
+METALLB_IP_RANGES = "192.168.0.105-192.168.0.105,192.168.0.110-192.168.0.111,192.168.1.240/28,fd00:db8:1::/64,fd01:db9::-fd01:db9::1:FFFF"
+
+
+def addon_jobs():
+    """
+    The addons tested by test_addons_parallel, with the requirements and
+    conflicts the scheduler needs to run them side by side on one cluster.
+    """
+
+    def metrics_server():
+        microk8s_enable("metrics-server")
+        validate_metrics_server()
+        microk8s_disable("metrics-server")
+
+    def registry():
+        microk8s_enable("registry")
+        validate_registry()
+        microk8s_disable("registry")
+        microk8s_disable("hostpath-storage:destroy-storage")
+
+    def rbac():
+        microk8s_enable("rbac")
+        validate_rbac()
+        microk8s_disable("rbac")
+
+    def metallb():
+        microk8s_enable("metallb {}".format(METALLB_IP_RANGES), timeout_insec=500)
+        validate_metallb_config(METALLB_IP_RANGES)
+        microk8s_disable("metallb")
+
+    def cert_manager():
+        microk8s_enable("ingress")
+        microk8s_enable("cert-manager")
+        microk8s_enable("host-access:ip=100.100.100.100")
+        validate_cert_manager()
+        microk8s_disable("ingress")
+        microk8s_disable("cert-manager")
+        microk8s_disable("host-access")
+
+    jobs = [
+        Job("dns", lambda: microk8s_enable("dns"), conflicts=["kubelet"]),
+        # Enabling metrics-server may restart the kubelet
+        Job("metrics-server", metrics_server, ["dns"], conflicts=["kubelet"]),
+        # The registry pulls through localhost:32000 and enables hostpath-storage,
+        # keep it apart from the ingress controller holding the node ports
+        Job("registry", registry, ["dns"], conflicts=["ingress", "storage"]),
+        # Turning RBAC on and off restarts the apiserver
+        Job("rbac", rbac, exclusive=True),
+    ]
+    if get_environment().machine == "x86_64":
+        jobs.append(Job("metallb", metallb, ["dns"]))
+        jobs.append(Job("cert-manager", cert_manager, ["dns"], conflicts=["ingress"]))
+    return jobs
 
 
 class TestAddons(object):
@@ -67,6 +125,10 @@ class TestAddons(object):
         expected["dns"] = "enabled"
 
         assert expected == {a["name"]: a["status"] for a in status["addons"]}
+        core = {a["name"] for a in status["addons"] if a.get("repository") == "core"}
+        evaluator = StatusEvaluator()
+        evaluated = evaluator.evaluate()
+        assert {a: expected[a] for a in core} == {a: evaluated[a] for a in core}
 
         for addon in status["addons"]:
             subprocess.check_call(["microk8s", "enable", addon["name"], "--", "--help"])
@@ -79,6 +141,8 @@ class TestAddons(object):
             )
 
         assert expected == {a["name"]: a["status"] for a in status["addons"]}
+        evaluated = evaluator.evaluate()
+        assert {a: expected[a] for a in core} == {a: evaluated[a] for a in core}
 
     @pytest.mark.skipif(
         platform.machine() != "s390x",
@@ -143,15 +207,14 @@ class TestAddons(object):
         microk8s_disable("registry")
         print("Creating test storage class for registry")
         size, storageclass = "25Gi", "registry-test-sc"
-        manifest_sc = TEMPLATES / "registry-sc.yaml"
-        kubectl(f"apply -f {manifest_sc}")
+        apply_manifest("registry-sc.yaml")
         microk8s_enable(f"registry --size={size} --storageclass={storageclass}")
         print("Validating registry with flag arguments")
         validate_registry_custom(size, storageclass)
         print("Disabling custom registry")
         microk8s_disable("registry")
         print("Removing test storage class")
-        kubectl(f"delete -f {manifest_sc}")
+        delete_manifest("registry-sc.yaml")
         print("Validating Port Forward")
         validate_forward()
         print("Validating the Metrics Server")
@@ -266,6 +329,19 @@ class TestAddons(object):
         print("Disabling observability")
         microk8s_disable("observability")
 
+    @pytest.mark.skipif(
+        not PARALLEL_ADDONS,
+        reason="Parallel addon tests are skipped without PARALLEL_ADDONS=True",
+    )
+    def test_addons_parallel(self):
+        """
+        Enable, validate and disable independent addons at the same time.
+        """
+        report = run_jobs(addon_jobs())
+        print(report.format())
+        assert not report.failed
+
+    @pytest.mark.skipif(PARALLEL_ADDONS, reason="Covered by test_addons_parallel")
     def test_rbac_addon(self):
         """
         Test RBAC.
@@ -282,12 +358,12 @@ class TestAddons(object):
         platform.machine() != "x86_64",
         reason="Metallb tests are only relevant in x86 architectures",
     )
+    @pytest.mark.skipif(PARALLEL_ADDONS, reason="Covered by test_addons_parallel")
     def test_metallb_addon(self):
         addon = "metallb"
-        ip_ranges = "192.168.0.105-192.168.0.105,192.168.0.110-192.168.0.111,192.168.1.240/28,fd00:db8:1::/64,fd01:db9::-fd01:db9::1:FFFF"
         print("Enabling metallb")
-        microk8s_enable("{} {}".format(addon, ip_ranges), timeout_insec=500)
-        validate_metallb_config(ip_ranges)
+        microk8s_enable("{} {}".format(addon, METALLB_IP_RANGES), timeout_insec=500)
+        validate_metallb_config(METALLB_IP_RANGES)
         print("Disabling metallb")
         microk8s_disable("metallb")
 
@@ -324,6 +400,7 @@ class TestAddons(object):
         platform.machine() != "x86_64",
         reason="Cert-Manager tests are not available in arm64 architectures yet",
     )
+    @pytest.mark.skipif(PARALLEL_ADDONS, reason="Covered by test_addons_parallel")
     def test_cert_manager_addon(self):
         """
         Test cert-manager.
@@ -0,0 +1,314 @@
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+import bench
+import common
+import dnsbench
+import kubeclient
+import registrybench
+import results as results_store
+import storagebench
+from kubeclient import KubeClient
+from manifests import apply_manifest, delete_manifest
+from standins import StandInApiServer, StandInDnsServer, make_node, make_pod
+from utils import microk8s_disable, microk8s_enable, wait_for_pod_state
+from validators import validate_ingress
+
+HERE = Path(__file__).absolute().parent
+BASELINE = os.environ.get("BENCH_BASELINE", str(HERE / "bench-baseline.json"))
+RESULTS = os.environ.get("BENCH_RESULTS", "bench-results.json")
+INGRESS_RESULTS = os.environ.get("INGRESS_RESULTS", "bench-ingress-results.json")
+
+
+def calls_per_second(fn, duration=2.0):
+    """
+    Call fn repeatedly for duration seconds and return the achieved rate.
+    """
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        fn()
+        calls += 1
+    return calls / (time.perf_counter() - start)
+
+
+class TestBenchmarks(object):
+    @pytest.fixture(scope="class")
+    def apiserver(self, tmp_path_factory):
+        """
+        A stand-in apiserver with a node and a few pods, and a kubeconfig for it.
+        """
+        objects = [make_node("node-1")]
+        objects += [
+            make_pod("pod-{}".format(i), "kube-system", {"app": "bench"})
+            for i in range(20)
+        ]
+        kubeconfig = tmp_path_factory.mktemp("kube") / "client.config"
+        with StandInApiServer(objects) as server:
+            server.write_kubeconfig(kubeconfig)
+            yield server, kubeconfig
+
+    def test_api_client_calls_per_second(self, apiserver):
+        """
+        Compare the pooled API client against a client per call and a process
+        per call, which is what forking kubectl costs at a minimum.
+        """
+        server, kubeconfig = apiserver
+
+        pooled = KubeClient(kubeconfig)
+        pooled_rate = calls_per_second(
+            lambda: pooled.get_resource(
+                "po", namespace="kube-system", label="app=bench"
+            )
+        )
+
+        fresh_rate = calls_per_second(
+            lambda: KubeClient(kubeconfig).get_resource(
+                "po", namespace="kube-system", label="app=bench"
+            )
+        )
+
+        script = (
+            "import sys; sys.path.insert(0, {!r}); from kubeclient import KubeClient; "
+            "KubeClient({!r}).get_resource('po', namespace='kube-system', label='app=bench')"
+        ).format(str(HERE), str(kubeconfig))
+        fork_rate = calls_per_second(
+            lambda: subprocess.check_call([sys.executable, "-c", script])
+        )
+
+        print("Pooled client:       {:8.1f} calls/s".format(pooled_rate))
+        print("Client per call:     {:8.1f} calls/s".format(fresh_rate))
+        print("Process per call:    {:8.1f} calls/s".format(fork_rate))
+        results_store.record_benchmark(
+            "api-client",
+            {
+                "pooled_calls_per_s": pooled_rate,
+                "client_per_call_calls_per_s": fresh_rate,
+                "fork_calls_per_s": fork_rate,
+            },
+        )
+        assert pooled_rate > fork_rate
+
+    def test_pod_state_detection_latency(self, apiserver, monkeypatch):
+        """
+        Time from a pod reaching its state to wait_for_pod_state returning,
+        and the number of apiserver requests made while waiting, with a watch
+        and with polling.
+        """
+        server, kubeconfig = apiserver
+        monkeypatch.setattr(kubeclient, "_client", KubeClient(kubeconfig))
+
+        def detect(watch):
+            server.put(make_pod("latency", state="waiting"))
+            ready_at = []
+
+            def flip():
+                ready_at.append(time.monotonic())
+                server.put(make_pod("latency"))
+
+            threading.Timer(1.3, flip).start()
+            requests_before = server.requests
+            wait_for_pod_state("latency", "default", "running", watch=watch)
+            latency = time.monotonic() - ready_at[0]
+            server.delete("Pod", "latency", "default")
+            return latency, server.requests - requests_before
+
+        measured = {mode: detect(mode == "watch") for mode in ["watch", "poll"]}
+        for mode, (latency, requests) in measured.items():
+            print(
+                "Detection latency ({}): {:.3f}s with {} requests".format(
+                    mode, latency, requests
+                )
+            )
+            results_store.record_benchmark(
+                "pod-state-detection-{}".format(mode),
+                {"latency": latency, "requests": requests},
+            )
+        # The watch sees the change as it happens, polling only on its next
+        # round, 3s apart
+        watch_latency, poll_latency = measured["watch"][0], measured["poll"][0]
+        assert watch_latency < 1 and watch_latency < poll_latency
+
+    @pytest.mark.skipif(
+        os.environ.get("TEST_BENCHMARKS") != "True",
+        reason="Cluster benchmarks are skipped without TEST_BENCHMARKS=True",
+    )
+    def test_addon_time_to_ready(self):
+        """
+        Time enable to ready and disable to teardown for the addons supported on
+        this arch, and compare against the baseline. Set BENCH_ADDONS to a comma
+        separated list to pick addons, BENCH_RUNS for the number of runs and
+        BENCH_SAVE_BASELINE=True to store the results as the new baseline.
+        """
+        addons = bench.supported_addons()
+        if os.environ.get("BENCH_ADDONS"):
+            selected = os.environ["BENCH_ADDONS"].split(",")
+            addons = [a for a in addons if a["name"] in selected]
+        else:
+            addons = [a for a in addons if a["name"] not in bench.SKIP_ADDONS]
+
+        results = bench.run_benchmark(addons, int(os.environ.get("BENCH_RUNS", "3")))
+        baseline = bench.load_results(BASELINE)
+        print(bench.format_results(results, baseline))
+        bench.save_results(RESULTS, results)
+        for addon, metrics in results.items():
+            results_store.record_benchmark("time-to-ready", metrics, addon)
+        if os.environ.get("BENCH_SAVE_BASELINE") == "True":
+            bench.save_results(BASELINE, results)
+
+        regressions = bench.compare_to_baseline(results, baseline)
+        for addon, metric, before, after in regressions:
+            print(
+                "{} {} regressed: {:.1f}s -> {:.1f}s".format(
+                    addon, metric, before, after
+                )
+            )
+        assert not regressions
+
+    @pytest.mark.skipif(
+        os.environ.get("TEST_BENCHMARKS") != "True",
+        reason="Cluster benchmarks are skipped without TEST_BENCHMARKS=True",
+    )
+    @pytest.mark.skipif(platform.machine() == "s390x", reason="Not available on s390x")
+    def test_ingress_load(self):
+        """
+        Load the Traefik ingress with INGRESS_LOAD_CLIENTS keep-alive clients for
+        INGRESS_LOAD_DURATION seconds, and compare against the results of the
+        previous Traefik chart version.
+        """
+        duration = int(os.environ.get("INGRESS_LOAD_DURATION", "30"))
+        clients = int(os.environ.get("INGRESS_LOAD_CLIENTS", "16"))
+        version = bench.script_variable(
+            common.ADDONS_DIR / "ingress" / "enable", "CHART_VERSION"
+        )
+
+        microk8s_enable("ingress")
+        try:
+            result = validate_ingress(load_test=(duration, clients))
+        finally:
+            microk8s_disable("ingress")
+
+        stats = dict(result.as_dict(), clients=clients, duration=duration)
+        previous = bench.record_versioned_result(INGRESS_RESULTS, version, stats)
+        print("Traefik chart {}: {}".format(version, stats))
+        results_store.record_benchmark("ingress-load", stats, "ingress")
+        regressions = bench.compare_load(stats, previous) if previous else []
+        for metric, before, after in regressions:
+            print("{} regressed: {} -> {}".format(metric, before, after))
+        assert result.ok(max_error_rate=0.001)
+        assert not regressions
+
+    @pytest.mark.skipif(
+        os.environ.get("TEST_BENCHMARKS") != "True",
+        reason="Cluster benchmarks are skipped without TEST_BENCHMARKS=True",
+    )
+    @pytest.mark.parametrize("storageclass", [None, "registry-test-sc"])
+    def test_registry_throughput(self, storageclass):
+        """
+        Push and pull synthetic images through the registry, backed by the
+        default hostpath PVC or by a custom storage class. REGISTRY_IMAGES,
+        REGISTRY_LAYERS, REGISTRY_LAYER_MB and REGISTRY_CONCURRENCY shape the load.
+        """
+        enable = "registry"
+        if storageclass:
+            apply_manifest("registry-sc.yaml")
+            enable = "registry --storageclass={}".format(storageclass)
+        microk8s_enable(enable)
+        try:
+            wait_for_pod_state(
+                "", "container-registry", "running", label="app=registry"
+            )
+            results = registrybench.run_registry_benchmark(
+                images=int(os.environ.get("REGISTRY_IMAGES", "4")),
+                layers=int(os.environ.get("REGISTRY_LAYERS", "3")),
+                layer_mb=int(os.environ.get("REGISTRY_LAYER_MB", "10")),
+                concurrency=int(os.environ.get("REGISTRY_CONCURRENCY", "4")),
+            )
+        finally:
+            microk8s_disable("registry")
+            if storageclass:
+                delete_manifest("registry-sc.yaml")
+
+        print("Registry on {}: {}".format(storageclass or "the default PVC", results))
+        results_store.record_benchmark(
+            "registry-{}".format("storageclass" if storageclass else "default"),
+            results,
+            "registry",
+        )
+        assert results["push"]["mb_per_s"] > 0 and results["pull"]["mb_per_s"] > 0
+
+    @pytest.mark.skipif(
+        os.environ.get("TEST_BENCHMARKS") != "True",
+        reason="Cluster benchmarks are skipped without TEST_BENCHMARKS=True",
+    )
+    @pytest.mark.parametrize("reclaim_policy", ["Delete", "Retain"])
+    def test_hostpath_storage_scale(self, reclaim_policy):
+        """
+        Provision STORAGE_VOLUMES hostpath volumes at once, run an I/O job of
+        STORAGE_IO_MB on each, and delete them all at once, with the storage
+        class set to reclaim_policy.
+        """
+        microk8s_enable("hostpath-storage --reclaim-policy={}".format(reclaim_policy))
+        try:
+            wait_for_pod_state(
+                "", "kube-system", "running", label="k8s-app=hostpath-provisioner"
+            )
+            results = storagebench.run_storage_benchmark(
+                count=int(os.environ.get("STORAGE_VOLUMES", "20")),
+                io_mb=int(os.environ.get("STORAGE_IO_MB", "64")),
+                reclaim_policy=reclaim_policy,
+            )
+        finally:
+            microk8s_disable("hostpath-storage:destroy-storage")
+
+        print("hostpath-storage with {}: {}".format(reclaim_policy, results))
+        results_store.record_benchmark(
+            "storage-{}".format(reclaim_policy.lower()), results, "hostpath-storage"
+        )
+        assert results["provision"]["volumes_per_s"] > 0
+
+    @pytest.mark.skipif(
+        os.environ.get("TEST_BENCHMARKS") != "True",
+        reason="Cluster benchmarks are skipped without TEST_BENCHMARKS=True",
+    )
+    def test_coredns_resolution(self):
+        """
+        Load CoreDNS with cluster, search path and upstream names for DNS_DURATION
+        seconds from DNS_CONCURRENCY threads. Upstream names are served by a
+        stand-in nameserver on this host. DNS_VARIANTS is a ; separated list of
+        dns addon arguments to compare, where {upstream} is the stand-in address.
+        """
+        address = dnsbench.upstream_address()
+        variants = os.environ.get("DNS_VARIANTS", "{upstream}").split(";")
+        results = {}
+        try:
+            with StandInDnsServer(host="0.0.0.0", port=53):
+                for variant in variants:
+                    microk8s_disable("dns")
+                    microk8s_enable(
+                        "dns:{}".format(variant.format(upstream=address)),
+                        timeout_insec=500,
+                    )
+                    wait_for_pod_state(
+                        "", "kube-system", "running", label="k8s-app=kube-dns"
+                    )
+                    results[variant] = dnsbench.run_dns_benchmark(
+                        duration=int(os.environ.get("DNS_DURATION", "30")),
+                        concurrency=int(os.environ.get("DNS_CONCURRENCY", "8")),
+                    )
+        finally:
+            microk8s_disable("dns")
+            microk8s_enable("dns", timeout_insec=500)
+
+        print(dnsbench.format_comparison(results))
+        for variant, result in results.items():
+            results_store.record_benchmark("coredns {}".format(variant), result, "dns")
+        for result in results.values():
+            assert result["kinds"]["upstream"]["resolutions"] > 0
@@ -0,0 +1,1166 @@
+import io
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+
+import pytest
+import yaml
+
+import addonstatus
+import bench
+import common
+import dnsbench
+import dnsload
+import environment
+import kubeclient
+import manifests
+import registrybench
+import results
+import retry
+import storagebench
+import timing
+import utils
+from kubeclient import KubeClient
+from probe import ProbeClient
+from scheduler import Job, run_jobs
+from standins import (
+    StandInApiServer,
+    StandInChartRepo,
+    StandInDnsServer,
+    StandInRegistry,
+    make_node,
+    make_pod,
+    make_workload,
+)
+from utils import (
+    run_until_success,
+    wait_for_installation,
+    wait_for_objects,
+    wait_for_pod_state,
+    wait_for_pods,
+)
+from subprocess import CalledProcessError
+
+
+def later(delay, fn, *args):
+    """
+    Call fn(*args) after delay seconds in a background thread.
+    """
+    timer = threading.Timer(delay, fn, args)
+    timer.start()
+    return timer
+
+
+FAKE_KUBECTL = """#!/bin/bash
+# Records the verb and the manifest of each call, exits with $SNAP/exit-<verb>
+verb="$2"
+echo "$verb" >> "$SNAP/calls"
+cat > "$SNAP/last-$verb.yaml"
+exit "$(cat "$SNAP/exit-$verb" 2> /dev/null || echo 0)"
+"""
+
+
+def use_addon_manifest(snap, manifest, action, **values):
+    """
+    Run use_addon_manifest of addons/common/utils.sh against the fake snap of
+    the fake_snap fixture, with arch giving amd64.
+
+    Returns: the completed process, with the output of the function and the
+    value of use_manifest_unchanged as its last line
+
+    """
+    path = os.path.relpath(str(manifest), str(common.ADDONS_DIR))[: -len(".yaml")]
+    items = "".join(
+        "VALUES['${}']={}\n".format(key, shlex.quote(str(value)))
+        for key, value in values.items()
+    )
+    script = """
+arch() {{ echo amd64; }}
+source {utils}
+declare -A VALUES
+{items}use_addon_manifest {path} {action} {values}
+echo "$use_manifest_unchanged"
+exit "$use_manifest_result"
+""".format(
+        utils=shlex.quote(str(common.ADDONS_DIR / "common" / "utils.sh")),
+        items=items,
+        path=shlex.quote(path),
+        action=action,
+        values='"$(declare -p VALUES)"' if values else "",
+    )
+    env = dict(os.environ, SNAP=str(snap), SNAP_DATA=str(snap / "data"))
+    return subprocess.run(
+        ["bash", "-c", script],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+
+
+# Stand-ins for the snap commands the observability enable runs. helm logs when
+# each release starts and ends, sleeps $SNAP/sleep-<release> and exits with
+# $SNAP/exit-<release>. kubectl lists the Prometheus and Alertmanager resources of
+# $SNAP/custom-resources, both by default, and their statefulsets show up on the
+# $SNAP/operator-polls th lookup.
+FAKE_OBSERVABILITY_SNAP = {
+    "usr/bin/python3": """#!/bin/bash
+case "$1" in
+  */charts.py) echo "$4"; echo "--repo=$3" ;;
+esac
+""",
+    "microk8s-helm3.wrapper": """#!/bin/bash
+release="$3"
+echo "start $release" >> "$SNAP/helm"
+sleep "$(cat "$SNAP/sleep-$release" 2> /dev/null || echo 0.3)"
+echo "end $release" >> "$SNAP/helm"
+exit "$(cat "$SNAP/exit-$release" 2> /dev/null || echo 0)"
+""",
+    "microk8s-kubectl.wrapper": """#!/bin/bash
+case "$1 $2" in
+  "get nodes") echo 10.0.0.1 ;;
+  "apply -f") cat > /dev/null ;;
+  "get prometheus,alertmanager")
+    cat "$SNAP/custom-resources" 2> /dev/null || printf "%s\\n" \\
+      prometheus.monitoring.coreos.com/kube-prom-stack-kube-prome-prometheus \\
+      alertmanager.monitoring.coreos.com/kube-prom-stack-kube-prome-alertmanager
+    ;;
+  "get statefulset")
+    echo "$5" >> "$SNAP/polls"
+    [ "$(wc -l < "$SNAP/polls")" -ge "$(cat "$SNAP/operator-polls" 2> /dev/null || echo 1)" ]
+    ;;
+  "get deployment,statefulset,daemonset")
+    echo deployment.apps/kube-prom-stack-grafana
+    echo statefulset.apps/prometheus-kube-prom-stack-kube-prome-prometheus
+    ;;
+  "rollout status")
+    echo "$5 $6" >> "$SNAP/rollouts"
+    exit "$(cat "$SNAP/exit-rollout" 2> /dev/null || echo 0)"
+    ;;
+esac
+""",
+    "actions/common/utils.sh": """
+refresh_opt_in_config() { :; }
+restart_service() { :; }
+""",
+}
+
+
+def enable_observability(snap, *args):
+    """
+    Run the observability enable against a fake snap of FAKE_OBSERVABILITY_SNAP.
+
+    Returns: the completed process, with the output of the enable
+
+    """
+    for path, content in FAKE_OBSERVABILITY_SNAP.items():
+        if not (snap / path).exists():
+            (snap / path).parent.mkdir(parents=True, exist_ok=True)
+            (snap / path).write_text(content)
+            (snap / path).chmod(0o755)
+    return subprocess.run(
+        ["bash", str(common.ADDONS_DIR / "observability" / "enable")] + list(args),
+        env=dict(os.environ, SNAP=str(snap)),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        timeout=60,
+    )
+
+
+class TestHarness(object):
+    """
+    Tests for the harness helpers, run against a stand-in apiserver.
+    """
+
+    @pytest.fixture
+    def fake_snap(self, tmp_path):
+        """
+        A $SNAP with the Python running the tests and a kubectl that records
+        its calls.
+        """
+        snap = tmp_path / "snap"
+        (snap / "usr" / "bin").mkdir(parents=True)
+        (snap / "usr" / "bin" / "python3").symlink_to(sys.executable)
+        (snap / "kubectl").write_text(FAKE_KUBECTL)
+        (snap / "kubectl").chmod(0o755)
+        return snap
+
+    @pytest.fixture
+    def apiserver(self, tmp_path, monkeypatch):
+        kubeconfig = tmp_path / "client.config"
+        with StandInApiServer([make_node("node-1")]) as server:
+            server.write_kubeconfig(kubeconfig)
+            monkeypatch.setattr(kubeclient, "_client", KubeClient(kubeconfig))
+            yield server
+
+    def test_wait_for_pod_state_watch(self, apiserver):
+        apiserver.put(make_pod("web", labels={"app": "web"}, state="waiting"))
+        later(0.3, apiserver.put, make_pod("web", labels={"app": "web"}))
+
+        start = time.monotonic()
+        wait_for_pod_state("", "default", "running", label="app=web", timeout_insec=10)
+        assert time.monotonic() - start < 2
+
+    def test_wait_for_pod_state_resumes_watch(self, apiserver):
+        apiserver.put(make_pod("web", state="waiting"))
+        later(0.3, apiserver.drop_watches)
+        later(0.6, apiserver.put, make_pod("web", state="terminated", reason="Done"))
+
+        wait_for_pod_state("web", "default", "terminated", "Done", timeout_insec=10)
+
+    def test_wait_for_pod_state_timeout(self, apiserver):
+        apiserver.put(make_pod("web", state="waiting"))
+        with pytest.raises(TimeoutError):
+            wait_for_pod_state("web", "default", "running", timeout_insec=1)
+
+    def test_wait_for_missing_pod(self, apiserver):
+        with pytest.raises(CalledProcessError):
+            wait_for_pod_state("web", "default", "running", timeout_insec=1)
+
+    def test_wait_for_pods_barrier(self, apiserver):
+        apiserver.put(make_pod("db", "data", {"app": "db"}))
+        apiserver.put(make_pod("web-1", "apps", {"app": "web"}, containers=2))
+        apiserver.put(make_pod("web-2", "apps", {"app": "web"}, state="waiting"))
+        apiserver.put(make_pod("web-2", "data", {"app": "web"}))
+        later(0.3, apiserver.put, make_pod("web-2", "apps", {"app": "web"}))
+        later(0.3, apiserver.put, make_pod("db", "apps", {"app": "db"}))
+
+        times = wait_for_pods(["app=web", "app=db"], ["apps", "data"], timeout_insec=10)
+        assert set(times) == {
+            "apps/web-1",
+            "apps/web-2",
+            "apps/db",
+            "data/db",
+            "data/web-2",
+        }
+        assert times["apps/web-1"] < times["apps/web-2"] < 2
+        assert wait_for_pods(["app=web"], []) == {}
+
+    def test_wait_for_pods_polls_within_the_deadline(self, monkeypatch):
+        gets = []
+
+        def kubectl_get(target, timeout_insec):
+            gets.append((target, timeout_insec))
+            return {"items": []}
+
+        monkeypatch.setattr(utils, "get_client", lambda: None)
+        monkeypatch.setattr(utils, "kubectl_get", kubectl_get)
+        with pytest.raises(TimeoutError):
+            wait_for_pods(["app=web"], ["default"], timeout_insec=4)
+        # Polled every 3s, each get bounded by the time left
+        assert gets == [
+            ("po -n default --request-timeout=4s", 4),
+            ("po -n default --request-timeout=1s", 1),
+        ]
+
+    def test_wait_for_pods_checks_all_containers(self, apiserver):
+        pod = make_pod("web", labels={"app": "web"}, containers=2)
+        pod["status"]["containerStatuses"][1]["state"] = {"waiting": {}}
+        apiserver.put(pod)
+        with pytest.raises(TimeoutError):
+            wait_for_pods(["app=web"], ["default"], timeout_insec=1)
+
+    def test_wait_for_installation_gate(self, apiserver, capsys):
+        service = {"kind": "Service", "metadata": {"name": "kubernetes"}}
+        service["metadata"]["namespace"] = "default"
+        apiserver.put(service)
+        apiserver.put(make_workload("DaemonSet", "calico-node"))
+        apiserver.put(make_workload("Deployment", "coredns", available=0))
+        apiserver.ready = False
+        later(0.5, setattr, apiserver, "ready", True)
+        later(1.5, apiserver.put, make_workload("Deployment", "coredns"))
+
+        start = time.monotonic()
+        wait_for_installation(timeout_insec=10)
+        assert time.monotonic() - start < 5
+        out = capsys.readouterr().out
+        assert "Waiting for apiserver" in out
+        assert "Waiting for coredns" in out
+
+        apiserver.put(make_node("node-1", ready=False))
+        with pytest.raises(TimeoutError, match="nodes"):
+            wait_for_installation(timeout_insec=1)
+
+    def test_environment_cached_per_boot_and_node_count(
+        self, apiserver, tmp_path, monkeypatch
+    ):
+        probes = []
+        monkeypatch.setenv("TEST_ENVIRONMENT_CACHE", str(tmp_path / "env.json"))
+        monkeypatch.setattr(environment, "probe_container", lambda: probes.append(1))
+        monkeypatch.setattr(environment, "probe_gpu", lambda: False)
+
+        def fresh():
+            monkeypatch.setattr(environment, "_environment", None)
+            return environment.get_environment()
+
+        env = fresh()
+        assert env.nodes == ["node-1"] and not env.is_multinode
+        assert env.boot_id == environment.boot_id()
+        assert fresh().as_dict() == env.as_dict()
+        assert len(probes) == 1
+
+        apiserver.put(make_node("node-2"))
+        assert fresh().is_multinode
+        assert len(probes) == 2
+
+        # A symlink planted at the cache path is replaced, not written through
+        target = tmp_path / "target"
+        (tmp_path / "env.json").unlink()
+        (tmp_path / "env.json").symlink_to(target)
+        fresh()
+        assert not target.exists() and not (tmp_path / "env.json").is_symlink()
+
+    def test_scheduler_respects_requirements_and_conflicts(self):
+        spans = {}
+
+        def work(name):
+            def run():
+                spans[name] = [time.monotonic()]
+                time.sleep(0.2)
+                spans[name].append(time.monotonic())
+
+            return run
+
+        def overlap(a, b):
+            return spans[a][0] < spans[b][1] and spans[b][0] < spans[a][1]
+
+        report = run_jobs(
+            [
+                Job("dns", work("dns")),
+                Job("ingress", work("ingress"), ["dns"]),
+                Job("registry", work("registry"), ["dns"], conflicts=["ingress"]),
+                Job("metallb", work("metallb"), ["dns"]),
+                Job("rbac", work("rbac"), exclusive=True),
+            ]
+        )
+        assert not report.failed
+        assert spans["dns"][1] <= spans["ingress"][0]
+        assert overlap("ingress", "metallb")
+        assert not overlap("ingress", "registry")
+        assert not any(overlap("rbac", job) for job in spans if job != "rbac")
+        assert report.wall_time < report.serial_time
+        path, seconds = report.critical_path()
+        assert path[0] == "dns" and len(path) == 2
+
+    def test_scheduler_skips_dependents_of_failures(self):
+        def fail():
+            raise CalledProcessError(1, "microk8s enable dns")
+
+        report = run_jobs(
+            [
+                Job("dns", fail),
+                Job("ingress", lambda: None, ["dns"]),
+                Job("rbac", lambda: None),
+            ]
+        )
+        assert [job.name for job in report.failed] == ["dns", "ingress"]
+        assert report.jobs["ingress"].skipped
+        assert report.jobs["rbac"].end
+
+    def test_render_manifest_in_memory(self, tmp_path):
+        template = tmp_path / "app.yaml"
+        template.write_text("image: microbot-$ARCH\nsize: $SIZE $SIZEUNIT\n")
+
+        rendered = manifests.render_manifest(
+            "app.yaml", tmp_path, ARCH="arm64", SIZE=2, SIZEUNIT="Gi"
+        )
+        assert rendered == "image: microbot-arm64\nsize: 2 Gi\n"
+        (tmp_path / "other.yaml").write_text("$ARCH $ARCHIVE")
+        assert manifests.render_manifest("other.yaml", tmp_path, ARCH="s390x") == (
+            "s390x $ARCHIVE"
+        )
+        assert "$ARCH" in template.read_text()
+
+        template.write_text("changed")
+        assert manifests.render_manifest("app.yaml", tmp_path, ARCH="amd64") == (
+            "image: microbot-amd64\nsize: $SIZE $SIZEUNIT\n"
+        )
+        assert run_until_success("cat", input=rendered) == rendered.strip()
+
+    def test_probe_client_sampling(self, apiserver):
+        client = ProbeClient()
+        url = apiserver.url + "/readyz"
+        apiserver.ready = False
+        later(0.3, setattr, apiserver, "ready", True)
+        assert client.wait_until_up(url, interval=0.1, timeout_insec=5) > 0
+
+        result = client.sample(url, count=40, concurrency=4)
+        assert result.ok() and result.total == 40
+        assert result.percentile(50) <= result.percentile(99)
+
+        result = client.sample(url, check=lambda resp: "pong" in resp.text)
+        assert result.errors == {"unexpected content": 20} and not result.ok()
+        result.latencies.append(0.01)
+        assert result.ok() and not result.ok(max_error_rate=0.1)
+        assert "20 errors (95.2%)" in result.format()
+        apiserver.ready = False
+        assert client.sample(url, count=5).errors == {"500": 5}
+
+    def test_spans_are_recorded(self, tmp_path, monkeypatch):
+        timings = tmp_path / "timings.jsonl"
+        monkeypatch.setenv("TIMINGS_FILE", str(timings))
+        with timing.addon_context("dns"):
+            run_until_success("true", kind="enable")
+            with pytest.raises(CalledProcessError):
+                run_until_success("false", timeout_insec=0, kind="kubectl")
+
+        records = [json.loads(line) for line in timings.read_text().splitlines()]
+        assert [(r["kind"], r["addon"], r["ok"]) for r in records] == [
+            ("enable", "dns", True),
+            ("kubectl", "dns", False),
+        ]
+        assert records[1]["attempts"] == 1
+        assert "test_spans_are_recorded" in records[0]["test"]
+        assert timing.summarise("addon")["dns"]["enable"][0] >= 1
+
+    def test_run_until_success_streams_stderr(self, tmp_path, monkeypatch):
+        written = []
+
+        class Recorder(io.StringIO):
+            def write(self, text):
+                written.append((time.monotonic(), text))
+                return len(text)
+
+        monkeypatch.setattr(sys, "stderr", Recorder())
+        script = tmp_path / "cmd"
+        script.write_text(
+            "#!/bin/bash\necho progress >&2\nsleep 1\necho done\n"
+            'echo "$1" >&2\nexit "$2"\n'
+        )
+        script.chmod(0o755)
+
+        start = time.monotonic()
+        assert run_until_success("{} finished 0".format(script)) == "done"
+        # Written as the command runs, not once it is done
+        assert written[0][1] == "progress\n" and written[0][0] - start < 0.8
+        assert written[-1][1] == "finished\n"
+
+        # And still captured to classify errors
+        with pytest.raises(CalledProcessError) as err:
+            run_until_success("{} NotFound 1".format(script), timeout_insec=0)
+        assert err.value.stderr == b"progress\nNotFound\n"
+
+    def test_benchmark_statistics(self):
+        stats = bench.summarise_runs({"enable": [3.0, 1.0, 2.0, 10.0]})
+        assert stats["enable"] == {"median": 2.5, "p95": 10.0, "runs": 4}
+
+        baseline = {"dns": {"enable": {"median": 2.0}, "ready": {"median": 5.0}}}
+        results = {
+            "dns": {"enable": {"median": 2.5}, "ready": {"median": 5.5}},
+            "registry": {"enable": {"median": 9.0}},
+        }
+        assert bench.compare_to_baseline(results, baseline) == [
+            ("dns", "enable", 2.0, 2.5)
+        ]
+
+    def test_versioned_load_results(self, apiserver, tmp_path):
+        enable = common.ADDONS_DIR / "ingress" / "enable"
+        assert bench.version_key(bench.script_variable(enable, "CHART_VERSION"))
+
+        client = ProbeClient(pool_maxsize=4)
+        result = client.load(apiserver.url + "/readyz", duration=0.5, concurrency=4)
+        assert result.rps > 0 and not result.errors
+        stats = result.as_dict()
+
+        path = tmp_path / "ingress.json"
+        assert bench.record_versioned_result(path, "39.0.8", stats) is None
+        assert bench.record_versioned_result(path, "40.0.0", stats) == stats
+        assert bench.record_versioned_result(path, "39.1.0", stats) == stats
+        slower = dict(stats, rps=stats["rps"] / 2, error_rate=0.1)
+        assert [r[0] for r in bench.compare_load(slower, stats)] == [
+            "rps",
+            "error_rate",
+        ]
+
+    def test_registry_benchmark(self, apiserver):
+        with StandInRegistry() as registry:
+            results = registrybench.run_registry_benchmark(
+                images=3, layers=2, layer_mb=1, concurrency=2, registry=registry.url
+            )
+            assert len(registry.blobs) == 3 * 3
+        assert results["push"]["mb_per_s"] > 0 and results["pull"]["mb_per_s"] > 0
+        assert results["pull"]["layer_p50"] <= results["pull"]["layer_p95"]
+        # The stand-in apiserver serves no metrics API
+        assert results["cpu_cores"] is None
+        assert registrybench.parse_quantity("250m") == 0.25
+        assert registrybench.parse_quantity("64Mi") == 64 * registrybench.MB
+
+    def test_wait_for_objects(self, apiserver):
+        def pvc(name, phase):
+            return {
+                "kind": "PersistentVolumeClaim",
+                "metadata": {"name": name, "namespace": "bench"},
+                "status": {"phase": phase},
+            }
+
+        apiserver.put(pvc("a", "Bound"))
+        apiserver.put(pvc("b", "Pending"))
+        later(0.3, apiserver.put, pvc("b", "Bound"))
+        later(0.4, apiserver.drop_watches)
+        later(0.6, apiserver.put, pvc("c", "Bound"))
+        seen = {}
+
+        def all_bound(pvcs):
+            for name, obj in pvcs.items():
+                if obj["status"]["phase"] == "Bound":
+                    seen.setdefault(name, time.monotonic())
+            return len(seen) == 3
+
+        wait_for_objects("pvc", "bench", all_bound, timeout_insec=10)
+        assert seen["a"] < seen["b"] < seen["c"]
+        with pytest.raises(TimeoutError):
+            wait_for_objects("pvc", "bench", lambda pvcs: False, timeout_insec=1)
+
+    def test_storage_benchmark_io_stats(self):
+        log = "seq_write 100.0 102.0\nseq_read 102.0 102.5\nrand_write 102.5 112.5\n"
+        stats = storagebench.parse_io_log(log, io_mb=64, random_ops=200)
+        assert stats == {
+            "seq_write_mb_s": 32.0,
+            "seq_read_mb_s": 128.0,
+            "rand_write_iops": 20.0,
+            "start": 100.0,
+            "end": 112.5,
+        }
+        other = dict(stats, seq_write_mb_s=16.0, start=101.0, end=116.0)
+        nodes = storagebench.node_throughput(
+            {"a": ("node-1", stats), "b": ("node-1", other), "c": ("node-2", stats)},
+            io_mb=64,
+        )
+        assert nodes["node-1"]["pods"] == 2
+        assert nodes["node-1"]["seq_write_mb_s"] == 24.0
+        assert nodes["node-1"]["aggregate_mb_s"] == 8.0
+        assert nodes["node-2"]["aggregate_mb_s"] == 5.1
+
+    def test_dns_load_against_stand_in_upstream(self):
+        names = [
+            ("upstream", "host-1.bench.test."),
+            ("search", "host-2.bench.test"),
+            ("missing", "host.example."),
+        ]
+        with StandInDnsServer() as upstream:
+            result = dnsload.run_load(
+                "127.0.0.1",
+                names,
+                duration=0.5,
+                concurrency=2,
+                port=upstream.port,
+                search=(["svc.cluster.local"], 5),
+            )
+            assert "host-2.bench.test.svc.cluster.local" in upstream.queries
+        kinds = result["kinds"]
+        assert kinds["upstream"]["resolutions"] > 0 and not kinds["upstream"]["errors"]
+        assert kinds["search"]["resolutions"] > 0
+        assert kinds["missing"]["errors"] > 0 and not kinds["missing"]["resolutions"]
+        assert result["qps"] > result["resolutions_per_s"]
+
+        metrics = dnsbench.parse_metrics(
+            "# TYPE coredns_cache_hits_total counter\n"
+            'coredns_cache_hits_total{server="dns://:53",type="success"} 30\n'
+            'coredns_cache_hits_total{server="dns://:53",type="denial"} 10\n'
+            'coredns_cache_misses_total{server="dns://:53"} 10\n'
+        )
+        zero = {metric: 0.0 for metric in dnsbench.CACHE_METRICS}
+        assert dnsbench.cache_hit_ratio(zero, metrics) == 0.8
+
+    def test_results_regressions_and_flaky_tests(self, tmp_path, capsys):
+        path = tmp_path / "results.db"
+        for i, wall in enumerate([10, 11, 9, 10, 10.5, 9.5, 21]):
+            version = "3.6.2" if i < 6 else "3.7.0"
+            flaky = {"test": {"t::flaky": {"enable": (1, 1 + i % 2, 0.0, 1.0)}}}
+            results.record_session(
+                path,
+                {"t::flaky": {"duration": 1.0, "passed": 1}},
+                dict(flaky, addon={}),
+                [("time-to-ready", "ingress", {"enable.median": wall})],
+            )
+            results.pending.clear()
+            store = results.ResultsStore(path)
+            store.db.execute(
+                "UPDATE measurements SET addon_version = ? WHERE run_id = ?",
+                (version, i + 1),
+            )
+            store.commit()
+            store.close()
+
+        store = results.ResultsStore(path)
+        found = results.find_regressions(store)
+        assert [(r["name"], r["metric"], r["latest"]) for r in found] == [
+            ("time-to-ready", "enable.median", 21)
+        ]
+        assert found[0]["version_change"] == "3.6.2 -> 3.7.0"
+        assert results.find_flaky(store) == [("t::flaky", 7, 3 / 7, 0.0)]
+        store.close()
+
+        assert results.main(["--db", str(path), "regressions"]) == 1
+        assert results.main(["--db", str(path), "trend", "--addon", "ingress"]) == 0
+        out = capsys.readouterr().out
+        assert "addon version 3.6.2 -> 3.7.0" in out
+        assert out.count("time-to-ready") == 1 + 7
+
+    def test_supported_addons(self):
+        names = [a["name"] for a in bench.supported_addons("s390x")]
+        assert "dns" in names and "ingress" not in names
+
+    def test_addon_status_in_one_list_per_resource(self, apiserver, tmp_path):
+        (tmp_path / "lock").mkdir()
+        (tmp_path / "lock" / "ha-cluster").touch()
+        addons = [
+            {"name": "dns", "check_status": "pod/coredns"},
+            {"name": "metrics-server", "check_status": "pod/metrics-server"},
+            {"name": "registry", "check_status": "deployment.apps/registry"},
+            {"name": "mayastor", "check_status": "daemonset.apps/mayastor"},
+            {"name": "nvidia", "check_status": "operator-node-feature-discovery"},
+            {"name": "ingress", "check_status": "ingressclass.networking.k8s.io/x"},
+            {"name": "ha-cluster", "check_status": "${SNAP_DATA}/lock/ha-cluster"},
+        ]
+        apiserver.put(make_pod("coredns-abc", "kube-system"))
+        apiserver.put(make_workload("Deployment", "registry", "container-registry"))
+        evaluator = addonstatus.StatusEvaluator(
+            addons, snap_paths={"SNAP_DATA": str(tmp_path)}
+        )
+
+        expected = {
+            "dns": "enabled",
+            "metrics-server": "disabled",
+            "registry": "enabled",
+            "mayastor": "disabled",
+            "nvidia": "disabled",
+            "ingress": "disabled",
+            "ha-cluster": "enabled",
+        }
+        assert evaluator.evaluate() == expected
+        apiserver.put(make_workload("DaemonSet", "gpu-operator-node-feature-discovery"))
+        expected["nvidia"] = "enabled"
+        requests = apiserver.requests
+        assert evaluator.evaluate() == expected
+        # pod, deployment.apps, daemonset.apps and statefulset.apps, once each
+        assert apiserver.requests - requests == 4
+
+    def test_render_addon_manifest(self, tmp_path, fake_snap):
+        render = common.load_addon_module("common/render.py")
+        template = "image: app-$ARCH\nsize: $SIZE\narchive: $ARCHIVE\n"
+        values = {"$ARCH": "arm64", "$SIZE": "$ARCH", "$ARCHIVE": "x.tgz"}
+        # One pass: values are not substituted again, and $ARCH does not
+        # clobber $ARCHIVE
+        assert render.render(template, values) == (
+            "image: app-arm64\nsize: $ARCH\narchive: x.tgz\n"
+        )
+        with pytest.raises(render.RenderError, match=r"\$ARCHIVE, \$SIZE"):
+            render.render(template, {"$ARCH": "arm64"})
+        assert render.render(template, {}, allow_unset=True) == template
+        with pytest.raises(render.RenderError):
+            render.parse_values(["SIZE=1"])
+
+        manifest = tmp_path / "app.yaml"
+        manifest.write_text(template)
+        args = [str(manifest), "--digest", "$SIZE=1", "$ARCHIVE=x"]
+        assert render.main(args + ["--allow-unset"]) == 0
+        assert render.main(args) == 1
+
+        # use_addon_manifest injects $ARCH
+        result = use_addon_manifest(fake_snap, manifest, "apply", SIZE=1, ARCHIVE="x")
+        assert result.returncode == 0, result.stdout
+        assert (fake_snap / "last-apply.yaml").read_text() == (
+            "image: app-amd64\nsize: 1\narchive: x\n"
+        )
+        result = use_addon_manifest(fake_snap, manifest, "apply", ARCHIVE="x")
+        assert result.returncode == 1 and "No value for $SIZE" in result.stdout
+
+    def test_use_addon_manifest_skips_only_unchanged_objects(self, tmp_path, fake_snap):
+        manifest = tmp_path / "app.yaml"
+        manifest.write_text("image: app-$ARCH\nsize: $SIZE\n")
+
+        def apply(size):
+            result = use_addon_manifest(fake_snap, manifest, "apply", SIZE=size)
+            assert result.returncode == 0, result.stdout
+            calls = (fake_snap / "calls").read_text().split()
+            (fake_snap / "calls").unlink()
+            return calls, result.stdout.split()[-1]
+
+        assert apply(1) == (["apply"], "false")
+        # Same values and no drift
+        assert apply(1) == (["diff"], "true")
+        # Changed values
+        assert apply(2) == (["apply"], "false")
+        # Live objects drifted from the manifest, or the diff failed
+        for code in ["1", "2"]:
+            (fake_snap / "exit-diff").write_text(code)
+            assert apply(2) == (["diff", "apply"], "false")
+        (fake_snap / "exit-diff").unlink()
+        assert apply(2) == (["diff"], "true")
+
+        # A failed apply is not recorded, and a delete forgets the digest
+        (fake_snap / "exit-apply").write_text("1")
+        result = use_addon_manifest(fake_snap, manifest, "apply", SIZE=3)
+        assert result.returncode == 1
+        (fake_snap / "exit-apply").unlink()
+        (fake_snap / "calls").unlink()
+        assert apply(3) == (["apply"], "false")
+        assert use_addon_manifest(fake_snap, manifest, "delete").returncode == 0
+        (fake_snap / "calls").unlink()
+        assert apply(3) == (["apply"], "false")
+
+    def test_observability_releases_and_readiness_barrier(self, tmp_path):
+        def enable(*args, **files):
+            snap = tmp_path / str(len(list(tmp_path.iterdir())))
+            snap.mkdir()
+            for name, content in files.items():
+                (snap / name.replace("_", "-")).write_text(content)
+            result = enable_observability(snap, *args)
+
+            def read(name):
+                path = snap / name
+                return path.read_text().splitlines() if path.exists() else []
+
+            return result, read("helm"), read("rollouts"), read("polls")
+
+        def timeouts(rollouts):
+            return [int(rollout.split("--timeout=")[1][:-1]) for rollout in rollouts]
+
+        releases = ["kube-prom-stack", "loki", "tempo"]
+        result, helm, rollouts, polls = enable()
+        assert result.returncode == 0, result.stdout
+        assert helm[:3] == ["start " + release for release in releases]
+        assert [rollout.split()[0] for rollout in rollouts] == [
+            "deployment.apps/kube-prom-stack-grafana",
+            "statefulset.apps/prometheus-kube-prom-stack-kube-prome-prometheus",
+        ]
+        assert all(595 <= timeout <= 600 for timeout in timeouts(rollouts))
+        assert polls == [
+            "prometheus-kube-prom-stack-kube-prome-prometheus",
+            "alertmanager-kube-prom-stack-kube-prome-alertmanager",
+        ]
+
+        result, helm, _, _ = enable("--max-parallel=1", "--without-tempo")
+        assert result.returncode == 0, result.stdout
+        assert helm == [
+            "start kube-prom-stack",
+            "end kube-prom-stack",
+            "start loki",
+            "end loki",
+        ]
+
+        # A failed release is reported once the others are done, with its output
+        result, helm, rollouts, _ = enable(exit_loki="1", sleep_loki="0")
+        assert result.returncode == 1
+        assert "Failed to install loki" in result.stdout
+        assert "Installed kube-prom-stack" in result.stdout
+        assert "Installed tempo" in result.stdout
+        assert len(helm) == 6 and rollouts == []
+
+        # The barrier waits for the statefulsets of the operator, within one deadline
+        result, _, rollouts, _ = enable("--ready-timeout=30", operator_polls="2")
+        assert result.returncode == 0, result.stdout
+        assert len(rollouts) == 2 and max(timeouts(rollouts)) <= 28
+        result, _, rollouts, _ = enable("--ready-timeout=1", operator_polls="99")
+        assert result.returncode == 1 and rollouts == []
+        assert (
+            "Timed out waiting for statefulset "
+            "prometheus-kube-prom-stack-kube-prome-prometheus"
+        ) in result.stdout
+        # Alertmanager disabled by the chart values
+        result, _, _, polls = enable(
+            custom_resources="prometheus.monitoring.coreos.com/main\n"
+        )
+        assert result.returncode == 0, result.stdout
+        assert polls == ["prometheus-main"]
+
+        # A workload that does not roll out fails the enable, naming it
+        result, _, rollouts, _ = enable(exit_rollout="1")
+        assert result.returncode == 1 and len(rollouts) == 1
+        assert "deployment.apps/kube-prom-stack-grafana did not become ready" in (
+            result.stdout
+        )
+
+        for arg in ["--max-parallel=0", "--max-parallel=x", "--ready-timeout=0"]:
+            result, helm, _, _ = enable(arg)
+            assert result.returncode == 1 and helm == []
+            assert "must be a positive number" in result.stdout
+
+    def test_apply_splits_metallb_manifests(self, monkeypatch):
+        apply = common.load_addon_module("common/apply.py")
+        metallb = common.ADDONS_DIR / "metallb"
+        # As the metallb enable substitutes the address ranges
+        addresses = "addresses:\n      - 10.64.140.43-10.64.140.49\n      - fd00::/64"
+        pool = (metallb / "addresspool.yaml").read_text()
+        monkeypatch.setattr(
+            "sys.stdin", io.StringIO(pool.replace("{{addresses}}", addresses))
+        )
+        docs = apply.load(str(metallb / "crd.yaml")) + apply.load(
+            str(metallb / "metallb.yaml")
+        )
+        docs += apply.load("-")
+
+        crds, resources, custom = apply.split(docs)
+        assert len(crds) == 8
+        assert {c["spec"]["group"] for c in crds} == {"metallb.io"}
+        assert [(r["kind"], r["metadata"]["name"]) for r in custom] == [
+            ("IPAddressPool", "default-addresspool"),
+            ("L2Advertisement", "default-advertise-all-pools"),
+        ]
+        assert custom[0]["spec"]["addresses"] == [
+            "10.64.140.43-10.64.140.49",
+            "fd00::/64",
+        ]
+        kinds = {r["kind"] for r in resources}
+        assert {"Namespace", "Deployment", "ValidatingWebhookConfiguration"} <= kinds
+        assert not kinds & {"CustomResourceDefinition", "IPAddressPool"}
+        assert len(crds) + len(resources) + len(custom) == len(docs)
+
+        # Lists are flattened, and custom resources of CRDs that are not part
+        # of the batch are applied with everything else
+        monkeypatch.setattr(
+            "sys.stdin",
+            io.StringIO(
+                yaml.safe_dump(
+                    {"kind": "List", "items": custom + [{"kind": "ConfigMap"}]}
+                )
+            ),
+        )
+        assert apply.split(apply.load("-")) == (
+            [],
+            custom + [{"kind": "ConfigMap"}],
+            [],
+        )
+
+    def test_apply_retries_webhooks_and_reports_watch_errors(
+        self, tmp_path, monkeypatch
+    ):
+        apply = common.load_addon_module("common/apply.py")
+        kubectl = tmp_path / "kubectl"
+        kubectl.write_text(
+            """#!/bin/bash
+# Rejects the first $FAKE_DIR/rejections applies as a webhook not serving yet
+if [ "$1" = get ]; then
+  [ "$2" = slow ] && exec sleep 10
+  echo "error: the server doesn't have a resource type \\"$2\\"" >&2
+  exit 1
+fi
+cat > /dev/null
+echo >> "$FAKE_DIR/applies"
+if [ -f "$FAKE_DIR/error" ]; then
+  cat "$FAKE_DIR/error"
+  exit 1
+fi
+if [ "$(wc -l < "$FAKE_DIR/applies")" -le "$(cat "$FAKE_DIR/rejections")" ]; then
+  echo 'Error from server (InternalError): failed calling webhook "pool": EOF'
+  exit 1
+fi
+"""
+        )
+        kubectl.chmod(0o755)
+        monkeypatch.setattr(apply, "KUBECTL", str(kubectl))
+        monkeypatch.setenv("FAKE_DIR", str(tmp_path))
+        pool = [{"apiVersion": "metallb.io/v1beta1", "kind": "IPAddressPool"}]
+
+        def applies(rejections, timeout=10):
+            (tmp_path / "rejections").write_text(str(rejections))
+            try:
+                apply.apply_custom(pool, timeout, interval=0.01)
+            finally:
+                calls.append(len((tmp_path / "applies").read_text().splitlines()))
+                (tmp_path / "applies").unlink()
+
+        calls = []
+        applies(0)
+        applies(2)
+        with pytest.raises(apply.ApplyError, match="Timed out"):
+            applies(1000, timeout=0.1)
+        assert calls[:2] == [1, 3] and calls[2] > 3
+        # Other errors are not retried
+        (tmp_path / "error").write_text("The IPAddressPool is invalid")
+        with pytest.raises(apply.ApplyError) as err:
+            applies(0)
+        assert calls[3] == 1 and "is invalid" in err.value.output
+
+        # A watch kubectl gives up on reports why, rather than a timeout
+        start = time.monotonic()
+        with pytest.raises(apply.ApplyError) as err:
+            apply.watch("nope", lambda objects: False, 10)
+        assert time.monotonic() - start < 5
+        assert "exited with 1" in str(err.value)
+        assert 'resource type "nope"' in str(err.value)
+        with pytest.raises(apply.ApplyError, match="Timed out waiting for slow"):
+            apply.watch("slow", lambda objects: False, 0.2)
+
+    def test_plan_addon_requirements(self):
+        plan = common.load_addon_module("common/plan.py")
+        catalogue = {
+            "dns": {},
+            "helm3": {},
+            "hostpath-storage": {"requires": ["dns"]},
+            "observability": {"requires": ["helm3", "hostpath-storage"]},
+            "cert-manager": {"requires": ["core/dns", "helm3"]},
+            "ingress": {"conflicts": ["traefik"]},
+            "traefik": {"conflicts": ["ingress"]},
+        }
+        assert plan.qualify("dns") == "core/dns"
+        assert plan.qualify("community/argocd") == "community/argocd"
+        assert plan.requirements("core/cert-manager", catalogue) == [
+            "core/dns",
+            "core/helm3",
+        ]
+        assert plan.requirements("community/cert-manager", catalogue) == []
+
+        assert plan.plan(["observability", "core/cert-manager"], catalogue) == [
+            ["core/dns", "core/helm3"],
+            ["core/cert-manager", "core/hostpath-storage"],
+            ["core/observability"],
+        ]
+        # Enabled addons are skipped, along with the layers they made needed
+        assert plan.plan(["observability"], catalogue, {"dns", "core/helm3"}) == [
+            ["core/hostpath-storage"],
+            ["core/observability"],
+        ]
+        assert plan.plan(["dns"], catalogue, {"core/dns"}) == []
+
+        with pytest.raises(plan.PlanError, match="conflicts"):
+            plan.plan(["ingress", "traefik"], catalogue)
+        with pytest.raises(plan.PlanError, match="conflicts"):
+            plan.plan(["traefik"], catalogue, {"core/ingress"})
+        catalogue["dns"] = {"requires": ["observability"]}
+        with pytest.raises(plan.PlanError, match="Circular"):
+            plan.plan(["hostpath-storage"], catalogue)
+
+        addons = plan.load_catalogue(common.ADDONS_YAML)
+        for name, addon in addons.items():
+            for other in addon.get("requires", []) + addon.get("conflicts", []):
+                assert other in addons, (name, other)
+        assert plan.plan(["observability"], addons)[-1] == ["core/observability"]
+
+    def test_catalogue_index_is_rebuilt_only_on_change(self, tmp_path, monkeypatch):
+        catalogue = common.load_addon_module("common/catalogue.py")
+        addons_yaml = tmp_path / "addons.yaml"
+        index = tmp_path / "index.json"
+
+        def write(*addons):
+            entries = [
+                {"name": name, "supported_architectures": arches}
+                for name, arches in addons
+            ]
+            addons_yaml.write_text(
+                yaml.safe_dump({"microk8s-addons": {"addons": entries}})
+            )
+
+        compiled = []
+        compile_index = catalogue.compile_index
+        monkeypatch.setattr(
+            catalogue,
+            "compile_index",
+            lambda *args: compiled.append(1) or compile_index(*args),
+        )
+
+        write(("dns", ["amd64", "arm64"]), ("nvidia", ["amd64"]))
+        loaded = catalogue.load(addons_yaml, index)
+        assert [a["name"] for a in loaded.for_arch("amd64")] == ["dns", "nvidia"]
+        assert [a["name"] for a in loaded.for_arch("arm64")] == ["dns"]
+        assert loaded.for_arch("s390x") == []
+        assert len(compiled) == 1 and index.exists()
+
+        # Unchanged, or only touched: the index is reused
+        catalogue.load(addons_yaml, index)
+        os.utime(str(addons_yaml), ns=(0, 10**9))
+        assert catalogue.load(addons_yaml, index).by_name.keys() == {"dns", "nvidia"}
+        assert len(compiled) == 1
+        assert json.loads(index.read_text())["mtime_ns"] == 10**9
+
+        # Edited: the index is rebuilt
+        write(("dns", ["amd64", "arm64"]), ("nvidia", ["amd64", "arm64"]))
+        loaded = catalogue.load(addons_yaml, index)
+        assert len(compiled) == 2
+        assert [a["name"] for a in loaded.for_arch("arm64")] == ["dns", "nvidia"]
+        # A corrupted index is rebuilt too
+        index.write_text("{")
+        assert catalogue.load(addons_yaml, index).by_name.keys() == {"dns", "nvidia"}
+        assert len(compiled) == 3
+
+        # An index others could have planted or written is not trusted
+        index.chmod(0o666)
+        catalogue.load(addons_yaml, index)
+        assert len(compiled) == 4 and index.stat().st_mode & 0o777 == 0o600
+        if os.geteuid() == 0:
+            os.chown(str(index), 65534, 65534)
+            catalogue.load(addons_yaml, index)
+            assert len(compiled) == 5 and index.stat().st_uid == 0
+
+        # By default, in a private per-user directory
+        monkeypatch.delenv("SNAP_USER_COMMON", raising=False)
+        monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+        path = catalogue.cache_path(addons_yaml)
+        assert path.parent == tmp_path / "cache" / "microk8s-addons"
+        catalogue.load(addons_yaml)
+        assert path.exists() and path.parent.stat().st_mode & 0o777 == 0o700
+
+    def test_chart_cache_against_stand_in_repo(self, tmp_path):
+        charts = common.load_addon_module("common/charts.py")
+        cache = charts.ChartCache(tmp_path / "charts", max_bytes=250)
+        with StandInChartRepo() as repo:
+            repo.add("app", "1.0.0", b"a" * 100)
+            repo.add("app", "1.1.0", b"b" * 100)
+            repo.add("bad", "1.0.0", b"c" * 100, digest="0" * 64)
+            path = cache.fetch(repo.url, "app", "v1.0.0")
+            assert path.read_bytes() == b"a" * 100
+            requests = repo.requests
+            # Served from the cache without the network, by any spelling of
+            # the version
+            assert cache.fetch(repo.url + "/", "app", "1.0.0") == path
+            assert repo.requests == requests
+            with pytest.raises(charts.ChartError):
+                cache.fetch(repo.url, "bad", "1.0.0")
+            with pytest.raises(charts.ChartError):
+                cache.fetch(repo.url, "app", "2.0.0")
+            assert charts.helm_args(cache, repo.url, "app", "2.0.0") == [
+                "app",
+                "--repo={}".format(repo.url),
+                "--version=2.0.0",
+            ]
+            # A malformed repository reply falls back to the repository too
+            repo.entries["broken"] = [{"version": "1.0.0"}]
+            assert charts.helm_args(cache, repo.url, "broken", "1.0.0")[0] == "broken"
+
+            # A corrupted archive is fetched again
+            path.write_bytes(b"x")
+            assert cache.fetch(repo.url, "app", "1.0.0").read_bytes() == b"a" * 100
+            cache.fetch(repo.url, "app", "1.1.0")
+
+        bundle = tmp_path / "bundle"
+        bundle.mkdir()
+        (bundle / "other.tgz").write_bytes(b"d" * 100)
+        (bundle / "charts.yaml").write_text(
+            yaml.safe_dump(
+                {
+                    "charts": [
+                        {
+                            "repository": repo.url,
+                            "chart": "other",
+                            "version": "3.0.0",
+                            "file": "other.tgz",
+                        }
+                    ]
+                }
+            )
+        )
+        assert cache.import_bundle(bundle) == 1
+        # The least recently used chart was evicted to stay under 250 bytes,
+        # and the rest are served with the repository down
+        assert cache.get(repo.url, "app", "1.0.0") is None
+        blobs = {p.name for p in (tmp_path / "charts" / "blobs").iterdir()}
+        assert blobs == {
+            cache.blob(charts.sha256(data)).name for data in [b"b" * 100, b"d" * 100]
+        }
+        assert charts.helm_args(cache, repo.url, "other", "3.0.0") == [
+            str(cache.blob(charts.sha256(b"d" * 100)))
+        ]
+
+    def test_vendor_locked_chart_dependencies(self, tmp_path):
+        charts = common.load_addon_module("common/charts.py")
+        cache = charts.ChartCache(tmp_path / "cache")
+        chart = tmp_path / "chart"
+        chart.mkdir()
+        with StandInChartRepo() as repo:
+            repo.add("etcd", "0.0.1", b"etcd")
+            repo.add("engine", "2.0.0", b"engine")
+
+            def write_chart(*dependencies):
+                chart_yaml = {
+                    "apiVersion": "v2",
+                    "name": "aio",
+                    "version": "1.0.0",
+                    "dependencies": [
+                        {"name": name, "version": version, "repository": repo.url}
+                        for name, version in dependencies
+                    ],
+                }
+                (chart / "Chart.yaml").write_text(yaml.safe_dump(chart_yaml))
+
+            write_chart(("etcd", "0.0.1"))
+            assert not charts.vendor(chart, cache)
+            assert (chart / "charts" / "etcd-0.0.1.tgz").read_bytes() == b"etcd"
+            requests = repo.requests
+            assert charts.vendor(chart, cache)
+            assert repo.requests == requests
+
+            # A changed Chart.yaml is vendored again, dropping stale archives
+            write_chart(("engine", "2.0.0"))
+            assert not charts.vendor(chart, cache)
+            assert [p.name for p in (chart / "charts").iterdir()] == [
+                "engine-2.0.0.tgz"
+            ]
+
+        # A tampered archive is restored from the cache, with the repo down
+        (chart / "charts" / "engine-2.0.0.tgz").write_bytes(b"x")
+        assert not charts.vendor(chart, cache)
+        assert (chart / "charts" / "engine-2.0.0.tgz").read_bytes() == b"engine"
+        assert charts.vendor(chart, cache)
+
+    def test_chart_bundle_import_refuses_unsafe_members(self, tmp_path, monkeypatch):
+        charts = common.load_addon_module("common/charts.py")
+        cache = charts.ChartCache(tmp_path / "charts")
+        charts_yaml = yaml.safe_dump({"charts": []}).encode("utf8")
+
+        def bundle(name, member):
+            path = tmp_path / name
+            with tarfile.open(str(path), "w:gz") as tar:
+                info = tarfile.TarInfo("charts.yaml")
+                info.size = len(charts_yaml)
+                tar.addfile(info, io.BytesIO(charts_yaml))
+                tar.addfile(member, io.BytesIO(b"evil") if member.size else None)
+            return path
+
+        escape = tarfile.TarInfo("../escaped")
+        escape.size = 4
+        link = tarfile.TarInfo("link")
+        link.type = tarfile.SYMTYPE
+        link.linkname = str(tmp_path / "target")
+        unsafe = [bundle("escape.tgz", escape), bundle("link.tgz", link)]
+
+        for filtered in [True, False]:
+            if not filtered:
+                # Pythons without extraction filters
+                monkeypatch.delattr(tarfile, "data_filter")
+            for path in unsafe:
+                with pytest.raises(charts.ChartError):
+                    cache.import_bundle(path)
+            assert not list(tmp_path.glob("**/escaped"))
+        safe = tarfile.TarInfo("app.tgz")
+        safe.size = 4
+        assert cache.import_bundle(bundle("safe.tgz", safe)) == 0
+
+    def test_retry_classifies_errors(self):
+        assert (
+            retry.classify("The connection to the server was refused") == "unavailable"
+        )
+        assert (
+            retry.classify('Error from server (NotFound): pods "x" not found')
+            == "not-found"
+        )
+        assert (
+            retry.classify("Error from server (Forbidden): cannot list") == "forbidden"
+        )
+        assert retry.classify("exit status 1") == "other"
+
+    def test_retry_policy_backoff(self):
+        policy = retry.RetryPolicy()
+        deadline = time.monotonic() + 600
+        not_found = [policy.next_delay("NotFound", n, deadline) for n in (1, 2, 3)]
+        assert not_found[0] < 0.5 and not_found[0] < not_found[1] < not_found[2]
+        assert policy.next_delay("connection refused", 1, deadline) >= 1.6
+        assert policy.next_delay("Forbidden", 4, deadline) is not None
+        assert policy.next_delay("Forbidden", 5, deadline) is None
+        assert policy.next_delay("NotFound", 30, deadline) <= 3.6
+        assert policy.next_delay("NotFound", 1, time.monotonic()) is None
+
+    def test_retry_budget_is_shared_by_nested_calls(self):
+        with retry.budget(1):
+            start = time.monotonic()
+            with pytest.raises(CalledProcessError):
+                run_until_success("false", timeout_insec=60)
+            assert time.monotonic() - start < 2
+            with retry.budget(60):
+                assert retry.deadline(60) < time.monotonic() + 1
@@ -0,0 +1,156 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_state = {"test": None}
+spans = []
+
+
+class Span(object):
+    """
+    The record of one harness operation, eg a kubectl call or a wait.
+    """
+
+    def __init__(self, kind, command, addon=None):
+        self.kind = kind
+        self.command = command
+        self.addon = addon or current_addon()
+        self.test = _state["test"]
+        self.attempts = 0
+        self.sleep_total = 0.0
+        self.start = time.time()
+        self.wall = None
+        self.ok = True
+        self.error = None
+
+    def sleep(self, seconds):
+        """
+        Sleep between attempts, accounting the time to this span.
+        """
+        self.sleep_total += seconds
+        time.sleep(seconds)
+
+    def as_dict(self):
+        return {
+            "kind": self.kind,
+            "command": self.command,
+            "addon": self.addon,
+            "test": self.test,
+            "attempts": self.attempts,
+            "sleep": round(self.sleep_total, 3),
+            "start": round(self.start, 3),
+            "wall": round(self.wall, 3),
+            "ok": self.ok,
+            "error": self.error,
+        }
+
+
+@contextmanager
+def span(kind, command, addon=None):
+    """
+    Record a span around a harness operation. The span is written as a JSON line
+    to the file in $TIMINGS_FILE, if set, and kept in memory for the summary.
+    """
+    record = Span(kind, command, addon)
+    started = time.monotonic()
+    try:
+        yield record
+    except BaseException as err:
+        record.ok = False
+        record.error = "{}: {}".format(type(err).__name__, err)[:200]
+        raise
+    finally:
+        record.wall = time.monotonic() - started
+        with _lock:
+            spans.append(record)
+            path = os.environ.get("TIMINGS_FILE")
+            if path:
+                with open(path, "a") as f:
+                    f.write(json.dumps(record.as_dict()) + "\n")
+
+
+def addon_name(addon):
+    """
+    Returns: the addon name out of an enable or disable argument, eg
+    "registry --size=25Gi" or "dns:8.8.8.8" -> registry, dns
+
+    """
+    return re.split(r"[\s:]", addon.strip(), 1)[0]
+
+
+def current_addon():
+    """
+    Returns: the addon the current thread is working on, if any.
+
+    """
+    return getattr(_local, "addon", None)
+
+
+def set_current_addon(addon):
+    """
+    Attribute the spans recorded by this thread to addon, unless an
+    addon_context is in effect.
+    """
+    if not getattr(_local, "pinned", False):
+        _local.addon = addon
+
+
+@contextmanager
+def addon_context(addon):
+    """
+    Attribute the spans recorded by this thread to addon.
+    """
+    previous = current_addon(), getattr(_local, "pinned", False)
+    _local.addon, _local.pinned = addon, True
+    try:
+        yield
+    finally:
+        _local.addon, _local.pinned = previous
+
+
+def start_test(nodeid):
+    """
+    Attribute the spans recorded from now on to a test.
+    """
+    _state["test"] = nodeid
+    _local.addon = None
+
+
+def summarise(key):
+    """
+    Returns: a {key value: {kind: (count, attempts, sleep, wall)}} summary of
+    the spans, where key is "test" or "addon".
+
+    """
+    summary = {}
+    with _lock:
+        records = list(spans)
+    for record in records:
+        group = summary.setdefault(getattr(record, key) or "-", {})
+        count, attempts, sleep, wall = group.get(record.kind, (0, 0, 0.0, 0.0))
+        group[record.kind] = (
+            count + 1,
+            attempts + record.attempts,
+            sleep + record.sleep_total,
+            wall + record.wall,
+        )
+    return summary
+
+
+def format_summary(key):
+    lines = []
+    for group, kinds in sorted(summarise(key).items()):
+        lines.append(group)
+        for kind, (count, attempts, sleep, wall) in sorted(kinds.items()):
+            lines.append(
+                "  {:<10} {:>5} calls {:>6} attempts {:>9.1f}s sleeping {:>9.1f}s wall".format(
+                    kind, count, attempts, sleep, wall
+                )
+            )
+    return "\n".join(lines)
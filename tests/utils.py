@@ -1,61 +1,131 @@
 import os.path
 import datetime
+import math
+import sys
+import threading
 import time
 import yaml
-import platform
-from subprocess import check_output, CalledProcessError, check_call
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import check_output, CalledProcessError, Popen, PIPE, run
 
+import requests
 
-arch_translate = {"aarch64": "arm64", "x86_64": "amd64"}
+import retry
+import timing
+from environment import get_environment
+from kubeclient import ApiError, get_client, parse_get_target
 
 
 def get_arch():
     """
     Returns the architecture we are running on
     """
-    return arch_translate[platform.machine()]
+    return get_environment().arch
 
 
-def run_until_success(cmd, timeout_insec=60, err_out=None):
+def run_teeing_stderr(args, input=None):
     """
-    Run a command until it succeeds or times out.
+    Run a command, streaming its stderr to ours as it is written, eg the progress
+    of a microk8s enable, while also capturing it so that errors can be classified.
+    Args:
+        args: the command and its arguments
+        input: bytes fed to the command on stdin, else stdin is inherited
+
+    Returns: (stdout, stderr) of the command, as bytes
+
+    """
+    proc = Popen(
+        args, stdin=PIPE if input is not None else None, stdout=PIPE, stderr=PIPE
+    )
+    errors = []
+
+    def tee():
+        for line in proc.stderr:
+            sys.stderr.write(line.decode("utf8", "replace"))
+            sys.stderr.flush()
+            errors.append(line)
+
+    def feed():
+        try:
+            with proc.stdin:
+                proc.stdin.write(input)
+        except BrokenPipeError:
+            pass
+
+    threads = [threading.Thread(target=tee)]
+    if input is not None:
+        threads.append(threading.Thread(target=feed))
+    for thread in threads:
+        thread.start()
+    output = proc.stdout.read()
+    for thread in threads:
+        thread.join()
+    proc.stdout.close()
+    proc.stderr.close()
+    if proc.wait() != 0:
+        raise CalledProcessError(proc.returncode, args, output, b"".join(errors))
+    return output, b"".join(errors)
+
+
+def run_until_success(
+    cmd, timeout_insec=60, err_out=None, kind="command", addon=None, input=None
+):
+    """
+    Run a command until it succeeds or times out. The time between attempts
+    comes from the retry policy in effect, based on the error seen.
     Args:
         cmd: Command to run
-        timeout_insec: Time out in seconds
+        timeout_insec: Time out in seconds, cut short by any retry budget in effect
         err_out: If command fails and this is the output, return.
+        kind: the kind of timing span to record, eg kubectl
+        addon: the addon the command works on, if any
+        input: string fed to the command on stdin, on every attempt
 
     Returns: The string output of the command
 
     """
-    deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout_insec)
-    while True:
-        try:
-            output = check_output(cmd.split()).strip().decode("utf8")
-            return output.replace("\\n", "\n")
-        except CalledProcessError as err:
-            output = err.output.strip().decode("utf8").replace("\\n", "\n")
-            print(output)
-            if output == err_out:
-                return output
-            if datetime.datetime.now() > deadline:
-                raise
-            print("Retrying {}".format(cmd))
-            time.sleep(3)
+    deadline = retry.deadline(timeout_insec)
+    policy = retry.get_policy()
+    with timing.span(kind, cmd, addon) as span:
+        while True:
+            span.attempts += 1
+            try:
+                output, _ = run_teeing_stderr(
+                    cmd.split(), input.encode("utf8") if input is not None else None
+                )
+                return output.strip().decode("utf8").replace("\\n", "\n")
+            except CalledProcessError as err:
+                output = err.output.strip().decode("utf8").replace("\\n", "\n")
+                # Already streamed, kept to classify the error
+                errors = (err.stderr or b"").strip().decode("utf8")
+                print(output)
+                if output == err_out:
+                    return output
+                delay = policy.next_delay(errors or output, span.attempts, deadline)
+                if delay is None:
+                    raise
+                print(
+                    "Retrying {} in {:.1f}s ({})".format(
+                        cmd, delay, retry.classify(errors or output)
+                    )
+                )
+                span.sleep(delay)
 
 
-def kubectl(cmd, timeout_insec=300, err_out=None):
+def kubectl(cmd, timeout_insec=300, err_out=None, input=None):
     """
     Do a kubectl <cmd>
     Args:
         cmd: left part of kubectl <left_part> command
         timeout_insec: timeout for this job
         err_out: If command fails and this is the output, return.
+        input: string fed to kubectl on stdin, eg a manifest for apply -f -
 
     Returns: the kubectl response in a string
 
     """
     cmd = "/snap/bin/microk8s.kubectl " + cmd
-    return run_until_success(cmd, timeout_insec, err_out)
+    return run_until_success(cmd, timeout_insec, err_out, kind="kubectl", input=input)
 
 
 def docker(cmd):
@@ -71,12 +141,14 @@ def docker(cmd):
     if os.path.isfile("/snap/bin/microk8s.docker"):
         docker_bin = "/snap/bin/microk8s.docker"
     cmd = docker_bin + " " + cmd
-    return run_until_success(cmd)
+    return run_until_success(cmd, kind="docker")
 
 
 def kubectl_get(target, timeout_insec=300):
     """
     Do a kubectl get and return the results in a yaml structure.
+    The request is served by the pooled API client where possible, and falls back
+    to forking kubectl for targets the client does not understand.
     Args:
         target: which resource we are getting
         timeout_insec: timeout for this job
@@ -84,72 +156,531 @@ def kubectl_get(target, timeout_insec=300):
     Returns: YAML structured response
 
     """
-    cmd = "get -o yaml " + target
-    output = kubectl(cmd, timeout_insec)
-    return yaml.safe_load(output)
+    client = get_client()
+    parsed = parse_get_target(target, client.namespace) if client else None
+    if not parsed:
+        cmd = "get -o yaml " + target
+        output = kubectl(cmd, timeout_insec)
+        return yaml.safe_load(output)
+
+    resource, name, namespace, label = parsed
+    deadline = retry.deadline(timeout_insec)
+    policy = retry.get_policy()
+    with timing.span("kubectl", "get " + target) as span:
+        while True:
+            span.attempts += 1
+            try:
+                return client.get_resource(resource, name, namespace, label)
+            except (ApiError, requests.RequestException) as err:
+                print(err)
+                delay = policy.next_delay(err, span.attempts, deadline)
+                if delay is None:
+                    raise
+                print(
+                    "Retrying get {} in {:.1f}s ({})".format(
+                        target, delay, retry.classify(err)
+                    )
+                )
+                span.sleep(delay)
+
+
+def container_in_state(status, desired_state, desired_reason=None):
+    """
+    Returns: True if the first container of a pod status is in the desired state.
+
+    """
+    if "containerStatuses" not in status:
+        return False
+    container_status = status["containerStatuses"][0]
+    state, details = list(container_status["state"].items())[0]
+    if desired_reason:
+        reason = details.get("reason")
+        return state == desired_state and reason == desired_reason
+    return state == desired_state
 
 
 def wait_for_pod_state(
-    pod, namespace, desired_state, desired_reason=None, label=None, timeout_insec=600
+    pod,
+    namespace,
+    desired_state,
+    desired_reason=None,
+    label=None,
+    timeout_insec=600,
+    watch=True,
 ):
     """
     Wait for a a pod state. If you do not specify a pod name and you set instead a label
     only the first pod will be checked.
+    With watch set, and the API client available, a single watch stream is used
+    instead of polling every 3 seconds.
+    """
+    what = "pod {} in {}".format(pod or label, namespace)
+    with timing.span("wait", "{} {}".format(what, desired_state)) as span:
+        client = get_client()
+        if watch and client:
+            span.attempts += 1
+            return watch_for_pod_state(
+                client,
+                pod,
+                namespace,
+                desired_state,
+                desired_reason,
+                label,
+                timeout_insec,
+            )
+
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout_insec)
+        while True:
+            if datetime.datetime.now() > deadline:
+                raise TimeoutError(
+                    "Pod {} not in {} after {} seconds.".format(
+                        pod, desired_state, timeout_insec
+                    )
+                )
+            span.attempts += 1
+            cmd = "po {} -n {}".format(pod, namespace)
+            if label:
+                cmd += " -l {}".format(label)
+            data = kubectl_get(cmd, timeout_insec)
+            if pod == "":
+                if len(data["items"]) > 0:
+                    status = data["items"][0]["status"]
+                else:
+                    status = []
+            else:
+                status = data["status"]
+            if container_in_state(status, desired_state, desired_reason):
+                break
+            span.sleep(3)
+
+
+def watch_for_pod_state(
+    client, pod, namespace, desired_state, desired_reason, label, timeout_insec
+):
     """
-    deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout_insec)
-    while True:
-        if datetime.datetime.now() > deadline:
+    Wait for a pod state over a watch stream. The stream is resumed from the
+    last resourceVersion on disconnect, and the pods are listed again if that
+    resourceVersion has expired.
+    """
+    deadline = time.monotonic() + timeout_insec
+    field = "metadata.name={}".format(pod) if pod else None
+    pods = {}
+    seen = False
+    resource_version = None
+
+    def reached():
+        if not pods:
+            return False
+        first = pods[sorted(pods)[0]]
+        return container_in_state(first["status"], desired_state, desired_reason)
+
+    while time.monotonic() < deadline:
+        if resource_version is None:
+            try:
+                data = client.get_resource("po", None, namespace, label, field)
+            except (ApiError, requests.RequestException) as err:
+                print(err)
+                print("Retrying list of pods in {}".format(namespace))
+                time.sleep(3)
+                continue
+            pods = {p["metadata"]["name"]: p for p in data["items"]}
+            resource_version = data["metadata"].get("resourceVersion")
+            seen = seen or bool(pods)
+            if reached():
+                return
+
+        try:
+            for event, obj in client.watch(
+                "po", namespace, label, field, resource_version, deadline
+            ):
+                resource_version = obj["metadata"].get("resourceVersion")
+                name = obj["metadata"]["name"]
+                if event == "DELETED":
+                    pods.pop(name, None)
+                else:
+                    pods[name] = obj
+                    seen = True
+                if reached():
+                    return
+        except ApiError as err:
+            print(err)
+            if err.status != 410:
+                time.sleep(3)
+            resource_version = None
+
+    if pod and not seen:
+        raise ApiError(
+            404, "NotFound", 'pods "{}" not found'.format(pod), "pods/{}".format(pod)
+        )
+    raise TimeoutError(
+        "Pod {} not in {} after {} seconds.".format(pod, desired_state, timeout_insec)
+    )
+
+
+def selector_matches(labels, selector):
+    """
+    Returns: True if a label set matches an equality based label selector
+    such as "app=foo,tier!=db". An empty selector matches everything.
+
+    """
+    for term in [t.strip() for t in selector.split(",") if t.strip()]:
+        if "!=" in term:
+            key, value = term.split("!=", 1)
+            if labels.get(key.strip()) == value.strip():
+                return False
+        elif "=" in term:
+            key, value = term.replace("==", "=").split("=", 1)
+            if labels.get(key.strip()) != value.strip():
+                return False
+        elif term.startswith("!"):
+            if term[1:] in labels:
+                return False
+        elif term not in labels:
+            return False
+    return True
+
+
+def pod_satisfies(pod, condition):
+    """
+    Check every container of a pod against a condition. The condition is either
+    a container state such as "running", "ready" for the containers' readiness,
+    or a callable taking the pod.
+    """
+    if callable(condition):
+        return condition(pod)
+    statuses = pod.get("status", {}).get("containerStatuses", [])
+    containers = pod.get("spec", {}).get("containers", [])
+    if not statuses or len(statuses) < len(containers):
+        return False
+    if condition == "ready":
+        return all(s.get("ready") for s in statuses)
+    return all(condition in s["state"] for s in statuses)
+
+
+def wait_for_pods(selectors, namespaces, condition="running", timeout_insec=600):
+    """
+    Wait until every pod matching the label selectors in the namespaces satisfies
+    the condition, for all of its containers. Each selector has to match at least
+    one pod in each namespace. Completed and terminating pods are ignored.
+
+    Pods are tracked with one list and watch per namespace, or polled when the API
+    client is not available.
+
+    Returns: a dict of "namespace/pod" to the seconds it took the pod to get ready
+
+    """
+    if not namespaces:
+        return {}
+    start = time.monotonic()
+    deadline = start + timeout_insec
+    client = get_client()
+    addon = timing.current_addon()
+
+    def wait_in(namespace):
+        with timing.addon_context(addon):
+            if client:
+                return _watch_namespace_pods(
+                    client, namespace, selectors, condition, start, deadline
+                )
+            return _poll_namespace_pods(
+                namespace, selectors, condition, start, deadline
+            )
+
+    what = "pods {} in {} {}".format(
+        ",".join(selectors), ",".join(namespaces), condition
+    )
+    with timing.span("wait", what) as span:
+        span.attempts += 1
+        with ThreadPoolExecutor(max_workers=len(namespaces)) as executor:
+            results = list(executor.map(wait_in, namespaces))
+
+    times = {}
+    for namespace, ready in zip(namespaces, results):
+        if ready is None:
             raise TimeoutError(
-                "Pod {} not in {} after {} seconds.".format(
-                    pod, desired_state, timeout_insec
+                "Pods {} in {} not {} after {} seconds.".format(
+                    selectors, namespace, condition, timeout_insec
                 )
             )
-        cmd = "po {} -n {}".format(pod, namespace)
-        if label:
-            cmd += " -l {}".format(label)
-        data = kubectl_get(cmd, timeout_insec)
-        if pod == "":
-            if len(data["items"]) > 0:
-                status = data["items"][0]["status"]
-            else:
-                status = []
-        else:
-            status = data["status"]
-        if "containerStatuses" in status:
-            container_status = status["containerStatuses"][0]
-            state, details = list(container_status["state"].items())[0]
-            if desired_reason:
-                reason = details.get("reason")
-                if state == desired_state and reason == desired_reason:
-                    break
-            elif state == desired_state:
-                break
+        times.update({"{}/{}".format(namespace, p): t for p, t in ready.items()})
+
+    for pod, seconds in sorted(times.items(), key=lambda item: item[1]):
+        print("Pod {} {} after {:.1f}s".format(pod, condition, seconds))
+    return times
+
+
+def _barrier_reached(pods, selectors, condition, start, ready):
+    """
+    Record time-to-ready for the pods and return True if the barrier is satisfied.
+    """
+    tracked = {
+        name: pod
+        for name, pod in pods.items()
+        if pod.get("status", {}).get("phase") != "Succeeded"
+        and not pod["metadata"].get("deletionTimestamp")
+    }
+    for name, pod in tracked.items():
+        if name not in ready and pod_satisfies(pod, condition):
+            ready[name] = time.monotonic() - start
+    for selector in selectors:
+        matched = [
+            name
+            for name, pod in tracked.items()
+            if selector_matches(pod["metadata"].get("labels", {}), selector)
+        ]
+        if not matched or not all(
+            pod_satisfies(tracked[n], condition) for n in matched
+        ):
+            return False
+    return True
+
+
+def _watch_namespace_pods(client, namespace, selectors, condition, start, deadline):
+    pods = {}
+    ready = {}
+    resource_version = None
+    while time.monotonic() < deadline:
+        if resource_version is None:
+            try:
+                data = client.get_resource("po", None, namespace)
+            except (ApiError, requests.RequestException) as err:
+                print(err)
+                print("Retrying list of pods in {}".format(namespace))
+                time.sleep(3)
+                continue
+            pods = {p["metadata"]["name"]: p for p in data["items"]}
+            resource_version = data["metadata"].get("resourceVersion")
+            if _barrier_reached(pods, selectors, condition, start, ready):
+                return ready
+
+        try:
+            for event, obj in client.watch(
+                "po", namespace, resource_version=resource_version, deadline=deadline
+            ):
+                resource_version = obj["metadata"].get("resourceVersion")
+                if event == "DELETED":
+                    pods.pop(obj["metadata"]["name"], None)
+                else:
+                    pods[obj["metadata"]["name"]] = obj
+                if _barrier_reached(pods, selectors, condition, start, ready):
+                    return ready
+        except ApiError as err:
+            print(err)
+            if err.status != 410:
+                time.sleep(3)
+            resource_version = None
+    return None
+
+
+def _poll_namespace_pods(namespace, selectors, condition, start, deadline):
+    ready = {}
+    while time.monotonic() < deadline:
+        # Each get is bounded by the deadline too, so a hung one cannot overrun it
+        remaining = int(math.ceil(deadline - time.monotonic()))
+        data = kubectl_get(
+            "po -n {} --request-timeout={}s".format(namespace, remaining), remaining
+        )
+        pods = {p["metadata"]["name"]: p for p in data["items"]}
+        if _barrier_reached(pods, selectors, condition, start, ready):
+            return ready
         time.sleep(3)
+    return None
+
+
+def wait_for_objects(resource, namespace, done, timeout_insec=600, interval=1):
+    """
+    Wait until done(objects) returns True, where objects maps the names of the
+    objects of resource in namespace to the objects. done is called after the
+    initial list and after every change, so it can also record when objects
+    reach some state. The objects are watched through the API client where
+    possible, and polled every interval seconds otherwise.
+    Args:
+        resource: the resource, eg pvc
+        namespace: the namespace, None for all namespaces or cluster scoped resources
+        done: callable taking the {name: object} dict
+        timeout_insec: seconds to wait
+
+    """
+    deadline = time.monotonic() + timeout_insec
+    client = get_client()
+    with timing.span("wait", "{} in {}".format(resource, namespace)) as span:
+        resource_version = None
+        objects = {}
+        while time.monotonic() < deadline:
+            span.attempts += 1
+            if not client:
+                target = resource + (" -n " + namespace if namespace else " -A")
+                items = kubectl_get(target)["items"]
+                if done({o["metadata"]["name"]: o for o in items}):
+                    return
+                span.sleep(interval)
+                continue
+
+            if resource_version is None:
+                try:
+                    data = client.get_resource(resource, None, namespace)
+                except (ApiError, requests.RequestException) as err:
+                    print(err)
+                    span.sleep(3)
+                    continue
+                objects = {o["metadata"]["name"]: o for o in data["items"]}
+                resource_version = data["metadata"].get("resourceVersion")
+                if done(objects):
+                    return
+            try:
+                for event, obj in client.watch(
+                    resource,
+                    namespace,
+                    resource_version=resource_version,
+                    deadline=deadline,
+                ):
+                    resource_version = obj["metadata"].get("resourceVersion")
+                    if event == "DELETED":
+                        objects.pop(obj["metadata"]["name"], None)
+                    else:
+                        objects[obj["metadata"]["name"]] = obj
+                    if done(objects):
+                        return
+            except ApiError as err:
+                print(err)
+                if err.status != 410:
+                    span.sleep(3)
+                resource_version = None
+        raise TimeoutError(
+            "{} in {} not done after {} seconds".format(
+                resource, namespace, timeout_insec
+            )
+        )
+
+
+# kube-system workloads the cluster is not usable without, if they are deployed
+KUBE_SYSTEM_WORKLOADS = [
+    ("ds", "calico-node"),
+    ("deploy", "calico-kube-controllers"),
+    ("deploy", "coredns"),
+]
 
 
 def wait_for_installation(cluster_nodes=1, timeout_insec=360):
     """
-    Wait for kubernetes service to appear.
+    Wait for kubernetes service to appear, and for the cluster to be ready: the
+    nodes report Ready, the apiserver passes /readyz and the kube-system workloads
+    have rolled out. Returns as soon as all of them are healthy.
+    """
+    with timing.span("wait", "installation") as span:
+        while True:
+            span.attempts += 1
+            cmd = "svc kubernetes"
+            data = kubectl_get(cmd, timeout_insec)
+            service = data["metadata"]["name"]
+            if "kubernetes" in service:
+                break
+            else:
+                span.sleep(3)
+
+        start = time.monotonic()
+        deadline = start + timeout_insec
+        gates = [
+            ("nodes", lambda: nodes_not_ready(cluster_nodes)),
+            ("apiserver", apiserver_not_ready),
+        ]
+        for kind, name in KUBE_SYSTEM_WORKLOADS:
+            gates.append((name, lambda k=kind, n=name: rollout_pending(k, n)))
+
+        waiting_on = None
+        while True:
+            span.attempts += 1
+            for component, check in gates:
+                detail = check()
+                if detail:
+                    break
+            else:
+                print(
+                    "Cluster ready after {:.1f}s, last waited on {}".format(
+                        time.monotonic() - start, waiting_on or "nothing"
+                    )
+                )
+                return
+            if component != waiting_on:
+                print("Waiting for {}: {}".format(component, detail))
+                waiting_on = component
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    "Cluster not ready after {} seconds, waiting for {}: {}".format(
+                        timeout_insec, component, detail
+                    )
+                )
+            span.sleep(1)
+
+
+def nodes_not_ready(cluster_nodes):
+    """
+    Returns: why the nodes are not ready yet, or None if cluster_nodes are Ready.
+
     """
-    while True:
-        cmd = "svc kubernetes"
-        data = kubectl_get(cmd, timeout_insec)
-        service = data["metadata"]["name"]
-        if "kubernetes" in service:
-            break
-        else:
-            time.sleep(3)
+    ready = count_ready_nodes(kubectl_get("no"))
+    if ready != cluster_nodes:
+        return "{} of {} nodes Ready".format(ready, cluster_nodes)
+    return None
+
+
+def apiserver_not_ready():
+    """
+    Returns: why the apiserver is not ready yet, or None if /readyz passes.
 
-    while True:
-        cmd = "get no"
-        nodes = kubectl(cmd, timeout_insec)
-        if nodes.count(" Ready") == cluster_nodes:
-            break
+    """
+    client = get_client()
+    try:
+        if client:
+            client.request("GET", "/readyz", timeout=10)
         else:
-            time.sleep(3)
+            cmd = "/snap/bin/microk8s.kubectl get --raw /readyz"
+            run(cmd.split(), stdout=PIPE, stderr=PIPE, check=True)
+    except (CalledProcessError, requests.RequestException) as err:
+        return "/readyz failed: {}".format(str(err).strip()[:200])
+    return None
+
+
+def rollout_pending(kind, name, namespace="kube-system"):
+    """
+    Returns: why a deployment or daemonset has not rolled out yet, or None if it
+    has, or if it is not deployed at all.
+
+    """
+    items = kubectl_get("{} -n {}".format(kind, namespace))["items"]
+    matches = [i for i in items if i["metadata"]["name"] == name]
+    if not matches:
+        return None
+    obj = matches[0]
+    status = obj.get("status", {})
+    if status.get("observedGeneration", 0) < obj["metadata"].get("generation", 0):
+        return "{} update not observed yet".format(name)
+    if kind == "ds":
+        desired = status.get("desiredNumberScheduled", 0)
+        updated = status.get("updatedNumberScheduled", 0)
+        available = status.get("numberAvailable", 0)
+    else:
+        desired = obj["spec"].get("replicas", 1)
+        updated = status.get("updatedReplicas", 0)
+        available = status.get("availableReplicas", 0)
+    if updated < desired or available < desired:
+        return "{} has {} updated and {} available of {} pods".format(
+            name, updated, available, desired
+        )
+    return None
+
 
-    # Allow rest of the services to come up
-    time.sleep(30)
+def count_ready_nodes(nodes):
+    """
+    Returns: the number of nodes in a node list with the Ready condition set.
+
+    """
+    ready = 0
+    for node in nodes["items"]:
+        for condition in node["status"].get("conditions", []):
+            if condition["type"] == "Ready" and condition["status"] == "True":
+                ready += 1
+    return ready
 
 
 def wait_for_namespace_termination(namespace, timeout_insec=360):
@@ -159,17 +690,23 @@ def wait_for_namespace_termination(namespace, timeout_insec=360):
 
     print("Waiting for namespace {} to be removed".format(namespace))
     deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout_insec)
-    while True:
-        try:
-            cmd = "/snap/bin/microk8s.kubectl get ns {}".format(namespace)
-            check_output(cmd.split()).strip().decode("utf8")
-            print("Waiting...")
-        except CalledProcessError:
-            if datetime.datetime.now() > deadline:
-                raise
-            else:
-                return
-        time.sleep(10)
+    client = get_client()
+    with timing.span("wait", "namespace {} removed".format(namespace)) as span:
+        while True:
+            span.attempts += 1
+            try:
+                if client:
+                    client.get_resource("ns", namespace)
+                else:
+                    cmd = "/snap/bin/microk8s.kubectl get ns {}".format(namespace)
+                    check_output(cmd.split()).strip().decode("utf8")
+                print("Waiting...")
+            except (CalledProcessError, requests.RequestException):
+                if datetime.datetime.now() > deadline:
+                    raise
+                else:
+                    return
+            span.sleep(10)
 
 
 def microk8s_enable(addon, timeout_insec=300, force=False):
@@ -186,15 +723,16 @@ def microk8s_enable(addon, timeout_insec=300, force=False):
         if is_lxc_container():
             print("We are in an lxc container. Will not test gpu addon")
             raise CalledProcessError(1, "Nothing to do for gpu")
-        nv_out = run_until_success("lspci", timeout_insec=10)
-        if "NVIDIA" not in nv_out.upper():
+        if not get_environment().gpu:
             print("Not a cuda capable system. Will not test gpu addon")
             raise CalledProcessError(1, "Nothing to do for gpu")
 
+    name = timing.addon_name(addon)
+    timing.set_current_addon(name)
     cmd = "/snap/bin/microk8s.enable {}".format(addon)
     if force:
         cmd = "{} --force".format(cmd)
-    return run_until_success(cmd, timeout_insec)
+    return run_until_success(cmd, timeout_insec, kind="enable", addon=name)
 
 
 def microk8s_disable(addon):
@@ -206,7 +744,9 @@ def microk8s_disable(addon):
 
     """
     cmd = "/snap/bin/microk8s.disable {}".format(addon)
-    return run_until_success(cmd, timeout_insec=300)
+    return run_until_success(
+        cmd, timeout_insec=300, kind="disable", addon=timing.addon_name(addon)
+    )
 
 
 def microk8s_clustering_capable():
@@ -221,50 +761,16 @@ def microk8s_reset(cluster_nodes=1):
     Call microk8s reset
     """
     cmd = "/snap/bin/microk8s.reset"
-    run_until_success(cmd, timeout_insec=300)
+    run_until_success(cmd, timeout_insec=300, kind="reset")
     wait_for_installation(cluster_nodes)
 
 
-def update_yaml_with_arch(manifest_file):
-    """
-    Updates any $ARCH entry with the architecture in the manifest
-
-    """
-    arch = arch_translate[platform.machine()]
-    with open(manifest_file) as f:
-        s = f.read()
-
-    with open(manifest_file, "w") as f:
-        s = s.replace("$ARCH", arch)
-        f.write(s)
-
-
 def is_container():
     """
     Returns: True if the deployment is in a VM/container.
 
     """
-    try:
-        if os.path.isdir("/run/systemd/system"):
-            container = check_output("sudo systemd-detect-virt --container".split())
-            print("Tests are running in {}".format(container))
-            return True
-    except CalledProcessError:
-        print("systemd-detect-virt did not detect a container")
-
-    if os.path.exists("/run/container_type"):
-        return True
-
-    try:
-        check_call(
-            "sudo grep -E (lxc|hypervisor) /proc/1/environ /proc/cpuinfo".split()
-        )
-        print("Tests are running in an undetectable container")
-        return True
-    except CalledProcessError:
-        print("no indication of a container in /proc")
-
-    return False
+    return get_environment().is_container
 
 
 def is_lxc_container():
@@ -272,14 +778,7 @@ def is_lxc_container():
     Returns: True if the deployment is in an lxc container.
 
     """
-    try:
-        check_call("sudo grep -E lxc /proc/1/environ /proc/cpuinfo".split())
-        print("Tests are running in an lxc container")
-        return True
-    except CalledProcessError:
-        print("no indication of a container in /proc")
-
-    return False
+    return get_environment().is_lxc_container
 
 
 def is_multinode():
@@ -287,11 +786,4 @@ def is_multinode():
     Return: True if the deployment is multinode
 
     """
-    try:
-        cmd = ["/snap/bin/microk8s.kubectl", "get", "no", "-o", "name"]
-        nodes = check_output(cmd).decode("utf-8").split()
-        return len(nodes) > 1
-    except CalledProcessError:
-        print("Failed to query the cluster nodes.")
-
-    return False
+    return get_environment().is_multinode
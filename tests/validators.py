@@ -1,26 +1,28 @@
 import time
 import os
 import re
-import requests
-import platform
 import yaml
 import subprocess
 from pathlib import Path
 
+from environment import get_environment
+from manifests import apply_manifest, delete_manifest
+from probe import ProbeClient, probe
 from utils import (
     get_arch,
     kubectl,
     wait_for_pod_state,
+    wait_for_pods,
     kubectl_get,
     wait_for_installation,
     docker,
-    update_yaml_with_arch,
     run_until_success,
     is_multinode,
 )
 
 TEMPLATES = Path(__file__).absolute().parent / "templates"
 PATCH_TEMPLATES = Path(__file__).absolute().parent / "templates" / "patches"
+INGRESS_URL = "http://microbot.127.0.0.1.nip.io/"
 
 
 def validate_storage():
@@ -47,8 +49,8 @@ def validate_storage():
             )
         )
 
-    manifest = TEMPLATES / "pvc.yaml"
-    kubectl("apply -f {}".format(manifest))
+    manifest = "pvc.yaml"
+    apply_manifest(manifest)
     wait_for_pod_state("hostpath-test-pod", "default", "running")
 
     attempt = 50
@@ -68,7 +70,7 @@ def validate_storage():
     assert found
     assert "myclaim" in output
     assert "Bound" in output
-    kubectl("delete -f {}".format(manifest))
+    delete_manifest(manifest)
 
 
 def validate_storage_custom_pvdir():
@@ -97,8 +99,8 @@ def validate_storage_custom_pvdir():
             )
         )
 
-    manifest = TEMPLATES / "pvc-pvdir.yaml"
-    kubectl("apply -f {}".format(manifest))
+    manifest = "pvc-pvdir.yaml"
+    apply_manifest(manifest)
     wait_for_pod_state("hostpath-test-pod-pvdir", "default", "running")
 
     attempt = 50
@@ -118,7 +120,11 @@ def validate_storage_custom_pvdir():
     assert found
     assert "myclaim" in output
     assert "Bound" in output
-    kubectl("delete -f {}".format(manifest))
+    delete_manifest(manifest)
+
+
+def microbot_page(resp):
+    return "microbot.png" in resp.text
 
 
 def common_ingress():
@@ -135,50 +141,51 @@ def common_ingress():
         attempt -= 1
     assert "microbot.127.0.0.1.nip.io" in output
 
-    service_ok = False
-    attempt = 50
-    while attempt >= 0:
-        try:
-            resp = requests.get("http://microbot.127.0.0.1.nip.io/")
-            if resp.status_code == 200 and "microbot.png" in resp.content.decode(
-                "utf-8"
-            ):
-                service_ok = True
-                break
-        except requests.RequestException:
-            time.sleep(5)
-            attempt -= 1
-
-    assert service_ok
+    result = probe(INGRESS_URL, check=microbot_page)
+    assert result.ok()
 
 
-def validate_ingress():
+def validate_ingress(load_test=None):
     """
     Validate ingress by creating an ingress rule.
     Traefik is deployed as a DaemonSet in the 'ingress' namespace.
+
+    Args:
+        load_test: optional (duration, clients) to load the ingress with that many
+            keep-alive clients for duration seconds once it is validated
+
+    Returns: the ProbeResult of the load test, if one was run
+
     """
-    if platform.machine() == "s390x":
+    if get_environment().machine == "s390x":
         print("Ingress tests are not available on s390x")
         return
 
     # Wait for Traefik pods to be ready
     wait_for_pod_state("", "ingress", "running", label="app.kubernetes.io/name=traefik")
 
-    manifest = TEMPLATES / "ingress.yaml"
-    update_yaml_with_arch(manifest)
-    kubectl("apply -f {}".format(manifest))
+    manifest = "ingress.yaml"
+    apply_manifest(manifest)
     wait_for_pod_state("", "default", "running", label="app=microbot")
 
-    common_ingress()
-
-    kubectl("delete -f {}".format(manifest))
+    try:
+        common_ingress()
+        if load_test:
+            duration, clients = load_test
+            client = ProbeClient(pool_maxsize=clients)
+            result = client.load(INGRESS_URL, duration, clients, check=microbot_page)
+            print(result.format())
+            print("{:.1f} requests/s".format(result.rps or 0))
+            return result
+    finally:
+        delete_manifest(manifest)
 
 
 def validate_gpu():
     """
     Validate gpu by trying a cuda-add.
     """
-    if platform.machine() != "x86_64":
+    if get_environment().machine != "x86_64":
         print("GPU tests are only relevant in x86 architectures")
         return
 
@@ -189,15 +196,15 @@ def validate_gpu():
         label="app=nvidia-device-plugin-daemonset",
         timeout_insec=1500,
     )
-    manifest = TEMPLATES / "cuda-add.yaml"
+    manifest = "cuda-add.yaml"
 
     get_pod = kubectl_get("po")
     if "cuda-vector-add" in str(get_pod):
         # Cleanup
-        kubectl("delete -f {}".format(manifest))
+        delete_manifest(manifest)
         time.sleep(10)
 
-    kubectl("apply -f {}".format(manifest))
+    apply_manifest(manifest)
     wait_for_pod_state("cuda-vector-add", "default", "terminated")
     result = kubectl("logs pod/cuda-vector-add")
     assert "PASSED" in result
@@ -217,12 +224,12 @@ def validate_registry():
     docker("tag busybox localhost:32000/my-busybox")
     docker("push localhost:32000/my-busybox")
 
-    manifest = TEMPLATES / "bbox-local.yaml"
-    kubectl("apply -f {}".format(manifest))
+    manifest = "bbox-local.yaml"
+    apply_manifest(manifest)
     wait_for_pod_state("busybox", "default", "running")
     output = kubectl("describe po busybox")
     assert "localhost:32000/my-busybox" in output
-    kubectl("delete -f {}".format(manifest))
+    delete_manifest(manifest)
 
 
 def validate_registry_custom(size, storageclass):
@@ -241,36 +248,28 @@ def validate_registry_custom(size, storageclass):
     docker("tag busybox localhost:32000/my-busybox")
     docker("push localhost:32000/my-busybox")
 
-    manifest = TEMPLATES / "bbox-local.yaml"
-    kubectl("apply -f {}".format(manifest))
+    manifest = "bbox-local.yaml"
+    apply_manifest(manifest)
     wait_for_pod_state("busybox", "default", "running")
     output = kubectl("describe po busybox")
     assert "localhost:32000/my-busybox" in output
-    kubectl("delete -f {}".format(manifest))
+    delete_manifest(manifest)
 
 
 def validate_forward():
     """
     Validate ports are forwarded
     """
-    manifest = TEMPLATES / "nginx-pod.yaml"
-    kubectl("apply -f {}".format(manifest))
+    manifest = "nginx-pod.yaml"
+    apply_manifest(manifest)
     wait_for_pod_state("", "default", "running", label="app=nginx")
     os.system("killall kubectl")
     os.system("/snap/bin/microk8s.kubectl port-forward pod/nginx 5123:80 &")
-    attempt = 10
-    while attempt >= 0:
-        try:
-            resp = requests.get("http://localhost:5123")
-            if resp.status_code == 200:
-                break
-        except requests.RequestException:
-            pass
-        attempt -= 1
-        time.sleep(2)
-
-    assert resp.status_code == 200
-    os.system("killall kubectl")
+    try:
+        result = probe("http://localhost:5123", timeout_insec=30)
+    finally:
+        os.system("killall kubectl")
+    assert result.ok()
 
 
 def validate_networking():
@@ -279,29 +278,17 @@ def validate_networking():
     """
     files = ["nginx-svc.yaml", "nginx-pod.yaml"]
     for file in files:
-        manifest = TEMPLATES / file
-        kubectl("apply -f {}".format(manifest))
+        apply_manifest(file)
 
     cluster_ip = kubectl("get svc/nginx -o jsonpath='{.spec.clusterIP}'")
     cluster_ip = cluster_ip.strip("'")
     wait_for_pod_state("", "default", "running", label="app=nginx")
 
-    attempt = 10
-    while attempt >= 0:
-        try:
-            resp = requests.get(f"http://{cluster_ip}")
-            if resp.status_code == 200:
-                break
-        except requests.RequestException:
-            pass
-        attempt -= 1
-        time.sleep(2)
-
-    assert resp.status_code == 200
+    result = probe(f"http://{cluster_ip}", timeout_insec=30)
+    assert result.ok()
 
     for file in files:
-        manifest = TEMPLATES / file
-        kubectl("delete -f {}".format(manifest))
+        delete_manifest(file)
 
 
 def validate_metrics_server():
@@ -327,20 +314,17 @@ def validate_observability():
     """
     Validate the observability operator
     """
-    if platform.machine() != "x86_64":
+    if get_environment().machine != "x86_64":
         print("Observability tests are only relevant in x86 architectures")
         return
 
-    wait_for_pod_state(
-        "prometheus-kube-prom-stack-kube-prome-prometheus-0",
-        "observability",
-        "running",
-        timeout_insec=1200,
-    )
-    wait_for_pod_state(
-        "alertmanager-kube-prom-stack-kube-prome-alertmanager-0",
-        "observability",
-        "running",
+    wait_for_pods(
+        [
+            "app.kubernetes.io/name=prometheus",
+            "app.kubernetes.io/name=alertmanager",
+            "app.kubernetes.io/name=grafana",
+        ],
+        ["observability"],
         timeout_insec=1200,
     )
 
@@ -361,7 +345,7 @@ def validate_metallb_config(ip_ranges="192.168.0.105"):
     """
     Validate Metallb
     """
-    if platform.machine() != "x86_64":
+    if get_environment().machine != "x86_64":
         print("Metallb tests are only relevant in x86 architectures")
         return
     out = kubectl(
@@ -387,10 +371,10 @@ def validate_mayastor():
     Validate mayastor. Waits for the mayastor control plane to come up,
     then ensures that we can create a test pod with a PVC.
     """
-    wait_for_pod_state("", "mayastor", "running", label="app=mayastor")
+    wait_for_pods(["app=mayastor"], ["mayastor"])
 
-    manifest = TEMPLATES / "mayastor-pvc.yaml"
-    kubectl("apply -f {}".format(manifest))
+    manifest = "mayastor-pvc.yaml"
+    apply_manifest(manifest)
     wait_for_pod_state("mayastor-test-pod", "default", "running")
 
     attempt = 50
@@ -401,7 +385,7 @@ def validate_mayastor():
         time.sleep(2)
         attempt -= 1
 
-    kubectl("delete -f {}".format(manifest))
+    delete_manifest(manifest)
 
 
 def validate_cert_manager():
@@ -415,10 +399,10 @@ def validate_cert_manager():
     )
     wait_for_pod_state("", "ingress", "running", label="app.kubernetes.io/name=traefik")
 
-    manifest = TEMPLATES / "cert-manager-aio-test.yaml"
-    kubectl("apply -f {}".format(manifest))
+    manifest = "cert-manager-aio-test.yaml"
+    apply_manifest(manifest)
     kubectl("wait cert/mock-ingress-tls --for=condition=ready=true")
-    kubectl("delete -f {}".format(manifest))
+    delete_manifest(manifest)
 
 
 def validate_cis_hardening():
@@ -445,7 +429,7 @@ def validate_rook_ceph():
     Validate rook-ceph. Wait for rook-ceph operator to come up.
     """
     wait_for_installation()
-    wait_for_pod_state("", "rook-ceph", "running", label="app=rook-ceph-operator")
+    wait_for_pods(["app=rook-ceph-operator"], ["rook-ceph"])
 
 
 def validate_rook_ceph_integration():
@@ -453,9 +437,9 @@ def validate_rook_ceph_integration():
     Integration test for rook-ceph microceph.
     """
     wait_for_installation()
-    wait_for_pod_state("", "rook-ceph", "running", label="app=rook-ceph-operator")
+    wait_for_pods(["app=rook-ceph-operator"], ["rook-ceph"])
 
-    manifest = TEMPLATES / "microceph.yaml"
+    manifest = "microceph.yaml"
     try:
         subprocess.check_call("microceph cluster bootstrap".split())
         subprocess.check_call("microceph status".split())
@@ -484,7 +468,7 @@ def validate_rook_ceph_integration():
         subprocess.check_call("ceph fs volume create fs0".split())
         subprocess.check_call("microk8s connect-external-ceph".split())
 
-        kubectl("apply -f {}".format(manifest))
+        apply_manifest(manifest)
         wait_for_pod_state("nginx-rbd", "default", "running")
         # We do not test ceph-fs because its provisioner requires CPU cores
         # that may not be available on small VMs. If you want to test ceph-fs
@@ -494,4 +478,4 @@ def validate_rook_ceph_integration():
         # wait_for_pod_state("nginx-fs-2", "default", "running")
 
     finally:
-        kubectl("delete -f {}".format(manifest))
+        delete_manifest(manifest)